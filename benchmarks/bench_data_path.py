@@ -0,0 +1,193 @@
+'''
+    Benchmark of the data-path functions of the analysis scripts on synthetic data (see synthetic_data.py).
+
+    For every function and data size the best time of some repetitions and the peak memory (tracemalloc) of one call
+    are measured. The generated files are kept in the data directory and reused by later runs.
+    Results can be saved as json and compared to a previous run to see regressions:
+
+    python bench_data_path.py --sizes small medium --json new.json --compare old.json
+
+    Sizes:
+    small       10^4 point xyz, 1 h temperature log, 10 IV files, 10^3 wafer SNs
+    medium      10^5 point xyz, 1 day temperature log, 100 IV files, 10^4 wafer SNs
+    production  10^6 point xyz, 1 week temperature log, 10k IV files, 10^5 wafer SNs (takes hours with the current readers)
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ('metrology', 'sensor_iv', 'thermal_cycling', 'sn_parser'):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+sys.path.insert(0, ROOT)
+
+import synthetic_data as sd  # noqa: E402
+import plot_metrology  # noqa: E402
+import scan_sensor_iv  # noqa: E402
+import thermocycling_data  # noqa: E402
+import plot_thermocycling_QC  # noqa: E402
+import parse_sn  # noqa: E402
+
+SIZES = {
+    'small': dict(xyz=10 ** 4, csv=100, temps=60 * 60, iv=10, sns=10 ** 3),
+    'medium': dict(xyz=10 ** 5, csv=1000, temps=24 * 60 * 60, iv=100, sns=10 ** 4),
+    'production': dict(xyz=10 ** 6, csv=10 ** 4, temps=7 * 24 * 60 * 60, iv=10 ** 4, sns=10 ** 5),
+}
+
+
+def measure(f, repeat=3, min_time=1.):
+    ''' Best time of repeat calls (only one call if it takes longer than min_time) and peak memory of one call in byte. '''
+    f = _quiet(f)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+        if times[-1] > min_time:
+            break
+    tracemalloc.start()
+    try:
+        f()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def _quiet(f):
+    ''' f without the result prints of the scripts. '''
+    def call():
+        with redirect_stdout(io.StringIO()):
+            f()
+    return call
+
+
+def cached(filename, generate, *args):
+    ''' Generate a data file unless it is there from a previous run. '''
+    if not os.path.exists(filename):
+        logging.info('Generating {0}'.format(os.path.basename(filename)))
+        generate(filename, *args)
+    return filename
+
+
+def get_data(filename):
+    return lambda: plot_metrology.get_data(filename)
+
+
+def benchmarks(size, data_dir):
+    ''' (name, n, function) of all benchmarks of one size. '''
+    n = SIZES[size]
+    xyz = cached(os.path.join(data_dir, 'metrology_{0}.xyz'.format(n['xyz'])), sd.write_metrology_xyz, n['xyz'])
+    csv = cached(os.path.join(data_dir, 'metrology_{0}.csv'.format(n['csv'])), sd.write_metrology_csv, n['csv'])
+    grid = plot_metrology.get_data(xyz)[:3]
+    temps_qc = cached(os.path.join(data_dir, 'temps_qc_{0}.dat'.format(n['temps'])), sd.write_temps_log, n['temps'], 1., 'qc')
+    temps_dc = cached(os.path.join(data_dir, 'temps_dc_{0}.dat'.format(n['temps'])), sd.write_temps_log, n['temps'], 1., 'dc')
+    iv_path = os.path.join(data_dir, 'iv')
+    if not os.path.isdir(iv_path):
+        os.makedirs(iv_path)
+    iv_files = [cached(os.path.join(iv_path, 'iv_{0:05d}.h5'.format(i)), sd.write_iv_file, 100, i) for i in range(n['iv'])]
+    sns = sd.wafer_sns(n['sns'])
+
+    def load_temps(filename, names=None, cache_files=False):
+        def f():
+            thermocycling_data._cache.clear()  # measure a full parse (or a load from the cache file), not the incremental reload
+            thermocycling_data.CACHE_FILES = cache_files
+            try:
+                thermocycling_data.load_temps(filename, names=names)
+            finally:
+                thermocycling_data.CACHE_FILES = True
+        return f
+
+    def plot_iv():
+        for filename in iv_files:
+            scan_sensor_iv.plot(filename)
+
+    def plot_qc():
+        thermocycling_data._cache.clear()
+        plot_thermocycling_QC.plot(temps_qc, [os.path.join(data_dir, 'temps_qc.pdf')])
+
+    def parse_wafer_sns():
+        for sn in sns:
+            parse_sn.parse_wafer_sn(sn)
+
+    yield 'metrology.get_data(xyz)', n['xyz'], get_data(xyz)
+    yield 'metrology.get_data(csv)', n['csv'], get_data(csv)
+    yield 'metrology.get_maximum_bow', grid[2].size, lambda: plot_metrology.get_maximum_bow(*grid)
+    yield 'thermocycling.load_temps(QC)', n['temps'], load_temps(temps_qc)
+    yield 'thermocycling.load_temps(cache)', n['temps'], load_temps(temps_qc, cache_files=True)
+    yield 'thermocycling.load_temps(DC)', n['temps'], load_temps(temps_dc, thermocycling_data.DC_NAMES)
+    yield 'plot_thermocycling_QC.plot', n['temps'], plot_qc
+    yield 'scan_sensor_iv.plot', n['iv'], plot_iv
+    yield 'parse_sn.parse_wafer_sn', n['sns'], parse_wafer_sns
+
+
+def xlsx_benchmark(data_dir):
+    ''' The xlsx layout has a fixed size. Reading needs xlrd < 2, writing the test file openpyxl. '''
+    try:
+        xlsx = cached(os.path.join(data_dir, 'metrology.xlsx'), sd.write_metrology_xlsx)
+        plot_metrology.get_data(xlsx)
+    except Exception as e:
+        logging.warning('Skipping metrology.get_data(xlsx): {0}'.format(e))
+        return []
+    return [('metrology.get_data(xlsx)', 44, get_data(xlsx))]
+
+
+def compare(results, baseline, threshold):
+    ''' Log the change to the baseline results, returns the regressions. '''
+    old = {(r['name'], r['size']): r for r in baseline}
+    regressions = []
+    for r in results:
+        ref = old.get((r['name'], r['size']))
+        if ref is None:
+            continue
+        ratio = r['time'] / ref['time']
+        mem_ratio = r['peak_memory'] / max(ref['peak_memory'], 1)
+        flag = ''
+        # Differences below 1 ms and 1 MB are noise
+        if (ratio > threshold and r['time'] - ref['time'] > 1e-3) or (mem_ratio > threshold and r['peak_memory'] - ref['peak_memory'] > 2 ** 20):
+            flag = ' REGRESSION'
+            regressions.append(r)
+        print('{0:<32} {1:<10} time x{2:6.2f}  memory x{3:6.2f}{4}'.format(r['name'], r['size'], ratio, mem_ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the data-path functions on synthetic data')
+    parser.add_argument('--sizes', nargs='+', default=['small'], choices=list(SIZES))
+    parser.add_argument('--only', default=None, help='Only run benchmarks whose name contains this string')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'module_scripts_benchmark_data'), help='Directory of the generated data files')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', default=None, help='Write the results to this file')
+    parser.add_argument('--compare', default=None, help='Results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2, help='Slow down (or memory increase) counted as regression')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)-7s %(message)s', level=logging.INFO)
+    results = []
+    print('{0:<32} {1:<10} {2:>8} {3:>10} {4:>12} {5:>11}'.format('benchmark', 'size', 'n', 'time[s]', 'per item[us]', 'peak[MB]'))
+    for size in args.sizes:
+        data_dir = os.path.join(args.data_dir, size)
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        for name, n, f in list(benchmarks(size, data_dir)) + xlsx_benchmark(data_dir):
+            if args.only is not None and args.only not in name:
+                continue
+            t, peak = measure(f, repeat=args.repeat)
+            results.append(dict(name=name, size=size, n=n, time=t, peak_memory=peak))
+            print('{0:<32} {1:<10} {2:8d} {3:10.4f} {4:12.2f} {5:11.2f}'.format(name, size, n, t, t / n * 1e6, peak / 2 ** 20))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        sys.exit(1 if compare(results, baseline, args.threshold) else 0)
@@ -0,0 +1,105 @@
+'''
+    Start-up time of the scripts: every module import and command runs in a fresh interpreter, the median wall time
+    of some repetitions is reported. With --importtime the slowest imports of each module (python -X importtime)
+    are listed, e.g. to find a heavy import which crept back to the top of a script.
+
+    python bench_import.py --repeat 5 --importtime 5
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name, folder added to the path, module
+IMPORTS = [
+    ('import parse_sn', 'sn_parser', 'parse_sn'),
+    ('import batch_sn', 'sn_parser', 'batch_sn'),
+    ('import scan_sensor_iv', 'sensor_iv', 'scan_sensor_iv'),
+    ('import plot_metrology', 'metrology', 'plot_metrology'),
+    ('import run_thermocycling_QC', 'thermal_cycling', 'run_thermocycling_QC'),
+    ('import run_connectivity_cycles', 'thermal_cycling', 'run_connectivity_cycles'),
+]
+
+# name, arguments of cli.py
+COMMANDS = [
+    ('cli.py --help', ['--help']),
+    ('cli.py sn wafer', ['sn', 'wafer', 'N25A67-01B6']),
+    ('cli.py sn chip', ['sn', 'chip', '0x103B']),
+    ('cli.py iv --dry-run', ['iv', '--dry-run']),
+    ('cli.py thermocycle qc --dry-run', ['thermocycle', 'qc', '--dry-run']),
+]
+
+
+def import_command(folder, module):
+    code = 'import sys; sys.path.insert(0, {0!r}); sys.path.insert(0, {1!r}); import {2}'.format(ROOT, os.path.join(ROOT, folder), module)
+    return [sys.executable, '-c', code]
+
+
+def run(cmd, repeat):
+    ''' Median wall time of repeat runs of cmd, None if it fails (e.g. missing optional dependency). '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        times.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            return None, proc.stderr.decode(errors='replace').strip().splitlines()[-1:]
+    return float(np.median(times)), None
+
+
+def slowest_imports(folder, module, n):
+    ''' The n direct imports of module with the largest cumulative time in us (python -X importtime). '''
+    cmd = import_command(folder, module)
+    proc = subprocess.run(cmd[:1] + ['-X', 'importtime'] + cmd[1:], cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    imports = []
+    for line in proc.stderr.decode(errors='replace').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # A module is listed after its imports, indented by two spaces per level
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        if level == 0:
+            if name.strip() == module:
+                return sorted(imports, reverse=True)[:n]
+            imports = []
+        elif level == 1:
+            imports.append((int(cumulative), name.strip()))
+    return []
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the start-up time of the scripts and the command line')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--importtime', type=int, default=0, help='Show this many slowest imports per module')
+    parser.add_argument('--json', default=None, help='Write the results to this file')
+    args = parser.parse_args()
+
+    baseline, _ = run([sys.executable, '-c', 'pass'], args.repeat)
+    print('{0:<36} {1:>9}'.format('interpreter start-up', '{0:1.3f}'.format(baseline)))
+    print('{0:<36} {1:>9} {2:>9}'.format('benchmark', 'time[s]', '-start[s]'))
+    results = []
+    cases = [(name, import_command(folder, module)) for name, folder, module in IMPORTS]
+    cases += [(name, [sys.executable, os.path.join(ROOT, 'cli.py')] + cli_args) for name, cli_args in COMMANDS]
+    for name, cmd in cases:
+        t, error = run(cmd, args.repeat)
+        if t is None:
+            print('{0:<36} failed: {1}'.format(name, ' '.join(error)))
+            continue
+        results.append(dict(name=name, time=t, startup=baseline))
+        print('{0:<36} {1:9.3f} {2:9.3f}'.format(name, t, t - baseline))
+
+    for name, folder, module in IMPORTS[:args.importtime and len(IMPORTS)]:
+        print('\nSlowest imports of {0}:'.format(module))
+        for cumulative, imported in slowest_imports(folder, module, args.importtime):
+            print('  {0:9.3f}s {1}'.format(cumulative * 1e-6, imported))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,258 @@
+'''
+    Benchmark of the measurement loops on the simulated instruments (instruments/simulation.py).
+
+    The periphery yaml files of the scripts are loaded with the simulation enabled, so no hardware is needed.
+    For every loop the wall time, the time spent in instrument calls and in sleeps is measured, the rest is the
+    overhead of the loop itself:
+
+    iv_scan            SensorIVScan._scan over a short voltage range
+    acquire            CycleController.acquire, one readout of all sensors of the QC setup incl. interlock
+    go_to_temperature  CycleController.go_to_temperature from ambient to the target temperature
+    program            run_thermocycling_QC.run_program, one short cycle uploaded as program of the simulated chamber
+    host_program       the same cycle run by a HostProgram on the chamber in manual mode
+    server             opening the QC periphery and reading all sensors, directly and through an instrument server
+                       (instruments/server.py) which already holds the open instruments
+
+    Sleeps of the scripts and the simulated chamber run time_scale times faster than the wall clock.
+
+    python bench_loops.py --time-scale 60 --latency 0.002
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'sensor_iv'))
+sys.path.insert(0, os.path.join(ROOT, 'thermal_cycling'))
+
+from instruments.io_metrics import IOMetrics, InstrumentedDut  # noqa: E402
+from instruments.simulation import load_conf, create_dut  # noqa: E402
+from instruments.server import InstrumentServer  # noqa: E402
+import scan_sensor_iv  # noqa: E402
+import cycle_controller  # noqa: E402
+from cycle_controller import CycleController  # noqa: E402
+from campaign_state import CampaignState  # noqa: E402
+from chamber_program import HostProgram  # noqa: E402
+
+IV_CONFIG = os.path.join(ROOT, 'sensor_iv', 'sensor_iv.yaml')
+QC_CONFIG = os.path.join(ROOT, 'thermal_cycling', 'thermocycling_QC.yaml')
+
+
+class ScaledTime(object):
+    ''' Stand-in for the time module of a script: sleeps are shortened by time_scale and summed up. '''
+
+    def __init__(self, time_scale):
+        self.time_scale = time_scale
+        self.slept = 0.
+
+    def sleep(self, seconds):
+        start = time.perf_counter()
+        time.sleep(seconds / self.time_scale)
+        self.slept += time.perf_counter() - start
+
+    def __getattr__(self, attr):
+        return getattr(time, attr)
+
+
+def sim_conf(filename, time_scale, latency=None, noise=None):
+    ''' Periphery configuration of filename with enabled simulation. '''
+    conf = load_conf(filename)
+    sim = dict(conf.get('simulation') or {}, time_scale=time_scale)
+    if latency is not None:
+        sim['latency'] = latency
+    if noise is not None:
+        sim['noise'] = noise
+    sim['enabled'] = True
+    conf['simulation'] = sim
+    return conf
+
+
+def io_time(metrics):
+    return sum(stats.total for stats in metrics.calls.values())
+
+
+def result(name, iterations, wall, io, slept=0., **kwargs):
+    ''' Timing of one benchmark, overhead is the wall time which is neither spent in instrument calls nor sleeping. '''
+    return dict(name=name, iterations=int(iterations), wall=wall, io=io, sleep=slept,
+                overhead_per_iteration=(wall - io - slept) / max(iterations, 1), **kwargs)
+
+
+def bench_iv_scan(time_scale, latency, noise, v_stop=-40, v_step=-2, samples=5):
+    clock = ScaledTime(time_scale)
+    scan_sensor_iv.time = clock
+    with tempfile.TemporaryDirectory() as tmp:
+        scan_sensor_iv.OUTPUT_DIR = os.path.join(tmp, 'output_data')
+        config = dict(scan_sensor_iv.scan_configuration, VBIAS_start=0, VBIAS_stop=v_stop, VBIAS_step=v_step, samples=samples)
+        scan = scan_sensor_iv.SensorIVScan(config, device_config=sim_conf(IV_CONFIG, time_scale, latency, noise))
+        metrics = scan.io_metrics
+        scan.init()
+        try:
+            start, start_io, start_sleep = time.perf_counter(), io_time(metrics), clock.slept
+            scan._scan()
+            wall = time.perf_counter() - start
+            steps = scan.raw_data_table.nrows
+        finally:
+            scan.h5_file.close()
+            scan.devices.close()
+    scan_sensor_iv.time = time
+    return result('iv_scan', steps, wall, io_time(metrics) - start_io, clock.slept - start_sleep)
+
+
+def qc_sensors(dut):
+    ''' Sensors of the QC setup, the last one is the dew point calculated by the interlock. '''
+    import run_thermocycling_QC  # creates the output folder of the runner
+
+    return run_thermocycling_QC.setup_sensors(dut)
+
+
+def qc_controller(outfile, time_scale, latency, noise):
+    metrics = IOMetrics()
+    dut = InstrumentedDut(create_dut(sim_conf(QC_CONFIG, time_scale, latency, noise)), metrics)
+    dut.init()
+    # One sample and log entry per 1 s and 10 s of simulated time
+    ctrl = CycleController(dut, qc_sensors(dut), outfile, t_sens='t_mod2', air_sens=['air2', 'sens', 'air'], mod_sens=['mod', 'mod2'],
+                           sample_period=1. / time_scale, log_period=10. / time_scale, timeout=2 * 60 * 60 / time_scale,
+                           sample_log_level=logging.DEBUG)
+    return ctrl, dut, metrics
+
+
+def bench_acquire(time_scale, latency, noise, n=200):
+    with tempfile.TemporaryDirectory() as tmp:
+        ctrl, dut, metrics = qc_controller(os.path.join(tmp, 'temps.dat'), time_scale, latency, noise)
+        start = time.perf_counter()
+        for _ in range(n):
+            ctrl.acquire()
+        wall = time.perf_counter() - start
+        dut.close()
+    return result('acquire', n, wall, io_time(metrics))
+
+
+def bench_go_to_temperature(time_scale, latency, noise, target=-20):
+    clock = ScaledTime(1.)  # the sampling period is already scaled
+    cycle_controller.time = clock
+    with tempfile.TemporaryDirectory() as tmp:
+        ctrl, dut, metrics = qc_controller(os.path.join(tmp, 'temps.dat'), time_scale, latency, noise)
+        env = dut._dut.env
+        dut['Climatechamber'].start_manual_mode()
+        dut['Climatechamber'].set_air_dryer(True)
+        start, start_io, start_sim = time.perf_counter(), io_time(metrics), env.now()
+        ctrl.go_to_temperature(target, overshoot=-5, accuracy=1)
+        wall = time.perf_counter() - start
+        sim_time = env.now() - start_sim
+        dut.close()
+    cycle_controller.time = time
+    return result('go_to_temperature', ctrl.n_samples, wall, io_time(metrics) - start_io, clock.slept,
+                  simulated_time=sim_time, max_sampling_lag=ctrl.clock.max_lag, max_interlock_latency=ctrl.max_latency)
+
+
+def bench_program(time_scale, latency, noise, host=False, temps=(-20, 40), wait_time=60, settle_time=10 * 60):
+    ''' The supervising loop of a program, the simulated time should match the programmed one. '''
+    import run_thermocycling_QC  # creates the output folder of the runner
+
+    clock = ScaledTime(1.)  # the sampling period is already scaled
+    cycle_controller.time = clock
+    run_thermocycling_QC.program_settle_time = settle_time
+    cycles = np.array([(1, temps, wait_time)], dtype=run_thermocycling_QC.cycles.dtype)
+    with tempfile.TemporaryDirectory() as tmp:
+        ctrl, dut, metrics = qc_controller(os.path.join(tmp, 'temps.dat'), time_scale, latency, noise)
+        env = dut._dut.env
+        chamber = dut['Climatechamber']
+        chamber.start_manual_mode()
+        chamber.set_air_dryer(True)
+        state = CampaignState(os.path.join(tmp, 'state.json'))
+        state.reset()
+        runner = HostProgram(chamber, clock=env.now) if host else chamber
+        start, start_io, start_sim = time.perf_counter(), io_time(metrics), env.now()
+        run_thermocycling_QC.run_program(ctrl, runner, cycles, env.air_temperature, state)
+        wall = time.perf_counter() - start
+        sim_time = env.now() - start_sim
+        dut.close()
+    cycle_controller.time = time
+    return result('host_program' if host else 'program', ctrl.n_samples, wall, io_time(metrics) - start_io, clock.slept,
+                  simulated_time=sim_time, programmed_time=len(temps) * (settle_time + wait_time), completed_cycles=state['completed_cycles'],
+                  max_sampling_lag=ctrl.clock.max_lag, max_interlock_latency=ctrl.max_latency)
+
+
+def bench_host_program(time_scale, latency, noise):
+    return bench_program(time_scale, latency, noise, host=True)
+
+
+def bench_server(time_scale, latency, noise, n=20, port=6012):
+    ''' One job: open the QC periphery, read all sensors n times, close. The server pays the set-up only once. '''
+    conf = sim_conf(QC_CONFIG, time_scale, latency, noise)
+    calls = []
+
+    def job(conf):
+        start = time.perf_counter()
+        dut = create_dut(conf)
+        dut.init()
+        sensors = qc_sensors(dut)[:-1]  # without the calculated dew point
+        for _ in range(n):
+            for sensor in sensors:
+                sensor['f'](**sensor['kwargs'])
+        dut.close()
+        calls.append(n * len(sensors))
+        return time.perf_counter() - start
+
+    direct = job(conf)
+    server = InstrumentServer(('localhost', port)).start()
+    try:
+        conf['server'] = {'enabled': True, 'address': 'localhost:{0}'.format(port)}
+        job(conf)  # opens the periphery on the server
+        start_io = io_time(server.pool.metrics)
+        remote = job(conf)
+        io = io_time(server.pool.metrics) - start_io
+    finally:
+        server.close()
+    # The overhead per iteration is the one of a remote call
+    return result('server', calls[-1], remote, io, direct=direct)
+
+
+BENCHMARKS = {
+    'iv_scan': bench_iv_scan,
+    'acquire': bench_acquire,
+    'go_to_temperature': bench_go_to_temperature,
+    'program': bench_program,
+    'host_program': bench_host_program,
+    'server': bench_server,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the measurement loops on simulated instruments')
+    parser.add_argument('benchmarks', nargs='*', help='Benchmarks to run ({0}), all by default'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--time-scale', type=float, default=60., help='Simulated seconds per second')
+    parser.add_argument('--latency', type=float, default=None, help='Duration of an instrument call in s, default from the yaml files')
+    parser.add_argument('--noise', type=float, default=None, help='Relative noise of the measured values, default from the yaml files')
+    parser.add_argument('--json', default=None, help='Write the results to this file')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('Unknown benchmarks: {0}'.format(', '.join(sorted(unknown))))
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)-7s %(message)s', level=logging.WARNING)
+    results = []
+    print('{0:<20} {1:>10} {2:>9} {3:>9} {4:>9} {5:>14}'.format('benchmark', 'iterations', 'wall[s]', 'io[s]', 'sleep[s]', 'overhead[ms/it]'))
+    for name in args.benchmarks or BENCHMARKS:
+        res = BENCHMARKS[name](args.time_scale, args.latency, args.noise)
+        results.append(res)
+        print('{name:<20} {iterations:10d} {wall:9.3f} {io:9.3f} {sleep:9.3f} {0:14.3f}'.format(res['overhead_per_iteration'] * 1e3, **res))
+        if 'direct' in res:
+            print('{0:<20} same job without server {1:1.3f}s'.format('', res['direct']))
+        if 'programmed_time' in res:
+            print('{0:<20} simulated time {1:1.0f}s of {2:1.0f}s programmed, {3} cycles completed'.format(
+                '', res['simulated_time'], res['programmed_time'], res['completed_cycles']))
+        elif 'simulated_time' in res:
+            print('{0:<20} simulated time to target {1:1.0f}s, max. sampling lag {2:1.3f}s'.format('', res['simulated_time'], res['max_sampling_lag']))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,105 @@
+'''
+    Latency of notify() in the control loop with a slow and failing Slack API.
+
+    A local stub of the Slack web API (chat.postMessage) answers every request after --delay s and rejects the
+    first --rate-limited requests with HTTP 429 (Retry-After). A control loop samples every --period s and sends a
+    notification on every sample (the worst case, like a dew point alarm on every readout). The loop's sampling lag
+    shows whether the notifications delay the control path. Needs the slack package (slackclient).
+
+    python bench_notifications.py --delay 2 --rate-limited 3
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'thermal_cycling'))
+
+from notifications import Notifier  # noqa: E402
+
+
+class SlackStub(object):
+    ''' Local http server answering like chat.postMessage of the Slack web API. '''
+
+    def __init__(self, delay=0., rate_limited=0, retry_after=1):
+        self.delay = delay
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.messages = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())
+                time.sleep(stub.delay)
+                if stub.rate_limited > 0:
+                    stub.rate_limited -= 1
+                    self.reply(429, {'ok': False, 'error': 'ratelimited'}, {'Retry-After': str(stub.retry_after)})
+                else:
+                    stub.messages.append(body)
+                    self.reply(200, {'ok': True})
+
+            def reply(self, status, data, headers={}):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(json.dumps(data).encode())
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('localhost', 0), Handler)
+        self.url = 'http://localhost:{0}/api/'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def control_loop(notify, duration, period):
+    ''' Fixed rate loop with a notification per sample, returns the notify durations and the max. sampling lag. '''
+    durations, max_lag = [], 0.
+    start = next_sample = time.perf_counter()
+    while next_sample - start < duration:
+        now = time.perf_counter()
+        if now < next_sample:
+            time.sleep(next_sample - now)
+        max_lag = max(max_lag, time.perf_counter() - next_sample)
+        t = time.perf_counter()
+        notify('Dew point interlock triggered, holding temperature!')
+        durations.append(time.perf_counter() - t)
+        next_sample += period
+    return np.array(durations), max_lag
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the notification queue against a local Slack stub')
+    parser.add_argument('--delay', type=float, default=2., help='Response time of the stub in s')
+    parser.add_argument('--rate-limited', type=int, default=3, help='Number of requests rejected with HTTP 429')
+    parser.add_argument('--duration', type=float, default=5., help='Duration of the control loop in s')
+    parser.add_argument('--period', type=float, default=0.1, help='Sampling period of the control loop in s')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)-7s %(message)s', level=logging.WARNING)
+    stub = SlackStub(args.delay, args.rate_limited)
+    notifier = Notifier('xoxb-benchmark', ['U0001', 'U0002'], base_url=stub.url, coalesce_window=1., backoff=0.5)
+    durations, max_lag = control_loop(notifier.notify, args.duration, args.period)
+    notifier.close(timeout=args.delay * 10)
+    stub.close()
+
+    print('notify calls       {0}'.format(len(durations)))
+    print('notify mean / max  {0:1.1f} / {1:1.1f} us'.format(durations.mean() * 1e6, durations.max() * 1e6))
+    print('max. sampling lag  {0:1.1f} ms'.format(max_lag * 1e3))
+    print('posts received     {0} ({1})'.format(len(stub.messages), ', '.join(sorted(set(m['channel'] for m in stub.messages)))))
+    print('statistics         {0}'.format(notifier.stats))
@@ -0,0 +1,146 @@
+'''
+    Generators of synthetic input files in the formats read by the analysis scripts.
+
+    The data only has to look realistic enough to take the same code paths as measured data
+    (value ranges, missing values, number of unique coordinates), it is not physically accurate.
+'''
+
+import os
+
+import numpy as np
+import tables as tb
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Sensors of run_thermocycling_QC.py in the order of the data columns
+QC_NAMES = ['t_chamber', 't_setp', 't_sens', 't_mod', 't_air', 't_mod2', 't_air2', 'h_sens', 'h_mod', 'h_air', 'h_mod2', 'h_air2',
+            'd_sens', 'd_mod', 'd_air', 'd_mod2', 'd_air2', 'dew_point']
+DC_NAMES = ['t_setp', 't_chamber', 't_sens', 'h_sens', 't_mod', 'h_mod', 't_air', 'h_air']
+
+
+def _surface(x, y, rng, bow=0.05):
+    ''' Module surface in mm: paraboloid with bow in the center, a tilt and measurement noise. '''
+    xn = (x - x.mean()) / max(np.ptp(x), 1)
+    yn = (y - y.mean()) / max(np.ptp(y), 1)
+    return 0.3 + bow * (1 - 4 * (xn ** 2 + yn ** 2)) + 0.01 * xn + 0.002 * rng.standard_normal(x.shape)
+
+
+def write_metrology_xyz(filename, n_points, seed=0):
+    ''' Point cloud 'x y z' in mm on a grid with 1 mm pitch (the reader rounds x and y to mm). '''
+    rng = np.random.default_rng(seed)
+    nx = int(np.sqrt(n_points))
+    ny = n_points // nx
+    x, y = np.meshgrid(np.arange(nx, dtype=float), np.arange(ny, dtype=float))
+    x = x.ravel() + 0.01 * rng.standard_normal(nx * ny)  # stage positioning error
+    y = y.ravel() + 0.01 * rng.standard_normal(nx * ny)
+    np.savetxt(filename, np.column_stack((x, y, _surface(x, y, rng))), fmt='%.4f', delimiter=' ')
+    return filename
+
+
+def write_metrology_csv(filename, n_rows, seed=0):
+    ''' Microscope measurement: 4 points (x, y, z) per row at fixed x positions in um. '''
+    rng = np.random.default_rng(seed)
+    y = np.arange(n_rows, dtype=float) * 2000.
+    x = np.array([0., 13000., 26000., 39000.])
+    X, Y = np.meshgrid(x, y)
+    Z = _surface(X, Y, rng) * 1e3
+    data = np.stack((X, Y, Z), axis=-1).reshape(n_rows, 12)
+    np.savetxt(filename, data, fmt='%.1f', delimiter=',')
+    return filename
+
+
+def write_metrology_xlsx(filename, seed=0):
+    ''' Sheet with the 11 x 4 height grid and the module envelope as read by plot_metrology.get_data. Needs openpyxl. '''
+    import openpyxl
+
+    rng = np.random.default_rng(seed)
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    x = [0., 13000., 26000., 39000.]
+    y = [i * 4000. for i in range(11)]
+    X, Y = np.meshgrid(x, y)
+    Z = _surface(X, Y, rng) * 1e3
+    for col in range(11):
+        ws.cell(row=3, column=col + 2, value=y[col])
+        for row in range(4):
+            ws.cell(row=row + 4, column=col + 2, value=float(Z[col, row]))
+        ws.cell(row=9, column=col + 2, value=float(700 + rng.normal(0, 5)))  # sensor height
+        ws.cell(row=10, column=col + 2, value=float(1100 + rng.normal(0, 5)))  # module height
+        ws.cell(row=11, column=col + 2, value=float(450 + rng.normal(0, 5)))  # sensor thickness
+    for row in range(4):
+        ws.cell(row=row + 4, column=1, value=x[row])
+        ws.cell(row=row + 4, column=14, value=float(42200 + rng.normal(0, 10)))  # module width
+    wb.save(filename)
+    return filename
+
+
+def write_iv_file(filename, n_steps=100, seed=0):
+    ''' Output file of scan_sensor_iv.SensorIVScan with an IV curve of n_steps points. '''
+    rng = np.random.default_rng(seed)
+    voltage = -np.arange(1, n_steps + 1) * 2
+    current = -1e-7 * np.sqrt(np.minimum(-voltage / 50., 1)) / np.maximum(1 - (-voltage / (2.2 * n_steps)) ** 4, 1e-3)
+    with tb.open_file(filename, 'w') as f:
+        f.create_group(f.root, 'configuration', 'Configuration')
+        run_config = f.create_table(f.root.configuration, name='run_config', title='Run config',
+                                    description=np.dtype([('attribute', 'S64'), ('value', 'S512')]))
+        run_config.append([(b'scan_id', b'sensor_iv_scan'), (b'run_name', os.path.basename(filename)[:-3].encode()),
+                           (b'module', b'SIM 0001'), (b'chip_type', b'rd53a')])
+        raw_data = np.zeros(n_steps, dtype=[('voltage', np.int32), ('current', np.float64), ('current_error', np.float64)])
+        raw_data['voltage'] = voltage
+        raw_data['current'] = current * (1 + 0.01 * rng.standard_normal(n_steps))
+        raw_data['current_error'] = np.abs(current) * 0.01
+        f.create_table(f.root, name='raw_data', title='Raw data', obj=raw_data)
+    return filename
+
+
+def write_temps_log(filename, duration, period=1., layout='qc', start=1.6e9, seed=0):
+    '''
+    Temperature log of a thermal cycling run of duration s, sampled every period s, in the QC layout (with header)
+    or the fixed DC layout. The chamber cycles between -45 and 40 °C, a few sensor readouts are missing (None).
+    '''
+    rng = np.random.default_rng(seed)
+    names = QC_NAMES if layout == 'qc' else DC_NAMES
+    t = start + np.arange(0, duration, period)
+    setp = np.where((t - start) % 7200 < 3600, -45., 40.)
+    data = np.empty((len(t), len(names)))
+    for i, name in enumerate(names):
+        if name.startswith('h_'):
+            data[:, i] = np.clip(30 + 10 * np.sin((t - start) / 3600.) + rng.standard_normal(len(t)), 0, 100)
+        elif name.startswith('d_') or name == 'dew_point':
+            data[:, i] = -40 + rng.standard_normal(len(t))
+        elif name == 't_setp':
+            data[:, i] = setp
+        else:
+            data[:, i] = setp * 0.9 + rng.standard_normal(len(t))
+    data[rng.random(data.shape) < 1e-3] = np.nan
+
+    with open(filename, 'w') as f:
+        if layout == 'qc':
+            f.write('#Timestamp, ' + ', '.join(names + ['dew_point']) + ', ' + '\n')
+        else:
+            f.write('#Timestamp, T_setpoint, T_chamber, T_sens, Hum_sens, T_mod, Hum_mod, T_air, Hum_air\n')
+        chunk = 100000
+        for i in range(0, len(t), chunk):
+            rows = np.column_stack((t[i:i + chunk], data[i:i + chunk]))
+            lines = [', '.join(['{0}'.format(r[0])] + ['{0:1.2f}'.format(v) for v in r[1:]]) for r in rows]
+            f.write('\n'.join(lines).replace('nan', 'None') + '\n')
+    return filename
+
+
+def wafer_sns(n, seed=0):
+    ''' Wafer serial numbers as typed by users: TSMC numbers with other check characters and lab identifiers. '''
+    import parse_sn
+
+    rng = np.random.default_rng(seed)
+    with open(os.path.join(ROOT, 'sn_parser', 'flipchip_lookup.yaml'), 'r') as f:
+        identifiers = [k for d in yaml.safe_load(f).values() for k in d]
+    tsmc = list(parse_sn.lookup_wafer_tsmc_rd53)
+    sns = []
+    for i in rng.integers(0, len(tsmc) + len(identifiers), n):
+        if i < len(tsmc):
+            sn = tsmc[i][:-2] + 'XX'
+            sns.append(sn.lower() if rng.random() < 0.5 else sn)
+        else:
+            sns.append(identifiers[i - len(tsmc)])
+    return sns
@@ -0,0 +1,224 @@
+'''
+    Command line entry point of the measurement scripts.
+
+    python cli.py sn wafer N25A67-01B6           wafer serial number in all formats
+    python cli.py sn chip 0x103B                 wafer and position of a chip
+    python cli.py sn batch chips.csv -o out.h5   convert a table of chip serial numbers
+    python cli.py iv --stop -100 --dry-run       check the IV scan configuration without hardware
+    python cli.py iv --stability --bias -150     leakage current over time at -150 V
+    python cli.py metrology module.xyz           metrology report of a measurement file
+    python cli.py thermocycle qc                 run a thermal cycling script (qc, dc, multi, connectivity, plot)
+    python cli.py dossier --workers 8            QC dossiers of the modules with new or changed results
+
+    Only the modules of the chosen subcommand are imported, the heavy ones (tables, matplotlib, basil, bdaq53, slack)
+    where they are used, so quick commands like a serial number lookup or a dry-run start fast.
+'''
+
+import os
+import sys
+import argparse
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+THERMOCYCLE_SCRIPTS = {
+    'qc': 'run_thermocycling_QC.py',
+    'dc': 'run_thermocycling_DC.py',
+    'multi': 'run_multi_chamber.py',
+    'connectivity': 'run_connectivity_cycles.py',
+    'plot': 'plot_thermocycling_QC.py',
+}
+THERMOCYCLE_CONFIGS = {
+    'qc': 'thermocycling_QC.yaml',
+    'dc': 'thermocycling_DC.yaml',
+    'multi': 'thermocycling_QC.yaml',
+    'connectivity': 'thermocycling_DC.yaml',
+}
+
+
+def _add_path(folder):
+    path = os.path.join(ROOT, folder)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def _has_module(name):
+    ''' Module name can be imported, without importing it. '''
+    import importlib.util
+
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ImportError:  # parent package missing
+        return False
+
+
+def check_periphery(conf):
+    '''
+    Check a periphery configuration without opening the hardware: every transfer layer and driver type needs a
+    basil module (or a simulation model if the simulation is enabled). Returns the list of problems.
+    '''
+    sys.path.insert(0, ROOT)
+    from instruments.simulation import load_conf, DRIVERS
+
+    conf = load_conf(conf)
+    simulate = (conf.get('simulation') or {}).get('enabled', False)
+    problems = []
+    if not simulate:
+        for intf in conf.get('transfer_layer', []):
+            if not _has_module('basil.TL.' + intf.get('type', '')):
+                problems.append('No basil transfer layer for {0} of type {1}'.format(intf.get('name'), intf.get('type')))
+    names = set()
+    for hw_conf in conf.get('hw_drivers', []):
+        name, driver = hw_conf.get('name'), hw_conf.get('type')
+        if name in names:
+            problems.append('Duplicate driver name {0}'.format(name))
+        names.add(name)
+        if simulate:
+            if driver not in DRIVERS:
+                problems.append('No simulation for driver {0} of type {1}'.format(name, driver))
+        elif not _has_module('basil.HL.' + driver):
+            problems.append('No basil driver for {0} of type {1}'.format(name, driver))
+        if not simulate and hw_conf.get('interface') not in [i.get('name') for i in conf.get('transfer_layer', [])]:
+            problems.append('Unknown interface {0} of driver {1}'.format(hw_conf.get('interface'), name))
+    return problems
+
+
+def _report(problems, what):
+    for problem in problems:
+        print(problem)
+    print('{0}: {1}'.format(what, 'ok' if not problems else '{0} problem(s)'.format(len(problems))))
+    return 1 if problems else 0
+
+
+def cmd_sn(args):
+    _add_path('sn_parser')
+    import parse_sn
+
+    index = parse_sn.get_index()
+    if args.kind == 'wafer':
+        for sn in args.sn:
+            tsmc_sn = parse_sn.parse_wafer_sn(sn, index)
+            rd53 = index.tsmc_to_rd53[tsmc_sn]
+            print('{0}: {1} (ITk) / {2} (RD53) / {3} (TSMC)'.format(sn, parse_sn.generate_itk_wafer_sn(rd53), rd53, tsmc_sn))
+    elif args.kind == 'chip':
+        for sn in args.sn:
+            rd53 = parse_sn.find_wafer_from_chip_sn(sn)
+            col, row = parse_sn.find_chip(sn)
+            print('{0}: wafer {1} (ITk) / {2} (RD53) / {3} (TSMC), chip {4}-{5}'.format(
+                sn, parse_sn.generate_itk_wafer_sn(rd53), rd53, index.rd53_to_tsmc.get(rd53, 'unknown'), col, row))
+    else:
+        from batch_sn import convert_chip_sns
+
+        convert_chip_sns(args.sn[0], args.output, args.column, args.node, index)
+    return 0
+
+
+def cmd_iv(args):
+    device_config = args.config or os.path.join(ROOT, 'sensor_iv', 'sensor_iv.yaml')
+    if args.dry_run:
+        return _report(check_periphery(device_config), device_config)
+
+    _add_path('sensor_iv')
+    import scan_sensor_iv
+
+    if args.stability:
+        scan_class, config = scan_sensor_iv.SensorStabilityScan, dict(scan_sensor_iv.stability_configuration)
+    else:
+        scan_class, config = scan_sensor_iv.SensorIVScan, dict(scan_sensor_iv.scan_configuration)
+    for key, value in (('module_name', args.module), ('VBIAS_start', args.start), ('VBIAS_stop', args.stop),
+                       ('VBIAS_step', args.step), ('samples', args.samples), ('hv_current_limit', args.current_limit),
+                       ('VBIAS', args.bias), ('duration', args.duration)):
+        if value is not None:
+            config[key] = value
+    with scan_class(scan_config=config, device_config=device_config) as scan:
+        scan.start()
+    return 0
+
+
+def cmd_metrology(args):
+    _add_path('metrology')
+    import plot_metrology
+
+    plot_metrology.create_report(args.file, live=args.show)
+    return 0
+
+
+def cmd_thermocycle(args):
+    folder = os.path.join(ROOT, 'thermal_cycling')
+    if args.dry_run:
+        if args.script not in THERMOCYCLE_CONFIGS:
+            print('Nothing to check for {0}'.format(args.script))
+            return 0
+        config = os.path.join(folder, THERMOCYCLE_CONFIGS[args.script])
+        return _report(check_periphery(config), config)
+
+    import runpy
+
+    # The scripts write their output files relative to the working directory and import their neighbours
+    _add_path('thermal_cycling')
+    sys.argv = [THERMOCYCLE_SCRIPTS[args.script]]
+    runpy.run_path(os.path.join(folder, THERMOCYCLE_SCRIPTS[args.script]), run_name='__main__')
+    return 0
+
+
+def cmd_dossier(args):
+    import logging
+
+    _add_path('qc_dossier')
+    import build_dossiers
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)-7s %(message)s', level=logging.INFO)
+    built, failed, up_to_date = build_dossiers.build_dossiers(output_dir=args.output or build_dossiers.OUTPUT_DIR,
+                                                              workers=args.workers, force=args.force)
+    print('{0} dossiers built, {1} failed, {2} up to date'.format(built, failed, up_to_date))
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Module QC measurement scripts')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    sn = subparsers.add_parser('sn', help='Convert chip and wafer serial numbers')
+    sn.add_argument('kind', choices=['wafer', 'chip', 'batch'])
+    sn.add_argument('sn', nargs='+', help='Serial numbers, or the csv / HDF5 file for batch')
+    sn.add_argument('--column', default=None, help='Column of the serial numbers (batch)')
+    sn.add_argument('--node', default='/chips', help='HDF5 node of the serial numbers (batch)')
+    sn.add_argument('-o', '--output', default=None, help='Output file (batch), default: print csv')
+    sn.set_defaults(func=cmd_sn)
+
+    iv = subparsers.add_parser('iv', help='Sensor IV scan')
+    iv.add_argument('--config', default=None, help='Periphery yaml file, default: sensor_iv/sensor_iv.yaml')
+    iv.add_argument('--module', default=None)
+    iv.add_argument('--start', type=int, default=None, help='Start voltage in V')
+    iv.add_argument('--stop', type=int, default=None, help='Stop voltage in V')
+    iv.add_argument('--step', type=int, default=None, help='Voltage step in V')
+    iv.add_argument('--samples', type=int, default=None, help='Current samples per step')
+    iv.add_argument('--current-limit', type=float, default=None, help='Current limit in A')
+    iv.add_argument('--stability', action='store_true', help='Current vs. time at a fixed bias voltage instead of an IV curve')
+    iv.add_argument('--bias', type=int, default=None, help='Bias voltage of the stability scan in V')
+    iv.add_argument('--duration', type=float, default=None, help='Duration of the stability scan in s')
+    iv.add_argument('--dry-run', action='store_true', help='Only check the periphery configuration')
+    iv.set_defaults(func=cmd_iv)
+
+    metrology = subparsers.add_parser('metrology', help='Metrology report')
+    metrology.add_argument('file', help='Measurement file (xyz, csv or xlsx)')
+    metrology.add_argument('--show', action='store_true', help='Show the surface plot')
+    metrology.set_defaults(func=cmd_metrology)
+
+    thermocycle = subparsers.add_parser('thermocycle', help='Thermal cycling scripts')
+    thermocycle.add_argument('script', choices=list(THERMOCYCLE_SCRIPTS))
+    thermocycle.add_argument('--dry-run', action='store_true', help='Only check the periphery configuration')
+    thermocycle.set_defaults(func=cmd_thermocycle)
+
+    dossier = subparsers.add_parser('dossier', help='QC dossiers of all modules (IV, metrology and thermal cycling)')
+    dossier.add_argument('-o', '--output', default=None, help='Folder of the dossiers, default: qc_dossier/output_data')
+    dossier.add_argument('--workers', type=int, default=None, help='Worker processes, default: number of CPUs')
+    dossier.add_argument('--force', action='store_true', help='Rebuild all dossiers')
+    dossier.set_defaults(func=cmd_dossier)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
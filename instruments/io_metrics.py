@@ -0,0 +1,183 @@
+'''
+    Latency and error statistics of the instrument calls.
+
+    InstrumentedDut wraps a basil Dut: every method call on one of its drivers (e.g. dut['Sourcemeter'].get_current())
+    is timed and counted per driver and method. The statistics can be exported in the Prometheus text format to a
+    file or a local http endpoint and printed as a summary at the end of a run.
+'''
+
+import os
+import time
+import logging
+import threading
+
+import numpy as np
+
+# Upper bounds of the latency histogram buckets in s
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 2., 5., 10.)
+
+
+class CallStats(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = {}  # exception name: count
+        self.total = 0.
+        self.max = 0.
+        self.buckets = np.zeros(len(BUCKETS) + 1, dtype=np.int64)  # last bucket is +Inf
+
+    def quantile(self, q):
+        ''' Upper bound of the bucket containing quantile q, limited by the largest duration seen. '''
+        if self.count == 0:
+            return float('nan')
+        i = np.searchsorted(np.cumsum(self.buckets), q * self.count)
+        return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+
+
+class IOMetrics(object):
+    ''' Thread safe statistics of instrument calls, keyed by driver and method name. '''
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def observe(self, driver, method, duration, error=None):
+        with self._lock:
+            stats = self.calls.get((driver, method))
+            if stats is None:
+                stats = self.calls[(driver, method)] = CallStats()
+            stats.count += 1
+            stats.total += duration
+            stats.max = max(stats.max, duration)
+            stats.buckets[np.searchsorted(BUCKETS, duration)] += 1
+            if error is not None:
+                name = type(error).__name__
+                stats.errors[name] = stats.errors.get(name, 0) + 1
+
+    def prometheus(self):
+        ''' Statistics in the Prometheus text exposition format. '''
+        lines = ['# HELP instrument_call_duration_seconds Duration of instrument driver calls',
+                 '# TYPE instrument_call_duration_seconds histogram']
+        errors = ['# HELP instrument_call_errors_total Failed instrument driver calls',
+                  '# TYPE instrument_call_errors_total counter']
+        with self._lock:
+            for (driver, method), stats in sorted(self.calls.items()):
+                labels = 'driver="{0}",method="{1}"'.format(driver, method)
+                for bound, count in zip(BUCKETS + ('+Inf',), np.cumsum(stats.buckets)):
+                    lines.append('instrument_call_duration_seconds_bucket{{{0},le="{1}"}} {2}'.format(labels, bound, count))
+                lines.append('instrument_call_duration_seconds_sum{{{0}}} {1:.6f}'.format(labels, stats.total))
+                lines.append('instrument_call_duration_seconds_count{{{0}}} {1}'.format(labels, stats.count))
+                for name, count in sorted(stats.errors.items()):
+                    errors.append('instrument_call_errors_total{{{0},error="{1}"}} {2}'.format(labels, name, count))
+        return '\n'.join(lines + errors) + '\n'
+
+    def write(self, filename):
+        ''' Write the Prometheus text format to filename (e.g. for the node exporter textfile collector). '''
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, filename)
+
+    def serve(self, port, host='localhost'):
+        ''' Serve the statistics on http://host:port/metrics from a background thread. '''
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def summary(self):
+        ''' Table of all calls, slowest total time first. '''
+        elapsed = time.time() - self.start_time
+        lines = ['{0:<40} {1:>8} {2:>6} {3:>9} {4:>9} {5:>9} {6:>9} {7:>8} {8:>7}'.format(
+            'call', 'count', 'errors', 'mean[ms]', 'p50[ms]', 'p95[ms]', 'max[ms]', 'calls/s', 'busy')]
+        with self._lock:
+            for (driver, method), stats in sorted(self.calls.items(), key=lambda item: -item[1].total):
+                lines.append('{0:<40} {1:8d} {2:6d} {3:9.1f} {4:9.1f} {5:9.1f} {6:9.1f} {7:8.2f} {8:6.1f}%'.format(
+                    driver + '.' + method, stats.count, sum(stats.errors.values()), stats.total / stats.count * 1e3,
+                    stats.quantile(0.5) * 1e3, stats.quantile(0.95) * 1e3, stats.max * 1e3,
+                    stats.count / elapsed, 100. * stats.total / elapsed))
+        return '\n'.join(lines)
+
+    def log_summary(self, log=None):
+        log = log if log is not None else logging.getLogger()
+        log.info('Instrument I/O statistics:\n' + self.summary())
+
+    def finish(self, filename=None, log=None):
+        ''' End of run: log the summary, write the metrics file and stop serving. '''
+        self.log_summary(log)
+        if filename is not None:
+            self.write(filename)
+        self.close()
+
+
+class InstrumentedDriver(object):
+    ''' Proxy of a driver which times all public method calls. '''
+
+    def __init__(self, name, driver, metrics):
+        self._name = name
+        self._driver = driver
+        self._metrics = metrics
+
+    def __getattr__(self, attr):
+        value = getattr(self._driver, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                ret = value(*args, **kwargs)
+            except Exception as e:
+                self._metrics.observe(self._name, attr, time.perf_counter() - start, error=e)
+                raise
+            self._metrics.observe(self._name, attr, time.perf_counter() - start)
+            return ret
+        return call
+
+
+class InstrumentedDut(object):
+    '''
+    Proxy of a basil Dut whose drivers are wrapped by InstrumentedDriver.
+
+    Parameters
+    ----------
+    dut : basil.dut.Dut
+    metrics : IOMetrics
+    prefix : str
+        Prepended to the driver names, e.g. to tell the setups of one process apart.
+    '''
+
+    def __init__(self, dut, metrics, prefix=''):
+        self._dut = dut
+        self._metrics = metrics
+        self._prefix = prefix
+        self._drivers = {}
+
+    def __getitem__(self, name):
+        if name not in self._drivers:
+            self._drivers[name] = InstrumentedDriver(self._prefix + name, self._dut[name], self._metrics)
+        return self._drivers[name]
+
+    def __getattr__(self, attr):
+        return getattr(self._dut, attr)
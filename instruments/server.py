@@ -0,0 +1,281 @@
+'''
+    Local instrument server which keeps the hardware connections open between runs.
+
+    The server holds a pool of Duts, one per periphery configuration. A Dut is created and initialized when the first
+    client asks for its configuration and then stays open until the server stops, so later scans, cycling runs or
+    monitors skip the connection set-up and the instrument handshakes. Calls to one driver are serialized, calls to
+    different drivers run in parallel.
+
+    Start the server with the periphery files to open right away (optional, others are opened on first use):
+
+    python -m instruments.server sensor_iv/sensor_iv.yaml --port 6011 --metrics-port 9101
+
+    The scripts use the server when their periphery yaml file contains
+
+    server:
+      enabled : True
+      address : localhost:6011
+
+    create_dut then returns a RemoteDut (or a local Dut if no server is running). Only driver methods can be called
+    remotely, arguments and return values are pickled. The simulation block is passed on, so a server can also
+    provide simulated instruments.
+'''
+
+import json
+import time
+import logging
+import argparse
+import threading
+from multiprocessing.connection import Listener, Client
+
+from instruments.io_metrics import IOMetrics, InstrumentedDut
+from instruments.simulation import load_conf, create_dut
+
+DEFAULT_ADDRESS = ('localhost', 6011)
+AUTHKEY = b'module_scripts'  # the server only listens on localhost, the key guards against stray connections
+
+
+def parse_address(address):
+    ''' ('host', port) from 'host:port', port or a tuple. '''
+    if isinstance(address, (tuple, list)):
+        return tuple(address)
+    if isinstance(address, int):
+        return (DEFAULT_ADDRESS[0], address)
+    host, _, port = str(address).rpartition(':')
+    return (host or DEFAULT_ADDRESS[0], int(port))
+
+
+def pool_key(conf):
+    ''' Configurations which only differ in the server block share one Dut. '''
+    conf = dict(conf)
+    conf.pop('server', None)
+    return json.dumps(conf, sort_keys=True, default=str)
+
+
+class DutPool(object):
+    '''
+    Initialized Duts by configuration, with one lock per driver.
+
+    Parameters
+    ----------
+    metrics : IOMetrics
+        Statistics of all driver calls, the driver names are prefixed with the number of the Dut.
+    '''
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics if metrics is not None else IOMetrics()
+        self.numbers = {}  # pool key: number
+        self.duts = []  # (dut, names of the drivers) by number
+        self.locks = {}  # (number, driver): lock
+        self._lock = threading.Lock()
+        self.log = logging.getLogger('DutPool')
+
+    def open(self, conf):
+        ''' Number of the Dut of conf and its driver names, the Dut is created and initialized on first use. '''
+        conf = load_conf(conf)
+        key = pool_key(conf)
+        with self._lock:
+            if key not in self.numbers:
+                number = len(self.duts)
+                server_conf = dict(conf)
+                server_conf.pop('server', None)
+                dut = create_dut(server_conf)
+                dut.init()
+                names = [hw_conf['name'] for hw_conf in server_conf.get('hw_drivers', [])]
+                self.duts.append((InstrumentedDut(dut, self.metrics, prefix='{0}.'.format(number)), names))
+                self.numbers[key] = number
+                for name in names:
+                    self.locks[(number, name)] = threading.Lock()
+                self.log.info('Opened periphery {0} with drivers {1}'.format(number, ', '.join(names)))
+            number = self.numbers[key]
+        return number, self.duts[number][1]
+
+    def call(self, number, driver, method, args=(), kwargs=None):
+        ''' Call method of driver of Dut number, other calls to the same driver wait. '''
+        if method.startswith('_'):
+            raise AttributeError('Private method {0} of {1} can not be called remotely'.format(method, driver))
+        with self.locks[(number, driver)]:
+            return getattr(self.duts[number][0][driver], method)(*args, **(kwargs or {}))
+
+    def close(self):
+        with self._lock:
+            for number, (dut, _) in enumerate(self.duts):
+                try:
+                    dut.close()
+                except Exception as e:
+                    self.log.error('Closing periphery {0} failed: {1}'.format(number, e))
+            self.numbers.clear()
+            del self.duts[:]
+            self.locks.clear()
+
+
+class InstrumentServer(object):
+    '''
+    Serves a DutPool to clients on a local socket, one thread per client connection.
+
+    Requests are tuples (command, *arguments):
+    ('open', conf)                                     -> (number, driver names)
+    ('call', number, driver, method, args, kwargs)     -> return value of the method
+    ('ping',)                                          -> server time
+    Replies are ('ok', value) or ('error', exception).
+    '''
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=AUTHKEY, pool=None):
+        self.pool = pool if pool is not None else DutPool()
+        self.listener = Listener(parse_address(address), authkey=authkey)
+        self.address = self.listener.address
+        self._authkey = authkey
+        self.log = logging.getLogger('InstrumentServer')
+        self._running = False
+
+    def handle(self, conn):
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    break
+                try:
+                    reply = ('ok', self.execute(*request))
+                except Exception as e:
+                    reply = ('error', e)
+                try:
+                    conn.send(reply)
+                except Exception as e:  # e.g. unpicklable return value or exception
+                    conn.send(('error', RuntimeError('{0}: {1!r}'.format(type(e).__name__, reply[1]))))
+        finally:
+            conn.close()
+
+    def execute(self, command, *args):
+        if command == 'call':
+            return self.pool.call(*args)
+        if command == 'open':
+            return self.pool.open(*args)
+        if command == 'ping':
+            return time.time()
+        raise ValueError('Unknown command {0}'.format(command))
+
+    def serve_forever(self):
+        self._running = True
+        self.log.info('Serving instruments on {0}:{1}'.format(*self.address))
+        while self._running:
+            try:
+                conn = self.listener.accept()
+            except Exception as e:  # e.g. failed authentication
+                if not self._running:
+                    break
+                self.log.warning('Rejected connection: {0}'.format(e))
+                continue
+            if not self._running:
+                conn.close()
+                break
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def start(self):
+        ''' Serve from a background thread. '''
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def close(self):
+        if self._running:
+            self._running = False
+            try:  # wake up accept
+                Client(self.address, authkey=self._authkey).close()
+            except OSError:
+                pass
+        self.listener.close()
+        self.pool.close()
+
+
+class RemoteDriver(object):
+    ''' Driver of a RemoteDut, every method call is executed by the server. '''
+
+    def __init__(self, dut, name):
+        self._dut = dut
+        self._name = name
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+
+        def call(*args, **kwargs):
+            return self._dut._request('call', self._dut._number, self._name, attr, args, kwargs)
+        call.__name__ = attr
+        return call
+
+
+class RemoteDut(object):
+    '''
+    Stand-in for basil.dut.Dut using the drivers of an instrument server.
+
+    init() opens the periphery on the server (only the first client really initializes it), close() only closes
+    the connection, the hardware stays open for the next client.
+
+    Parameters
+    ----------
+    conf : dict
+        Periphery configuration.
+    address : str or tuple
+        Address of the server, 'host:port'.
+    '''
+
+    def __init__(self, conf, address=DEFAULT_ADDRESS, authkey=AUTHKEY):
+        self._conf = load_conf(conf)
+        self._conn = Client(parse_address(address), authkey=authkey)
+        self._lock = threading.Lock()  # one request at a time on the connection
+        self._number, self._names = self._request('open', self._conf)
+        self._drivers = {}
+
+    def _request(self, *request):
+        with self._lock:
+            self._conn.send(request)
+            status, value = self._conn.recv()
+        if status == 'error':
+            raise value
+        return value
+
+    def init(self):
+        self._number, self._names = self._request('open', self._conf)
+
+    def close(self):
+        self._conn.close()
+
+    def __getitem__(self, item):
+        if item not in self._names:
+            raise KeyError('Item not existing: %s' % (item,))
+        if item not in self._drivers:
+            self._drivers[item] = RemoteDriver(self, item)
+        return self._drivers[item]
+
+
+def connect(conf, address=None, authkey=AUTHKEY):
+    ''' RemoteDut for conf, None if no server is listening on address (default: from the server block of conf). '''
+    conf = load_conf(conf)
+    if address is None:
+        address = (conf.get('server') or {}).get('address', DEFAULT_ADDRESS)
+    try:
+        return RemoteDut(conf, address, authkey)
+    except ConnectionRefusedError:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep the instruments of periphery yaml files open for the scripts')
+    parser.add_argument('periphery', nargs='*', help='Periphery yaml files to open at start')
+    parser.add_argument('--port', type=int, default=DEFAULT_ADDRESS[1])
+    parser.add_argument('--metrics-port', type=int, default=None, help='Serve the instrument I/O statistics on this port')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)-7s %(message)s', level=logging.INFO)
+    server = InstrumentServer(('localhost', args.port))
+    for periphery in args.periphery:
+        server.pool.open(periphery)
+    if args.metrics_port is not None:
+        server.pool.metrics.serve(args.metrics_port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        server.pool.metrics.finish()
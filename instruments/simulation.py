@@ -0,0 +1,459 @@
+'''
+    Simulated instruments for running the scan and cycling loops without hardware.
+
+    create_dut returns a basil Dut for a periphery yaml file (or a RemoteDut of server.py), unless the file contains a
+    'simulation' block with enabled: True. Then the hardware drivers are replaced by models with the same methods:
+
+    scpi (Keithley 2410)            diode IV curve with avalanche breakdown and current compliance, buffered readings
+    weiss_labevent                  climate chamber air temperature with first-order lag, rate limit and air dryer,
+                                    with a ramp/soak program mode (see thermal_cycling/chamber_program.py)
+    sensirion_ekh4, sensirion_sht85 thermohygrometers following the chamber air with their own lag
+
+    All models share one simulated clock which runs time_scale times faster than the wall clock. Every driver call
+    takes latency s (wall clock) and measured values get a relative gaussian noise.
+
+    simulation:
+      enabled : True
+      time_scale : 1
+      latency : 0.02
+      noise : 0.001
+      drivers :
+        Sourcemeter : {breakdown_voltage : -150}
+'''
+
+import time
+import logging
+import threading
+
+import numpy as np
+import yaml
+
+
+def load_conf(conf):
+    ''' Periphery configuration as dict from a yaml file name, yaml string or dict. '''
+    if isinstance(conf, dict):
+        return dict(conf)
+    if hasattr(conf, 'read'):
+        return yaml.safe_load(conf)
+    try:
+        with open(conf, 'r') as f:
+            return yaml.safe_load(f)
+    except (IOError, OSError):
+        return yaml.safe_load(conf)
+
+
+def create_dut(conf, simulate=None):
+    '''
+    basil Dut for conf, or a SimDut if simulation is enabled in conf. If the server block of conf is enabled and an
+    instrument server is running (see server.py), the Dut is a RemoteDut using the open instruments of the server.
+
+    Parameters
+    ----------
+    conf : str or dict
+        Periphery yaml file (or its content).
+    simulate : bool
+        Overrides the enabled flag of the simulation block of conf.
+    '''
+    conf = load_conf(conf)
+    server_conf = conf.get('server') or {}
+    if server_conf.get('enabled', False):
+        from instruments.server import connect
+
+        if simulate is not None:
+            conf['simulation'] = dict(conf.get('simulation') or {}, enabled=simulate)
+        dut = connect(conf)
+        if dut is not None:
+            return dut
+        logging.warning('No instrument server on {0}, opening the instruments directly'.format(server_conf.get('address')))
+    sim_conf = conf.get('simulation') or {}
+    if simulate is None:
+        simulate = sim_conf.get('enabled', False)
+    if simulate:
+        return SimDut(conf)
+    from basil.dut import Dut
+
+    return Dut(conf)
+
+
+def dew_point_to_humidity(T, dew_point):
+    ''' Relative humidity in % at temperature T of air with the given dew point (Magnus formula). '''
+    return min(100., 100. * np.exp(17.62 * dew_point / (243.12 + dew_point) - 17.62 * T / (243.12 + T)))
+
+
+def humidity_to_dew_point(T, RH):
+    H = np.log(max(RH, 1e-3) / 100.) + 17.62 * T / (243.12 + T)
+    return 243.12 * H / (17.62 - H)
+
+
+class SimEnvironment(object):
+    '''
+    Simulated clock and climate shared by the instruments of one SimDut.
+
+    Without a climate chamber the air stays at ambient temperature and dew point.
+    '''
+
+    def __init__(self, time_scale=1., latency=0., noise=0., ambient_temperature=22., ambient_dew_point=8., seed=None):
+        self.time_scale = time_scale
+        self.latency = latency
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.RLock()
+
+        self._wall_start = time.monotonic()
+        self._time = 0.   # simulated time in s
+        self.ambient_temperature = ambient_temperature
+        self.ambient_dew_point = ambient_dew_point
+        self.air_temperature = ambient_temperature
+        self.air_dew_point = ambient_dew_point
+        self.chamber = None
+        self.sensors = []  # lagged temperatures [tau, value] following the air temperature
+
+    def now(self):
+        return (time.monotonic() - self._wall_start) * self.time_scale
+
+    def sleep(self, seconds):
+        ''' Sleep for the wall clock time corresponding to seconds of simulated time. '''
+        time.sleep(seconds / self.time_scale)
+
+    def call(self):
+        ''' Latency of one instrument call, then bring the simulation up to date. '''
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.advance()
+
+    def measure(self, value, absolute=0., size=None):
+        ''' Value with relative (and absolute) gaussian noise, an array of size values if size is given. '''
+        return value * (1. + self.noise * self.rng.standard_normal(size)) + absolute * self.rng.standard_normal(size)
+
+    def add_sensor(self, tau):
+        sensor = [tau, self.air_temperature]
+        self.sensors.append(sensor)
+        return sensor
+
+    def advance(self):
+        with self.lock:
+            now = self.now()
+            dt_total = now - self._time
+            if dt_total <= 0:
+                return
+            n_steps = int(min(1000, np.ceil(dt_total)))  # steps of max. 1 s
+            dt = dt_total / n_steps
+            for _ in range(n_steps):
+                if self.chamber is not None:
+                    self.chamber.step(dt)
+                for sensor in self.sensors:
+                    sensor[1] += (self.air_temperature - sensor[1]) * (1. - np.exp(-dt / sensor[0]))
+            self._time = now
+
+
+class SimDriver(object):
+    ''' Base of the simulated drivers, conf is the driver entry of the yaml file merged with its simulation parameters. '''
+
+    def __init__(self, env, conf):
+        self.env = env
+        self.name = conf['name']
+        self.conf = conf
+
+    def init(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SimSourcemeter(SimDriver):
+    '''
+    Keithley 2410 sourcing a voltage on a planar sensor: the generation current grows with the depleted volume up to
+    full depletion, then with a small ohmic slope and finally diverges at breakdown (Miller avalanche multiplication).
+    Positive voltages forward bias the diode. The current is limited by the compliance.
+    With a trigger count n, a reading returns n buffered readings taken nplc / line_frequency (+ overhead) s apart.
+    '''
+
+    def __init__(self, env, conf):
+        super(SimSourcemeter, self).__init__(env, conf)
+        self.saturation_current = conf.get('saturation_current', 1e-7)  # reverse current at full depletion in A
+        self.depletion_voltage = conf.get('depletion_voltage', 50.)
+        self.resistance = conf.get('resistance', 5e10)  # parallel resistance in Ohm
+        self.breakdown_voltage = abs(conf.get('breakdown_voltage', 180.))
+        self.miller_exponent = conf.get('miller_exponent', 4.)
+        self.forward_current = conf.get('forward_current', 1e-12)  # diode saturation current in forward direction in A
+        self.voltage = 0.
+        self.current_limit = 1.05e-4
+        self.output = False
+        self.voltage_range = 1000.
+        self.trigger_count = 1
+        self.nplc = 1.
+        self.auto_zero = 'ON'
+        self.line_frequency = conf.get('line_frequency', 50.)
+        self.reading_overhead = conf.get('reading_overhead', 2e-4)  # time per reading in addition to the integration in s
+
+    def current(self, voltage):
+        ''' Noise-free current at voltage, without compliance. '''
+        if voltage > 0:
+            return self.forward_current * np.expm1(min(voltage / 0.05, 500.))
+        v = -voltage
+        generation = self.saturation_current * np.sqrt(min(v / self.depletion_voltage, 1.)) + v / self.resistance
+        multiplication = 1. / max(1. - (v / self.breakdown_voltage) ** self.miller_exponent, 1e-6)
+        return -generation * multiplication
+
+    def _reading(self):
+        self.env.call()
+        n = self.trigger_count
+        reading_time = self.nplc / self.line_frequency + self.reading_overhead
+        if n > 1:
+            self.env.sleep(n * reading_time)
+            self.env.advance()
+        timestamps = self.env.now() - reading_time * np.arange(n - 1, -1, -1)
+        if not self.output:
+            voltage, currents = 0., np.zeros(n)
+        else:
+            voltage = self.voltage
+            currents = self.env.measure(self.current(voltage), absolute=1e-12, size=n)
+            currents = np.clip(currents, -self.current_limit, self.current_limit)  # compliance
+        return ','.join('{0:+.6E},{1:+.6E},+9.910000E+37,{2:+.6E},+4.026000E+04'.format(voltage, current, timestamp)
+                        for current, timestamp in zip(currents, timestamps))
+
+    def source_volt(self):
+        self.env.call()
+
+    def set_voltage_range(self, value):
+        self.env.call()
+        self.voltage_range = float(value)
+
+    def set_voltage(self, value):
+        self.env.call()
+        self.voltage = float(value)
+
+    def set_current_limit(self, value):
+        self.env.call()
+        self.current_limit = float(value)
+
+    def on(self):
+        self.env.call()
+        self.output = True
+
+    def off(self):
+        self.env.call()
+        self.output = False
+
+    def get_on(self):
+        self.env.call()
+        return self.output
+
+    def set_trigger_count(self, value):
+        self.env.call()
+        self.trigger_count = max(1, int(value))
+
+    def set_current_nlpc(self, value):  # spelling of the basil Keithley description
+        self.env.call()
+        self.nplc = float(value)
+
+    def set_auto_zero(self, value):
+        self.env.call()
+        self.auto_zero = value
+
+    def get_voltage(self):
+        return self._reading()
+
+    def get_current(self):
+        return self._reading()
+
+
+class SimClimatechamber(SimDriver):
+    '''
+    Weiss LabEvent: the air temperature approaches the setpoint with time constant tau and a maximal rate.
+    The dew point of the air decreases to dry_dew_point while the air dryer runs, otherwise it approaches the ambient one.
+    A program of (setpoint, ramp, soak) segments runs in simulated time and starts the chamber.
+    '''
+
+    def __init__(self, env, conf):
+        super(SimClimatechamber, self).__init__(env, conf)
+        self.tau = conf.get('tau', 300.)
+        self.max_rate = conf.get('max_rate', 3.) / 60.  # K/min -> K/s
+        self.dry_dew_point = conf.get('dry_dew_point', -60.)
+        self.dry_tau = conf.get('dry_tau', 20 * 60.)
+        self.setpoint = env.ambient_temperature
+        self.running = False
+        self.air_dryer = False
+        self.program = []
+        self.program_running = False
+        self.program_held = False
+        self.program_segment = 0
+        self.program_elapsed = 0.  # time in the current segment
+        self._program_start = None  # setpoint the current segment ramps from
+        env.chamber = self
+
+    def _step_program(self, dt):
+        self.program_elapsed += dt
+        while self.program_running:
+            setpoint, ramp, soak = self.program[self.program_segment]
+            if self.program_elapsed < ramp + soak:
+                break
+            self.program_elapsed -= ramp + soak
+            self._program_start = setpoint
+            self.program_segment += 1
+            self.program_running = self.program_segment < len(self.program)
+        if not self.program_running:
+            self.program_elapsed = 0.
+            self.setpoint = setpoint
+        elif ramp > 0 and self.program_elapsed < ramp:
+            self.setpoint = self._program_start + (setpoint - self._program_start) * self.program_elapsed / ramp
+        else:
+            self.setpoint = setpoint
+
+    def step(self, dt):
+        env = self.env
+        if self.program_running and not self.program_held:
+            self._step_program(dt)
+        target = self.setpoint if self.running else env.ambient_temperature
+        change = (target - env.air_temperature) * (1. - np.exp(-dt / self.tau))
+        env.air_temperature += np.clip(change, -self.max_rate * dt, self.max_rate * dt)
+        dew_point = self.dry_dew_point if self.air_dryer and self.running else env.ambient_dew_point
+        env.air_dew_point += (dew_point - env.air_dew_point) * (1. - np.exp(-dt / self.dry_tau))
+        env.air_dew_point = min(env.air_dew_point, env.air_temperature)  # condensation
+
+    def start_manual_mode(self):
+        self.env.call()
+        self.running = True
+
+    def stop_manual_mode(self):
+        self.env.call()
+        self.running = False
+
+    def get_temperature(self):
+        self.env.call()
+        return round(self.env.measure(self.env.air_temperature, absolute=0.05), 1)
+
+    def set_temperature(self, target):
+        self.env.call()
+        self.setpoint = float(target)
+
+    def get_temperature_setpoint(self):
+        self.env.call()
+        return self.setpoint
+
+    def get_air_dryer(self):
+        self.env.call()
+        return self.air_dryer
+
+    def upload_program(self, segments):
+        self.env.call()
+        self.program_running = False
+        self.program = [tuple(float(v) for v in segment) for segment in segments]
+
+    def start_program(self, segment=0):
+        self.env.call()
+        with self.env.lock:
+            self.program_segment = segment
+            self.program_elapsed = 0.
+            self._program_start = self.setpoint
+            self.program_running = segment < len(self.program)
+            self.program_held = False
+            self.running = True
+            if self.program_running:
+                self._step_program(0.)
+
+    def stop_program(self):
+        self.env.call()
+        self.program_running = False
+
+    def hold_program(self, hold):
+        self.env.call()
+        with self.env.lock:
+            self.program_held = bool(hold)
+            if self.program_running and not hold:
+                self._step_program(0.)  # restore the program setpoint
+
+    def get_program_status(self):
+        self.env.call()
+        return {'running': self.program_running, 'held': self.program_held, 'segment': self.program_segment,
+                'elapsed': self.program_elapsed}
+
+    def set_air_dryer(self, value):
+        self.env.call()
+        self.air_dryer = bool(value)
+
+
+class SimThermohygrometer(SimDriver):
+    '''
+    Sensirion EKH4 (with channels) or SHT85: every channel is a temperature sensor following the chamber air with time
+    constant tau, humidity and dew point are calculated from the air dew point at the sensor temperature.
+    '''
+
+    def __init__(self, env, conf):
+        super(SimThermohygrometer, self).__init__(env, conf)
+        self.tau = conf.get('tau', 120.)
+        self.channels = {}
+
+    def _sensor(self, channel):
+        if channel not in self.channels:
+            with self.env.lock:
+                self.channels[channel] = self.env.add_sensor(self.tau)
+        return self.channels[channel]
+
+    def _temperature(self, channel):
+        self.env.call()
+        return self._sensor(channel)[1]
+
+    def get_temperature(self, channel=None):
+        return round(self.env.measure(self._temperature(channel), absolute=0.02), 2)
+
+    def get_humidity(self, channel=None):
+        humidity = dew_point_to_humidity(self._temperature(channel), self.env.air_dew_point)
+        return round(min(100., self.env.measure(humidity, absolute=0.1)), 2)
+
+    def get_dew_point(self, channel=None):
+        T = self._temperature(channel)
+        return round(humidity_to_dew_point(T, dew_point_to_humidity(T, self.env.air_dew_point)), 2)
+
+    def get_temperature_and_humidity(self):
+        return self.get_temperature(), self.get_humidity()
+
+
+# basil hardware driver type -> model
+DRIVERS = {
+    'scpi': SimSourcemeter,
+    'weiss_labevent': SimClimatechamber,
+    'sensirion_ekh4': SimThermohygrometer,
+    'sensirion_sht85': SimThermohygrometer,
+}
+
+
+class SimDut(object):
+    '''
+    Replacement of basil.dut.Dut with simulated hardware drivers. Transfer layers are not opened.
+
+    Parameters
+    ----------
+    conf : dict
+        Periphery configuration, the simulation block holds the parameters of SimEnvironment and per driver
+        parameters of the models under drivers.
+    '''
+
+    def __init__(self, conf):
+        self._conf = conf
+        sim_conf = dict(conf.get('simulation') or {})
+        driver_confs = sim_conf.pop('drivers', None) or {}
+        sim_conf.pop('enabled', None)
+        self.env = SimEnvironment(**sim_conf)
+
+        self._hardware_layer = {}
+        # Chamber first, the sensors start at its air temperature
+        for hw_conf in sorted(conf.get('hw_drivers', []), key=lambda c: c['type'] != 'weiss_labevent'):
+            if hw_conf['type'] not in DRIVERS:
+                raise ValueError('No simulation for driver {0} of type {1}'.format(hw_conf['name'], hw_conf['type']))
+            driver_conf = dict(hw_conf.get('init') or {}, name=hw_conf['name'], **driver_confs.get(hw_conf['name'], {}))
+            self._hardware_layer[hw_conf['name']] = DRIVERS[hw_conf['type']](self.env, driver_conf)
+
+    def init(self):
+        for driver in self._hardware_layer.values():
+            driver.init()
+
+    def close(self):
+        for driver in self._hardware_layer.values():
+            driver.close()
+
+    def __getitem__(self, item):
+        if item in self._hardware_layer:
+            return self._hardware_layer[item]
+        raise KeyError('Item not existing: %s' % (item,))
@@ -1,24 +1,20 @@
 import os
 import csv
-import xlrd
+import json
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
-# This import registers the 3D projection, but is otherwise unused.
-from mpl_toolkits.mplot3d import Axes3D  # noqa: F401 unused import
-
-import matplotlib.pyplot as plt
-from matplotlib import cm
-from matplotlib.ticker import LinearLocator, FormatStrFormatter
-from matplotlib.backends.backend_pdf import PdfPages
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-import matplotlib.ticker as tkr
+# xlrd and matplotlib are imported where they are used, reading the data does not need them
 
 in_file = ''
 module_name = 'ASD 15-3-C4'
 method = 'Mitutoyo Measuring Microscope'
 # method = 'ZW RFM'
 origin = 'top left'
+# Flatness is also evaluated per region: name -> (rows, columns) the measurement grid is split into
+regions = {'front-end chip': (2, 2)}  # e.g. {'front-end chip': (2, 2), 'sensor half': (1, 2)}, {} for single chip modules
+
+REGION_DTYPE = [('row', 'i4'), ('col', 'i4'), ('x', 'f8'), ('y', 'f8'), ('deviation', 'f8'), ('ptp', 'f8'), ('rms', 'f8'), ('tilt', 'f8')]
 
 
 def um_to_mm(x, pos):
@@ -86,6 +82,8 @@ def get_data(infile):
         Z = Z.T
 
     elif infile.split('.')[-1] == 'xlsx':
+        import xlrd
+
         workbook = xlrd.open_workbook(infile)
         worksheet = workbook.sheet_by_index(0)
 
@@ -158,7 +156,89 @@ def get_maximum_bow(X, Y, Z):
     return max_bow, fit
 
 
-def plot_title_page(X, Y, Z, pdf, max_bow, envelope):
+def split_regions(A, grid):
+    '''
+    (rows, cols, ny, nx) view of the 2D array A split into grid = (rows, cols) regions, no data is copied.
+    If the grid does not divide the number of points, neighbouring regions share the points at their boundary.
+    '''
+    (n_y, n_x), (rows, cols) = A.shape, grid
+    step_y, step_x = n_y // rows, n_x // cols
+    if step_y == 0 or step_x == 0:
+        raise ValueError('Grid of {0} x {1} points can not be split into {2} x {3} regions'.format(n_y, n_x, rows, cols))
+    window = (n_y - (rows - 1) * step_y, n_x - (cols - 1) * step_x)
+    return sliding_window_view(A, window)[::step_y, ::step_x]
+
+
+def _fit_planes(x, y, z):
+    ''' Least squares planes z = a * x + b * y + c through the points of the last two axes, NaN are ignored. '''
+    valid = ~np.isnan(z)
+    n = np.count_nonzero(valid, axis=(-2, -1))
+    mean_x, mean_y = [np.sum(np.where(valid, v, 0), axis=(-2, -1)) / n for v in (x, y)]
+    mean_z = np.nansum(z, axis=(-2, -1)) / n
+    dx, dy = x - mean_x[..., None, None], y - mean_y[..., None, None]
+    dz = np.where(valid, z - mean_z[..., None, None], 0)
+    dx, dy = np.where(valid, dx, 0), np.where(valid, dy, 0)
+    s_xx, s_yy, s_xy = np.sum(dx * dx, axis=(-2, -1)), np.sum(dy * dy, axis=(-2, -1)), np.sum(dx * dy, axis=(-2, -1))
+    s_xz, s_yz = np.sum(dx * dz, axis=(-2, -1)), np.sum(dy * dz, axis=(-2, -1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = s_xx * s_yy - s_xy ** 2
+        a = (s_xz * s_yy - s_yz * s_xy) / det
+        b = (s_yz * s_xx - s_xz * s_xy) / det
+    return a, b, mean_z - a * mean_x - b * mean_y
+
+
+def get_region_flatness(X, Y, Z, grid):
+    '''
+    Flatness of every region of a (rows, cols) grid over the module, all regions in one pass over views of the data.
+
+    deviation  largest distance of a point to the plane through the region corners. This is not the bow of
+               get_maximum_bow, which compares the highest point to the intercept of the corner plane.
+    ptp        peak to peak height
+    rms        RMS of the distances to the least squares plane of the region
+    tilt       angle of the least squares plane in mrad
+
+    Returns a structured array (REGION_DTYPE) with one entry per region, x and y are the region centers.
+    '''
+    X, Y, Z = (np.asarray(A, dtype=float) for A in (X, Y, Z))
+    if not X.shape == Y.shape == Z.shape:
+        raise ValueError('X, Y and Z need the same shape')
+    x, y, z = (split_regions(A, grid) for A in (X, Y, Z))
+
+    result = np.zeros(grid, dtype=REGION_DTYPE)
+    result['row'], result['col'] = np.indices(grid)
+    result['x'], result['y'] = np.mean(x, axis=(-2, -1)), np.mean(y, axis=(-2, -1))
+    result['ptp'] = np.nanmax(z, axis=(-2, -1)) - np.nanmin(z, axis=(-2, -1))
+
+    a, b, c = _fit_planes(x, y, z)
+    residuals = z - (a[..., None, None] * x + b[..., None, None] * y + c[..., None, None])
+    result['rms'] = np.sqrt(np.nanmean(residuals ** 2, axis=(-2, -1)))
+    result['tilt'] = np.arctan(np.hypot(a, b)) * 1e3
+
+    corners = (slice(None), slice(None), [[0], [-1]], [0, -1])  # 2 x 2 corner points of every region
+    a, b, c = _fit_planes(x[corners], y[corners], z[corners])
+    result['deviation'] = np.nanmax(np.abs(z - (a[..., None, None] * x + b[..., None, None] * y + c[..., None, None])), axis=(-2, -1))
+    return result.ravel()
+
+
+def get_flatness(X, Y, Z, regions=regions):
+    ''' get_region_flatness for every region set that fits the measurement grid, by name. '''
+    flatness = {}
+    for name, grid in regions.items():
+        try:
+            flatness[name] = get_region_flatness(X, Y, Z, grid)
+        except ValueError as e:
+            print('No flatness per {0}: {1}'.format(name, e))
+            continue
+        for r in flatness[name]:
+            print('{0} {1}-{2}: deviation {3:1.2f}, PTP {4:1.2f}, RMS {5:1.2f}, tilt {6:1.3f} mrad'.format(
+                name.capitalize(), r['row'], r['col'], r['deviation'], r['ptp'], r['rms'], r['tilt']))
+    return flatness
+
+
+def plot_title_page(X, Y, Z, pdf, max_bow, envelope, flatness={}):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
     fig = Figure()
     FigureCanvas(fig)
     ax = fig.add_subplot(111)
@@ -173,6 +253,9 @@ def plot_title_page(X, Y, Z, pdf, max_bow, envelope):
     text = 'Origin is {}.'.format(origin)
     ax.text(0.01, 0.6, text)
     text = 'Max bow is {0:1.2f}$\mu$m'.format(max_bow)
+    for name, result in flatness.items():
+        worst = result[np.nanargmax(result['deviation'])]
+        text += ', deviation per {0} up to {1:1.2f}$\mu$m ({2}-{3})'.format(name, worst['deviation'], worst['row'], worst['col'])
     ax.text(0.01, 0.5, text)
 
     if len(envelope) > 0:
@@ -190,6 +273,10 @@ def plot_title_page(X, Y, Z, pdf, max_bow, envelope):
 
 
 def plot_surface(X, Y, Z, pdf, plane_fit=None, projections=True, live=True, colorbar=False):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as tkr
+    from mpl_toolkits.mplot3d import Axes3D  # noqa: F401 registers the 3D projection
+
     fig = plt.figure(figsize=plt.figaspect(0.5))
     ax = plt.axes(projection='3d')
 
@@ -237,6 +324,10 @@ def plot_surface(X, Y, Z, pdf, plane_fit=None, projections=True, live=True, colo
 
 
 def plot_wireframe(X, Y, Z, pdf, projections=True):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as tkr
+    from mpl_toolkits.mplot3d import Axes3D  # noqa: F401 registers the 3D projection
+
     # Plotting
     fig = plt.figure(figsize=plt.figaspect(0.5))
     ax = plt.axes(projection='3d')
@@ -266,6 +357,9 @@ def plot_wireframe(X, Y, Z, pdf, projections=True):
 
 
 def plot_contour(X, Y, Z, pdf):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as tkr
+
     # Plotting
     fig = plt.figure()
     ax = plt.axes()
@@ -290,14 +384,64 @@ def plot_contour(X, Y, Z, pdf):
     pdf.savefig(fig)
 
 
-if __name__ == '__main__':
+def write_summary(filename, in_file, max_bow, fit, envelope, flatness={}):
+    ''' Results of the measurement as json, the module QC dossiers (qc_dossier/build_dossiers.py) are built from them. '''
+    def values(array):
+        return [None if np.isnan(v) else v.item() for v in array]
+
+    summary = {'module_name': module_name, 'method': method, 'origin': origin, 'input': os.path.abspath(in_file),
+               'max_bow': float(max_bow), 'plane_fit': [fit.item(i) for i in range(3)],
+               'envelope': {key: values(value) for key, value in envelope.items()},
+               'regions': {name: [dict(zip(result.dtype.names, values(r))) for r in result] for name, result in flatness.items()}}
+    with open(filename, 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def plot_regions(X, Y, Z, pdf, name, grid, flatness):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+    fig = Figure()
+    FigureCanvas(fig)
+    ax = fig.add_subplot(111)
+    cs = ax.contourf(Y, X, Z, cmap='coolwarm', alpha=0.5)
+    fig.colorbar(cs, shrink=0.75, orientation='horizontal').set_label(r'z [$\mu$m]')
+    for r in flatness:
+        ax.text(r['y'], r['x'], 'dev {0:1.1f}\nPTP {1:1.1f}\nRMS {2:1.1f}\ntilt {3:1.2f}'.format(r['deviation'], r['ptp'], r['rms'], r['tilt']),
+                fontsize=7, horizontalalignment='center', verticalalignment='center')
+    x, y = split_regions(np.asarray(X), grid), split_regions(np.asarray(Y), grid)
+    for row in range(grid[0]):
+        for col in range(grid[1]):
+            (x_min, x_max), (y_min, y_max) = (np.min(x[row, col]), np.max(x[row, col])), (np.min(y[row, col]), np.max(y[row, col]))
+            ax.plot([y_min, y_max, y_max, y_min, y_min], [x_min, x_min, x_max, x_max, x_min], color='grey', linewidth=0.8)
+    ax.invert_yaxis()
+    ax.set_xlabel(r'y [$\mu$m]')
+    ax.set_ylabel(r'x [$\mu$m]')
+    ax.set_title('{0}: flatness per {1} [$\mu$m]'.format(module_name, name))
+    pdf.savefig(fig)
+
+
+def create_report(in_file, live=True):
+    ''' Read the measurement in_file and plot it to a pdf next to it, the results are written to a json file next to it. '''
+    from matplotlib.backends.backend_pdf import PdfPages
+
     X, Y, Z, envelope = get_data(in_file)
     max_bow, fit = get_maximum_bow(X, Y, Z)
+    flatness = get_flatness(X, Y, Z)
 
-    pdf = PdfPages(os.path.join(os.path.dirname(in_file), '_'.join(os.path.split(in_file)[-1].split('.')[0:-1]) + '.pdf'))
-    plot_title_page(X, Y, Z, pdf, max_bow=max_bow, envelope=envelope)
-    plot_surface(X, Y, Z, pdf, plane_fit=fit, live=True)
+    out_file = os.path.join(os.path.dirname(in_file), '_'.join(os.path.split(in_file)[-1].split('.')[0:-1]))
+    write_summary(out_file + '_metrology.json', in_file, max_bow, fit, envelope, flatness)
+    pdf = PdfPages(out_file + '.pdf')
+    plot_title_page(X, Y, Z, pdf, max_bow=max_bow, envelope=envelope, flatness=flatness)
+    plot_surface(X, Y, Z, pdf, plane_fit=fit, live=live)
     plot_wireframe(X, Y, Z, pdf)
     plot_contour(X, Y, Z, pdf)
+    for name, result in flatness.items():
+        plot_regions(X, Y, Z, pdf, name, regions[name], result)
 
     pdf.close()
+
+
+if __name__ == '__main__':
+    create_report(in_file)
@@ -0,0 +1,377 @@
+'''
+    QC dossier per module: one pdf joining the IV scans, metrology results and thermal cycling runs of the module.
+
+    The outputs of the tools are indexed by module name:
+
+    IV scans          *.h5 of scan_sensor_iv.py, module from the run configuration (run_config module)
+    metrology         *_metrology.json written by plot_metrology.create_report (module_name)
+    thermal cycling   *_temps.dat of run_thermocycling_QC.py with a '#Modules:' header line (modules of the runner)
+
+    The module names per input file and a fingerprint of the inputs of every dossier are kept in the index file.
+    Only new or changed input files are read again and only dossiers whose inputs changed are rebuilt, in worker
+    processes, so a nightly run over a whole production batch only costs the modules which were measured that day.
+
+    python build_dossiers.py --workers 8
+'''
+
+import os
+import sys
+import json
+import hashlib
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+# tables and matplotlib are imported by the workers, indexing only needs them for new IV scans
+
+FILEPATH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(FILEPATH)
+for folder in ('sensor_iv', 'metrology', 'thermal_cycling'):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+from scan_sensor_iv import ConfigDict  # noqa: E402
+from thermocycling_data import load_temps  # noqa: E402
+
+IV_DIRS = [os.path.join(ROOT, 'sensor_iv', 'output_data')]
+METROLOGY_DIRS = [os.path.join(ROOT, 'metrology')]
+THERMOCYCLING_DIRS = [os.path.join(ROOT, 'thermal_cycling', 'output_data')]
+OUTPUT_DIR = os.path.join(FILEPATH, 'output_data')
+INDEX_FILE = 'dossier_index.json'  # in OUTPUT_DIR
+WORKERS = None  # processes building dossiers, number of CPUs if None
+VERSION = 4  # increase when the dossier layout changes, all dossiers are rebuilt then
+
+# kind: file name ending
+KINDS = {'iv': '.h5', 'metrology': '_metrology.json', 'thermocycling': '_temps.dat'}
+
+
+def find_inputs(iv_dirs=IV_DIRS, metrology_dirs=METROLOGY_DIRS, thermocycling_dirs=THERMOCYCLING_DIRS):
+    ''' Kind of all input files below the directories by path. '''
+    inputs = {}
+    for kind, dirs in (('iv', iv_dirs), ('metrology', metrology_dirs), ('thermocycling', thermocycling_dirs)):
+        for directory in dirs:
+            for path, _, files in os.walk(directory):
+                for name in files:
+                    if name.endswith(KINDS[kind]):
+                        inputs[os.path.abspath(os.path.join(path, name))] = kind
+    return inputs
+
+
+def read_modules(kind, filename):
+    ''' Names of the modules measured in an input file. '''
+    if kind == 'iv':
+        import tables as tb
+
+        with tb.open_file(filename, 'r') as f:
+            module = ConfigDict(f.root.configuration.run_config[:]).get('module')
+        return [str(module)] if module is not None else []
+    if kind == 'metrology':
+        with open(filename, 'r') as f:
+            module = json.load(f).get('module_name')
+        return [module] if module else []
+    with open(filename, 'r') as f:
+        for _, line in zip(range(2), f):
+            if line.startswith('#Modules:'):
+                return [m.strip() for m in line[len('#Modules:'):].split(',') if m.strip()]
+    return []
+
+
+def load_index(filename):
+    if os.path.isfile(filename):
+        with open(filename, 'r') as f:
+            return json.load(f)
+    return {'files': {}, 'dossiers': {}}
+
+
+def save_index(filename, index):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp, filename)
+
+
+def update_index(index, inputs, log=logging.root):
+    ''' Read the module names of new and changed files, forget removed ones. Returns the number of files read. '''
+    files, n_read = {}, 0
+    for path, kind in inputs.items():
+        stat = os.stat(path)
+        entry = index['files'].get(path)
+        if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            try:
+                modules = read_modules(kind, path)
+            except Exception as e:  # e.g. file which is still being written
+                log.warning('Could not read {0}: {1}'.format(path, e))
+                continue
+            entry = {'kind': kind, 'mtime': stat.st_mtime, 'size': stat.st_size, 'modules': modules}
+            n_read += 1
+        files[path] = entry
+    index['files'] = files
+    return n_read
+
+
+def module_inputs(index):
+    ''' Sorted (kind, path) of the input files by module. '''
+    modules = {}
+    for path, entry in index['files'].items():
+        for module in entry['modules']:
+            modules.setdefault(module, []).append((entry['kind'], path))
+    return {module: sorted(inputs) for module, inputs in modules.items()}
+
+
+def fingerprint(index, inputs):
+    ''' Changes when an input file is added, removed or changed. '''
+    state = [VERSION] + [(kind, path, index['files'][path]['mtime'], index['files'][path]['size']) for kind, path in inputs]
+    return hashlib.sha1(json.dumps(state).encode()).hexdigest()
+
+
+def dossier_file(output_dir, module):
+    return os.path.join(output_dir, ''.join(c if c.isalnum() or c in '-_.' else '_' for c in module) + '_dossier.pdf')
+
+
+def _extremum(f, values):
+    ''' f (e.g. np.min) of the values, None if there is no valid value. '''
+    values = values[~np.isnan(values)]
+    return float(f(values)) if len(values) else None
+
+
+def _iv_page(pdf, scans):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+    fig = Figure()
+    FigureCanvas(fig)
+    ax = fig.add_subplot(111)
+    for scan in scans:
+        ax.errorbar(scan['voltage'], np.abs(scan['current']), yerr=scan['current_error'], linestyle='none', marker='.', label=scan['run_name'])
+    ax.set_title('Sensor IV curves')
+    ax.set_xlabel('Bias voltage [V]')
+    ax.set_ylabel('Leakage current [A]')
+    ax.set_yscale('log')
+    if all(np.mean(scan['voltage']) < 0 for scan in scans if len(scan['voltage'])):
+        ax.invert_xaxis()
+    ax.grid()
+    ax.legend(fontsize=6)
+    pdf.savefig(fig)
+
+
+def _stability_page(pdf, runs):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+    fig = Figure()
+    FigureCanvas(fig)
+    ax = fig.add_subplot(111)
+    for run_name, stats in runs:
+        hours = (stats['start'] - stats['start'][0]) / 3600.
+        mean = np.abs(stats['mean'])
+        ax.plot(hours, mean, label=run_name)
+        ax.fill_between(hours, mean - stats['std'], mean + stats['std'], alpha=0.3)
+    ax.set_title('Leakage current stability')
+    ax.set_xlabel('Time [h]')
+    ax.set_ylabel('Leakage current [A]')
+    ax.grid()
+    ax.legend(fontsize=6)
+    pdf.savefig(fig)
+
+
+def _metrology_page(pdf, summary):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+    import plot_metrology
+
+    fig = Figure()
+    FigureCanvas(fig)
+    ax = fig.add_subplot(111)
+    if os.path.isfile(summary['input']):
+        X, Y, Z, _ = plot_metrology.get_data(summary['input'])
+        cs = ax.contour(Y, X, Z)
+        ax.clabel(cs, inline=1, fontsize=8)
+        ax.invert_yaxis()
+        ax.set_xlabel(r'y [$\mu$m]')
+        ax.set_ylabel(r'x [$\mu$m]')
+    else:
+        ax.axis('off')
+        ax.text(0.01, 0.5, 'Measurement file {0} not available'.format(summary['input']), fontsize=8)
+    ax.set_title('Metrology ({0}), max. bow {1:1.1f}$\\mu$m'.format(summary['method'], summary['max_bow']))
+    pdf.savefig(fig)
+
+
+def _thermocycling_page(pdf, filename, data):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+    fig = Figure()
+    FigureCanvas(fig)
+    ax = fig.add_subplot(111)
+    hours = (data['timestamp'] - data['timestamp'][0]) / 3600.
+    step = max(1, len(data) // 5000)  # the page does not need every sample of a long run
+    for name in ('t_setp', 't_mod', 't_mod2', 'dew_point'):
+        if name in data.dtype.names:
+            ax.plot(hours[::step], data[name][::step], label=name, linewidth=0.8)
+    ax.set_title('Thermal cycling {0}'.format(os.path.basename(filename)), fontsize=9)
+    ax.set_xlabel('Time [h]')
+    ax.set_ylabel('Temperature [°C]')
+    ax.grid()
+    ax.legend(fontsize=6)
+    pdf.savefig(fig)
+
+
+def _title_page(pdf, module, lines):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+    fig = Figure()
+    FigureCanvas(fig)
+    ax = fig.add_subplot(111)
+    ax.axis('off')
+    ax.text(0.01, 0.95, 'QC dossier of module', fontsize=10)
+    ax.text(0.3, 0.88, module, fontsize=12)
+    ax.text(0.01, 0.8, '\n'.join(lines), fontsize=7, verticalalignment='top', family='monospace')
+    pdf.savefig(fig)
+
+
+def build_dossier(module, inputs, output_file):
+    '''
+    Write the dossier pdf of module from its inputs ((kind, path) tuples) and a json file with the summary next to it.
+    Runs in a worker process, returns the summary.
+    '''
+    import tables as tb
+    from matplotlib.backends.backend_pdf import PdfPages
+    import analyze_cycles
+
+    summary = {'module': module, 'iv': [], 'stability': [], 'metrology': [], 'thermocycling': []}
+    scans, stability, metrology, runs = [], [], [], []
+    for kind, path in inputs:
+        if kind == 'iv':
+            with tb.open_file(path, 'r') as f:
+                run_config = ConfigDict(f.root.configuration.run_config[:])
+                run_name = run_config.get('run_name', os.path.basename(path))
+                if 'statistics' in f.root:  # current vs. time of SensorStabilityScan, only the statistics are read
+                    stats = f.root.statistics[:]
+                    voltage = ConfigDict(f.root.configuration.scan_config[:]).get('VBIAS')
+                    if len(stats):
+                        stability.append((run_name, stats))
+                        n = np.sum(stats['n'])
+                        summary['stability'].append({'file': path, 'run_name': run_name, 'voltage': voltage, 'readings': int(n),
+                                                     'hours': float(stats['stop'][-1] - stats['start'][0]) / 3600.,
+                                                     'mean': float(np.sum(stats['n'] * stats['mean']) / n),
+                                                     'max_std': float(np.max(stats['std']))})
+                    continue
+                data = f.root.raw_data[:]
+            scans.append({'run_name': run_name, 'voltage': data['voltage'],
+                          'current': data['current'], 'current_error': data['current_error']})
+            i_max = np.argmax(np.abs(data['voltage'])) if len(data) else None
+            summary['iv'].append({'file': path, 'run_name': scans[-1]['run_name'], 'points': len(data),
+                                  'max_voltage': float(data['voltage'][i_max]) if i_max is not None else None,
+                                  'current_at_max_voltage': float(data['current'][i_max]) if i_max is not None else None})
+        elif kind == 'metrology':
+            with open(path, 'r') as f:
+                metrology.append(json.load(f))
+            summary['metrology'].append({'file': path, 'method': metrology[-1]['method'], 'max_bow': metrology[-1]['max_bow'],
+                                         'regions': metrology[-1].get('regions', {})})
+        else:
+            data = load_temps(path)
+            if len(data) == 0:
+                continue
+            runs.append((path, data))
+            entry = {'file': path, 'start': float(data['timestamp'][0]), 'hours': float(data['timestamp'][-1] - data['timestamp'][0]) / 3600.}
+            if analyze_cycles.t_sens in data.dtype.names and 't_setp' in data.dtype.names:
+                ramps = analyze_cycles.analyze(data)
+                entry.update(ramps=len(ramps), max_overshoot=_extremum(np.max, ramps['overshoot']),
+                             min_dp_margin=_extremum(np.min, ramps['dp_margin']))
+            summary['thermocycling'].append(entry)
+
+    lines = []
+    for scan in summary['iv']:
+        current = scan['current_at_max_voltage']
+        lines.append('IV {0:<30} {1:4d} points, I({2} V) = {3}'.format(scan['run_name'], scan['points'], scan['max_voltage'],
+                                                                     '{0:1.2e} A'.format(current) if current is not None else '-'))
+    for run in summary['stability']:
+        lines.append('IV {0:<30} {1:5.1f} h at {2} V, I = {3:1.2e} A, max. std {4:1.1e} A'.format(
+            run['run_name'], run['hours'], run['voltage'], run['mean'], run['max_std']))
+    for result in summary['metrology']:
+        lines.append('Metrology {0:<23} max. bow {1:1.1f} um'.format(result['method'][:23], result['max_bow']))
+        for name, regions in result['regions'].items():
+            deviations = [r['deviation'] for r in regions if r.get('deviation') is not None]
+            if deviations:
+                lines.append('          per {0:<19} max. deviation {1:1.1f} um'.format(name[:19], max(deviations)))
+    for run in summary['thermocycling']:
+        lines.append('Thermal cycling {0:<17} {1:5.1f} h, {2} ramps, min. dew point margin {3}'.format(
+            os.path.basename(run['file'])[:15], run['hours'], run.get('ramps', '-'),
+            '{0:1.1f} C'.format(run['min_dp_margin']) if run.get('min_dp_margin') is not None else '-'))
+
+    tmp = output_file + '.tmp'
+    with PdfPages(tmp) as pdf:
+        _title_page(pdf, module, lines)
+        if scans:
+            _iv_page(pdf, scans)
+        if stability:
+            _stability_page(pdf, stability)
+        for result in metrology:
+            _metrology_page(pdf, result)
+        for path, data in runs:
+            _thermocycling_page(pdf, path, data)
+    os.replace(tmp, output_file)  # an interrupted build does not leave a broken dossier
+    with open(output_file[:-4] + '.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def build_dossiers(iv_dirs=IV_DIRS, metrology_dirs=METROLOGY_DIRS, thermocycling_dirs=THERMOCYCLING_DIRS, output_dir=OUTPUT_DIR,
+                   workers=WORKERS, force=False, log=logging.root):
+    '''
+    Update the index and rebuild the dossiers whose inputs changed (all with force).
+    Returns the numbers of built, failed and up to date dossiers.
+    '''
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    index_file = os.path.join(output_dir, INDEX_FILE)
+    index = load_index(index_file)
+    n_read = update_index(index, find_inputs(iv_dirs, metrology_dirs, thermocycling_dirs), log)
+    modules = module_inputs(index)
+    log.info('Indexed {0} files ({1} new or changed) of {2} modules'.format(len(index['files']), n_read, len(modules)))
+
+    stale = {}
+    for module, inputs in modules.items():
+        key = fingerprint(index, inputs)
+        if force or index['dossiers'].get(module) != key or not os.path.isfile(dossier_file(output_dir, module)):
+            stale[module] = key
+    save_index(index_file, index)
+    if not stale:
+        return 0, 0, len(modules)
+
+    built, failed = 0, 0
+    # Workers are spawned, matplotlib and tables are not forked in an unknown state
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {pool.submit(build_dossier, module, modules[module], dossier_file(output_dir, module)): module for module in sorted(stale)}
+        for future in as_completed(futures):
+            module = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                log.error('Dossier of {0} failed: {1}'.format(module, e))
+                continue
+            built += 1
+            index['dossiers'][module] = stale[module]
+            save_index(index_file, index)  # finished dossiers are kept if the run is interrupted
+            log.info('Built dossier of {0} ({1}/{2})'.format(module, built + failed, len(stale)))
+    return built, failed, len(modules) - len(stale)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the QC dossiers of all modules with new or changed results')
+    parser.add_argument('--iv', nargs='+', default=IV_DIRS, help='Folders with IV scans')
+    parser.add_argument('--metrology', nargs='+', default=METROLOGY_DIRS, help='Folders with metrology results')
+    parser.add_argument('--thermocycling', nargs='+', default=THERMOCYCLING_DIRS, help='Folders with thermal cycling data')
+    parser.add_argument('-o', '--output', default=OUTPUT_DIR, help='Folder of the dossiers and the index')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--force', action='store_true', help='Rebuild all dossiers')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)-7s %(message)s', level=logging.INFO)
+    built, failed, up_to_date = build_dossiers(args.iv, args.metrology, args.thermocycling, args.output, args.workers, args.force)
+    logging.info('{0} dossiers built, {1} failed, {2} up to date'.format(built, failed, up_to_date))
+    sys.exit(1 if failed else 0)
@@ -8,6 +8,9 @@
 '''
     This basic scan records an IV curve of the sensor of a module
     while making sure the chip is powered and configured.
+
+    SensorStabilityScan holds one bias voltage and records the leakage current over time (e.g. for hours) with
+    buffered readings of the sourcemeter.
 '''
 
 import os
@@ -16,16 +19,16 @@ import time
 import yaml
 import logging
 import numpy as np
-import tables as tb
-from tqdm import tqdm
 
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+# tables, tqdm and matplotlib are imported where they are used, so the module loads fast (e.g. for a config check)
 
-from basil.dut import Dut
+import _paths  # noqa: F401 (shared instrument code in the repository root)
+from instruments.io_metrics import IOMetrics, InstrumentedDut
+from instruments.simulation import create_dut
 
 
 OUTPUT_DIR = 'output_data'
+IO_METRICS_PORT = None  # Serve instrument I/O statistics (Prometheus text format) on this local port during the scan
 
 scan_configuration = {
     'module_name': 'FBK 6092-27',
@@ -38,16 +41,24 @@ scan_configuration = {
     'samples': 5
 }
 
+stability_configuration = dict(scan_configuration, **{
+    'VBIAS': -100,          # bias voltage which is held
+    'duration': 4 * 60 * 60,  # in s
+    'buffer_size': 1000,    # readings per buffered acquisition (trigger count, max. 2500)
+    'nplc': 0.01,           # integration time in power line cycles, 0.01 is the fastest of the Keithley 2410
+    'stats_window': 60,     # time span of one entry of the rolling statistics in s
+})
 
-class RawDataTable(tb.IsDescription):
-    voltage = tb.Int32Col(pos=1)
-    current = tb.Float64Col(pos=2)
-    current_error = tb.Float64Col(pos=3)
+# Commands missing in the basil Keithley 2410 description (NPLC is set with its set_current_nlpc)
+BUFFER_COMMANDS = {'set_trigger_count': 'TRIG:COUN', 'set_auto_zero': 'SYST:AZER'}
+# Instrument defaults restored after a stability scan, the other scans and later runs on a shared instrument rely on them
+BUFFER_RESET = (('set_trigger_count', 1), ('set_current_nlpc', 1), ('set_auto_zero', 'ON'))
 
 
-class RunConfigTable(tb.IsDescription):
-    attribute = tb.StringCol(64)
-    value = tb.StringCol(512)
+RawDataTable = np.dtype([('voltage', np.int32), ('current', np.float64), ('current_error', np.float64)])
+RunConfigTable = np.dtype([('attribute', 'S64'), ('value', 'S512')])
+StatisticsTable = np.dtype([('start', np.float64), ('stop', np.float64), ('n', np.int64), ('mean', np.float64), ('std', np.float64),
+                            ('min', np.float64), ('max', np.float64), ('drift', np.float64)])
 
 
 class ConfigDict(dict):
@@ -89,10 +100,15 @@ class SensorIVScan(object):
 
         if device_config is None:
             device_config = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'sensor_iv.yaml')
-        self.devices = Dut(device_config)
+        self.io_metrics = IOMetrics()
+        self.devices = InstrumentedDut(create_dut(device_config), self.io_metrics)
 
     def init(self):
+        import tables as tb
+
         self.devices.init()
+        if IO_METRICS_PORT is not None:
+            self.io_metrics.serve(IO_METRICS_PORT)
 
         self.devices['Sourcemeter'].source_volt()
         self.devices['Sourcemeter'].set_voltage_range(1000)
@@ -117,6 +133,9 @@ class SensorIVScan(object):
             row['attribute'] = key
             row['value'] = value
             row.append()
+        self._create_data_nodes()
+
+    def _create_data_nodes(self):
         self.raw_data_table = self.h5_file.create_table(self.h5_file.root, name='raw_data', title='Raw data', description=RawDataTable)
 
     def __enter__(self):
@@ -135,7 +154,10 @@ class SensorIVScan(object):
             self._ramp_hv_to(self.devices['Sourcemeter'], 0)
             self.devices['Sourcemeter'].off()
             self.h5_file.close()
-            self.devices.close()
+            self.io_metrics.finish(self.output_filename + '_io_metrics.prom', self.log)
+        self._plot()
+
+    def _plot(self):
         invert = self.config['VBIAS_stop'] < 0
         plot(self.output_filename + '.h5', invert_x=invert)
 
@@ -154,6 +176,8 @@ class SensorIVScan(object):
             return float(ret)
 
     def _ramp_hv_to(self, dev, target, verbose=True):
+        from tqdm import tqdm
+
         if not dev.get_on():
             dev.set_voltage(0)
             dev.on()
@@ -209,6 +233,7 @@ class SensorIVScan(object):
         VBIAS_step : int
             Stepsize to increase the bias voltage by in every step.
         '''
+        from tqdm import tqdm
 
         module_name = self.config.get('module_name', 'module_0')
         VBIAS_start = self.config.get('VBIAS_start', 0)
@@ -269,7 +294,220 @@ class SensorIVScan(object):
             self._ramp_hv_to(self.devices['Sourcemeter'], 0)
 
 
+class RunningStats(object):
+    ''' Mean, standard deviation, extrema and linear drift of a stream of readings in constant memory. '''
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.min = np.inf
+        self.max = -np.inf
+        self._m2 = 0.  # sum of squared deviations from the mean
+        self._t0 = None
+        self._sums = np.zeros(3)  # sums of t, t^2 and t * value with t relative to the first time stamp
+
+    def add(self, t, values):
+        ''' Add a block of readings (time stamps in s and values), merged like Chan et al. '''
+        n = len(values)
+        if n == 0:
+            return
+        if self._t0 is None:
+            self._t0 = t[0]
+        mean = np.mean(values)
+        delta = mean - self.mean
+        total = self.n + n
+        self._m2 += np.sum((values - mean) ** 2) + delta ** 2 * self.n * n / total
+        self.mean += delta * n / total
+        self.n = total
+        self.min, self.max = min(self.min, np.min(values)), max(self.max, np.max(values))
+        dt = t - self._t0
+        self._sums += (np.sum(dt), np.sum(dt * dt), np.sum(dt * values))
+
+    @property
+    def std(self):
+        return np.sqrt(self._m2 / self.n) if self.n > 0 else np.nan
+
+    @property
+    def drift(self):
+        ''' Slope of the least squares line through the readings per s. '''
+        s_t, s_tt, s_tv = self._sums
+        denominator = self.n * s_tt - s_t ** 2
+        return (self.n * s_tv - s_t * self.mean * self.n) / denominator if self.n > 1 and denominator > 0 else np.nan
+
+
+class SensorStabilityScan(SensorIVScan):
+    '''
+    Leakage current over time at a fixed bias voltage.
+
+    The sourcemeter takes buffer_size readings per request at the fastest integration time, every buffer is appended
+    to the compressed, extendable array stability_data (columns time stamp, voltage, current) and to the rolling
+    statistics (one row of the table statistics per stats_window s), so the memory use does not grow with the
+    duration. Without buffered readings (e.g. a driver of an instrument server) single readings are taken.
+    '''
+    scan_id = 'sensor_stability_scan'
+
+    def _create_data_nodes(self):
+        import tables as tb
+
+        filters = tb.Filters(complevel=5, complib='blosc', shuffle=True)
+        expected = int(self.config.get('duration', 3600) * 100)
+        self.data_array = self.h5_file.create_earray(self.h5_file.root, name='stability_data', atom=tb.Float64Atom(), shape=(0, 3),
+                                                     title='Time stamp [s], voltage [V], current [A]', filters=filters, expectedrows=expected)
+        self.statistics_table = self.h5_file.create_table(self.h5_file.root, name='statistics', title='Rolling statistics',
+                                                          description=StatisticsTable, filters=filters)
+
+    def _init_buffer(self, dev, buffer_size, nplc):
+        ''' Set up buffered readings, returns the number of readings per request. '''
+        commands = getattr(dev, '_scpi_commands', None)  # basil scpi driver, add the missing commands
+        if commands is not None:
+            for name, command in BUFFER_COMMANDS.items():
+                commands.setdefault(name, command)
+        try:
+            dev.set_current_nlpc(nplc)
+            dev.set_auto_zero('OFF')
+            dev.set_trigger_count(buffer_size)
+        except (AttributeError, ValueError) as e:
+            self.log.warning('No buffered readings, taking single readings: {0}'.format(e))
+            self._reset_buffer(dev)
+            return 1
+        return buffer_size
+
+    def _reset_buffer(self, dev):
+        ''' Restore single readings, integration time and auto zero (BUFFER_RESET). '''
+        for command, value in BUFFER_RESET:
+            try:
+                getattr(dev, command)(value)
+            except (AttributeError, ValueError):
+                pass  # command not available, so the setting was not changed either
+
+    def _read_buffer(self, dev):
+        ''' Time stamps (of the instrument), voltages and currents of one buffered request. '''
+        ret = dev.get_current()
+        values = np.array(ret.split(','), dtype=np.float64)
+        if len(values) % 5:  # only the current
+            return np.full(len(values), time.time()), np.full(len(values), np.nan), values
+        values = values.reshape(-1, 5)  # voltage, current, resistance, time stamp, status
+        return values[:, 3], values[:, 0], values[:, 1]
+
+    def _write_window(self, start, stats):
+        row = self.statistics_table.row
+        row['start'], row['stop'], row['n'] = start, start + self.config.get('stats_window', 60), stats.n
+        row['mean'], row['std'], row['min'], row['max'], row['drift'] = stats.mean, stats.std, stats.min, stats.max, stats.drift
+        row.append()
+        self.statistics_table.flush()
+        self.log.info('I = {0:1.3e} +- {1:1.1e} A ({2} readings)'.format(stats.mean, stats.std, stats.n))
+
+    def _scan(self):
+        '''
+        Current vs. time main loop
+
+        Parameters
+        ----------
+        VBIAS : int
+            Bias voltage which is held.
+        duration : float
+            Measurement time in s.
+        buffer_size : int
+            Readings per request.
+        nplc : float
+            Integration time in power line cycles.
+        stats_window : float
+            Time span of one entry of the rolling statistics in s.
+        '''
+        VBIAS = self.config.get('VBIAS', -100)
+        duration = self.config.get('duration', 60)
+        hv_current_limit = self.config.get('hv_current_limit', 1e-6)
+        window = self.config.get('stats_window', 60)
+        dev = self.devices['Sourcemeter']
+
+        try:
+            dev.off()
+            dev.set_voltage(0)
+            dev.set_current_limit(hv_current_limit)
+            dev.on()
+            self._ramp_hv_to(dev, VBIAS)
+            buffer_size = self._init_buffer(dev, self.config.get('buffer_size', 1000), self.config.get('nplc', 0.01))
+
+            self.log.info('Measuring current at {0} V for {1:1.0f}s, {2} readings per request...'.format(VBIAS, duration, buffer_size))
+            total, stats, window_start, offset = RunningStats(), RunningStats(), None, None
+            start = time.time()
+            while time.time() - start < duration:
+                t, voltage, current = self._read_buffer(dev)
+                if offset is None:  # instrument time stamps to unix time
+                    offset = time.time() - t[-1]
+                t = t + offset
+                self.data_array.append(np.column_stack((t, voltage, current)))
+                total.add(t, current)
+
+                while len(t):
+                    if window_start is None:
+                        window_start = t[0]
+                    i = np.searchsorted(t, window_start + window)
+                    stats.add(t[:i], current[:i])
+                    if i == len(t):
+                        break
+                    self._write_window(window_start, stats)
+                    stats = RunningStats()
+                    window_start += window * np.floor((t[i] - window_start) / window)
+                    t, current = t[i:], current[i:]
+
+                if np.max(np.abs(current)) >= hv_current_limit * 0.98:
+                    self.log.error('Current limit reached. Aborting scan!')
+                    break
+            if stats.n:
+                self._write_window(window_start, stats)
+            self.data_array.flush()
+            self.log.info('Scan finished: {0} readings ({1:1.0f}/s), I = {2:1.3e} +- {3:1.1e} A, drift {4:1.2e} A/h'.format(
+                total.n, total.n / max(time.time() - start, 1e-9), total.mean, total.std, total.drift * 3600))
+        except Exception as e:
+            self.log.error('An error occurred: %s' % e)
+        finally:
+            self._reset_buffer(dev)
+            self._ramp_hv_to(dev, 0)
+
+    def _plot(self):
+        plot_stability(self.output_filename + '.h5')
+
+
+def plot_stability(data_file, text_color='#07529a'):
+    ''' Mean and standard deviation of the rolling statistics over time, the readings are not loaded. '''
+    import tables as tb
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+    with tb.open_file(data_file, 'r') as f:
+        stats = f.root.statistics[:]
+        run_config = ConfigDict(f.root.configuration.run_config[:])
+        scan_config = ConfigDict(f.root.configuration.scan_config[:])
+
+    fig = Figure()
+    FigureCanvas(fig)
+    ax = fig.add_subplot(111)
+    fig.subplots_adjust(top=0.85)
+    fig.text(0.1, 0.92, '{0} at {1} V'.format(run_config['chip_type'], scan_config.get('VBIAS')), fontsize=12, color=text_color, transform=fig.transFigure)
+    fig.text(0.65, 0.92, 'Module: {0}'.format(run_config['module']), fontsize=12, color=text_color, transform=fig.transFigure)
+
+    if len(stats):
+        hours = (stats['start'] - stats['start'][0]) / 3600.
+        mean, std = np.abs(stats['mean']), stats['std']
+        ax.plot(hours, mean, color='C0', label='mean')
+        ax.fill_between(hours, mean - std, mean + std, color='C0', alpha=0.3, label='std')
+        ax.plot(hours, np.abs(stats['min']), color='C0', linewidth=0.5, linestyle=':')
+        ax.plot(hours, np.abs(stats['max']), color='C0', linewidth=0.5, linestyle=':')
+        ax.legend()
+    ax.set_title('Leakage current stability', color=text_color)
+    ax.set_xlabel('Time [h]')
+    ax.set_ylabel('Leakage current [A]')
+    ax.grid()
+
+    fig.savefig(data_file[:-3] + '.pdf')
+
+
 def plot(data_file, invert_x=True, log_y=True, level='', text_color='#07529a'):
+    import tables as tb
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
     with tb.open_file(data_file, 'r') as f:
         data = f.root.raw_data[:]
         run_config = ConfigDict(f.root.configuration.run_config[:])
@@ -311,4 +549,7 @@ if __name__ == '__main__':
     with SensorIVScan(scan_config=scan_configuration) as scan:
         scan.start()
 
+    # with SensorStabilityScan(scan_config=stability_configuration) as scan:
+    #     scan.start()
+
     # plot()
@@ -0,0 +1,151 @@
+'''
+    Vectorized conversion of many chip serial numbers, see parse_sn.py for single serial numbers.
+
+    python parse_sn.py --batch chips.csv [--column sn] [-o chips.h5]
+'''
+
+import csv
+
+import numpy as np
+
+from parse_sn import get_index
+
+
+# Value of a character code as hex digit, -1 if it is none
+HEX_DIGITS = np.full(128, -1, dtype=np.int64)
+for i, c in enumerate('0123456789abcdef'):
+    HEX_DIGITS[ord(c)] = HEX_DIGITS[ord(c.upper())] = i
+HEX_CHARS = np.array([ord(c) for c in '0123456789ABCDEF'], dtype=np.uint32)
+
+CHIP_DTYPE = [('sn', 'U32'), ('valid', bool), ('wafer_rd53', np.int32), ('col', np.int8), ('row', np.int8),
+              ('chip_rd53', 'U6'), ('chip_itk', 'U14'), ('wafer_itk', 'U14'), ('wafer_tsmc', 'U11')]
+
+
+def _codes(strings, min_width=14):
+    ''' Character codes of the strings as (n, width) array, shorter strings are padded with 0. '''
+    strings = np.asarray(strings, dtype='U')
+    width = max(strings.dtype.itemsize // 4, min_width)
+    return strings.astype('U{0}'.format(width)).view(np.uint32).reshape(len(strings), width)
+
+
+def _strings(codes):
+    ''' Inverse of _codes. '''
+    codes = np.ascontiguousarray(codes, dtype=np.uint32)
+    return codes.view('U{0}'.format(codes.shape[1])).ravel()
+
+
+def _decimal(values, prefix, n_digits):
+    ''' Strings prefix + values with n_digits decimal digits. '''
+    codes = np.empty((len(values), len(prefix) + n_digits), dtype=np.uint32)
+    codes[:, :len(prefix)] = [ord(c) for c in prefix]
+    codes[:, len(prefix):] = values[:, np.newaxis] // 10 ** np.arange(n_digits - 1, -1, -1) % 10 + ord('0')
+    return _strings(codes)
+
+
+def decode_chip_sns(sns):
+    '''
+    Vectorized find_wafer_from_chip_sn and find_chip for many RD53 (0xWWCR) or ITk (20UPGFCXXXXXXX) chip serial numbers.
+
+    Returns
+    -------
+    Arrays wafer, col, row and valid. Wafer, col and row are -1 for invalid serial numbers.
+    '''
+    sns = np.asarray(sns, dtype='U')
+    codes = _codes(sns)
+    if np.isin(codes, [ord(c) for c in ' \t\r\n']).any():  # np.char is slow, only strip if needed
+        codes = _codes(np.char.strip(sns))
+    length = np.count_nonzero(codes, axis=1)
+    codes = np.minimum(codes[:, :14], 127)  # non ASCII characters are invalid anyway
+
+    # RD53: 0xWWCR
+    hex_digits = HEX_DIGITS[codes[:, 2:6]]
+    rd53 = (length == 6) & (codes[:, 0] == ord('0')) & (codes[:, 1] == ord('x')) & np.all(hex_digits >= 0, axis=1)
+    rd53_value = hex_digits @ np.array([4096, 256, 16, 1])
+
+    # ITk: 20UPGFC + 7 decimal digits of the RD53 value
+    digits = codes[:, 7:14].astype(np.int64) - ord('0')
+    itk = (length == 14) & np.all(codes[:, :7] == [ord(c) for c in '20UPGFC'], axis=1) & np.all((digits >= 0) & (digits <= 9), axis=1)
+    itk_value = digits @ 10 ** np.arange(6, -1, -1)
+    itk &= itk_value <= 0xffff
+
+    value = np.where(rd53, rd53_value, np.where(itk, itk_value, -1))
+    valid = rd53 | itk
+    wafer = np.where(valid, value >> 8, -1)
+    col = np.where(valid, (value >> 4) & 0xf, -1)
+    row = np.where(valid, value & 0xf, -1)
+    return wafer, col, row, valid
+
+
+def chip_table(sns, index=None):
+    ''' Structured array (CHIP_DTYPE) with the RD53, ITk and TSMC identifiers of all chip serial numbers. '''
+    index = index or get_index()
+    wafer, col, row, valid = decode_chip_sns(sns)
+    table = np.zeros(len(wafer), dtype=CHIP_DTYPE)
+    table['sn'] = sns
+    table['valid'] = valid
+    table['wafer_rd53'] = wafer
+    table['col'] = col
+    table['row'] = row
+    if valid.any():
+        value = (wafer[valid] << 8) | (col[valid] << 4) | row[valid]
+        rd53 = np.empty((len(value), 6), dtype=np.uint32)
+        rd53[:, :2] = [ord('0'), ord('x')]
+        rd53[:, 2:] = HEX_CHARS[value[:, np.newaxis] >> np.array([12, 8, 4, 0]) & 0xf]
+        table['chip_rd53'][valid] = _strings(rd53)
+        table['chip_itk'][valid] = _decimal(value, '20UPGFC', 7)
+        table['wafer_itk'][valid] = _decimal(wafer[valid], '20UPGFW', 7)
+        tsmc = np.full(256, '', dtype='U11')  # TSMC serial number by RD53 wafer number
+        for rd53_no, tsmc_sn in index.rd53_to_tsmc.items():
+            tsmc[rd53_no] = tsmc_sn
+        table['wafer_tsmc'][valid] = tsmc[wafer[valid]]
+    return table
+
+
+def read_sns(filename, column=None, node='/chips'):
+    '''
+    Chip serial numbers from a csv file with header (column, default 'sn' or the first column) or an HDF5 file
+    (array or table node, column of the table).
+    '''
+    if filename.endswith('.h5'):
+        import tables as tb
+
+        with tb.open_file(filename, 'r') as f:
+            data = f.get_node(node)
+            data = data.col(column or data.colnames[0]) if isinstance(data, tb.Table) else data[:]
+        return np.char.decode(data, 'ascii') if data.dtype.kind == 'S' else np.asarray(data, dtype='U')
+    with open(filename, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = [h.strip() for h in next(reader)]
+        i = header.index(column) if column is not None else (header.index('sn') if 'sn' in header else 0)
+        return np.array([r[i] for r in reader if len(r) > i], dtype='U')
+
+
+def write_chip_table(filename, table):
+    ''' Write the result of chip_table as csv or (.h5) HDF5 table /chips. '''
+    if filename.endswith('.h5'):
+        import tables as tb
+
+        # PyTables stores byte strings only
+        out = table.astype([(n, 'S{0}'.format(table.dtype[n].itemsize // 4) if table.dtype[n].kind == 'U' else table.dtype[n])
+                            for n in table.dtype.names])
+        with tb.open_file(filename, 'w') as f:
+            f.create_table(f.root, 'chips', obj=out, title='Chip identifiers')
+        return
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(table.dtype.names)
+        writer.writerows(table.tolist())
+
+
+def convert_chip_sns(infile, outfile=None, column=None, node='/chips', index=None):
+    ''' Batch conversion of the chip serial numbers in infile, printed as csv if outfile is None. '''
+    table = chip_table(read_sns(infile, column, node), index)
+    if not table['valid'].all():
+        print(f'{np.count_nonzero(~table["valid"])} invalid serial numbers')
+    if outfile is None:
+        print(','.join(table.dtype.names))
+        for r in table.tolist():
+            print(','.join(str(v) for v in r))
+    else:
+        write_chip_table(outfile, table)
+    return table
@@ -1,4 +1,6 @@
-import yaml
+import os
+import pickle
+import argparse
 from os import path
 
 lookup_wafer_tsmc_rd53 = {
@@ -88,23 +90,149 @@ lookup_wafer_tsmc_rd53 = {
 }
 
 
-def parse_wafer_sn(sn):
-    all_lookups = {}
-    if sn[0].lower() == 'n' and len(sn) == 11:
-        for tsmc_sn in lookup_wafer_tsmc_rd53.keys():
-            if sn.lower()[:-2] in tsmc_sn.lower():
-                return tsmc_sn
-        else:
-            raise ValueError(f'Unknown serial number: {sn}')
-    else:
-        for d in lookup_tables.values():
-            for k, v in d.items():
-                all_lookups[k] = v
-        for identifier, tsmc_sn in all_lookups.items():
-            if sn in identifier:
-                return tsmc_sn
-        else:
+LOOKUP_FILE = path.join(path.dirname(path.abspath(__file__)), 'flipchip_lookup.yaml')
+LOOKUP_CACHE = path.splitext(LOOKUP_FILE)[0] + '.cache'  # pickled SNIndex, rebuilt when LOOKUP_FILE changes
+CACHE_VERSION = 1  # increase when SNIndex changes
+
+
+class SNIndex(object):
+    '''
+    Hash maps between all wafer identifiers: TSMC <-> RD53 <-> ITk <-> vendor aliases (e.g. HPK W6, IZM FOSB sl11).
+
+    TSMC serial numbers are matched without their last two (check) characters and case insensitive, so 'n25a67-01xx'
+    finds N25A67-01B6. Partial TSMC serial numbers are completed with a prefix trie.
+
+    Parameters
+    ----------
+    tsmc_to_rd53 : dict
+        TSMC serial number: RD53 wafer number.
+    vendor_tables : dict
+        Vendor: {alias: TSMC serial number}, content of flipchip_lookup.yaml.
+    '''
+
+    def __init__(self, tsmc_to_rd53, vendor_tables=None):
+        self.tsmc_to_rd53 = dict(tsmc_to_rd53)
+        self.rd53_to_tsmc = {v: k for k, v in self.tsmc_to_rd53.items()}
+        self.itk_to_rd53 = {generate_itk_wafer_sn(v): v for v in self.rd53_to_tsmc}
+        self._tsmc_stem = {k[:-2].lower(): k for k in self.tsmc_to_rd53}  # without check characters
+
+        self.alias_to_tsmc = {}  # alias: TSMC serial number as written in the vendor table
+        self.aliases = {}  # TSMC serial number of lookup_wafer_tsmc_rd53: [(vendor, alias)]
+        self._alias_lower = {}
+        for vendor, table in (vendor_tables or {}).items():
+            for alias, tsmc_sn in table.items():
+                alias = str(alias)
+                self.alias_to_tsmc[alias] = tsmc_sn
+                self._alias_lower.setdefault(alias.lower(), tsmc_sn)
+                known = self._tsmc_stem.get(tsmc_sn[:9].lower())
+                if known is not None:
+                    self.aliases.setdefault(known, []).append((vendor, alias))
+
+        self._trie = {}
+        for tsmc_sn in self.tsmc_to_rd53:
+            node = self._trie
+            for c in tsmc_sn.lower():
+                node = node.setdefault(c, {})
+            node[None] = tsmc_sn
+
+    def complete(self, prefix):
+        ''' All known TSMC serial numbers starting with prefix (case insensitive). '''
+        node = self._trie
+        for c in prefix.lower():
+            node = node.get(c)
+            if node is None:
+                return []
+        found, stack = [], [node]
+        while stack:
+            node = stack.pop()
+            for c, child in node.items():
+                if c is None:
+                    found.append(child)
+                else:
+                    stack.append(child)
+        return sorted(found)
+
+    def tsmc(self, sn):
+        ''' TSMC serial number of lookup_wafer_tsmc_rd53 for a wafer identifier in any format, None if unknown. '''
+        sn = str(sn).strip()
+        key = sn.lower()
+        if key[:1] == 'n' and len(sn) == 11:  # TSMC
+            return self._tsmc_stem.get(key[:-2])
+        if key.startswith('20upgfw'):  # ITk
+            rd53 = self.itk_to_rd53.get(sn.upper())
+            return self.rd53_to_tsmc.get(rd53)
+        if sn.isdigit():  # RD53
+            return self.rd53_to_tsmc.get(int(sn))
+        tsmc_sn = self.alias_to_tsmc.get(sn, self._alias_lower.get(key))
+        if tsmc_sn is None:  # part of an alias, e.g. 'sl11'
+            tsmc_sn = next((v for k, v in self.alias_to_tsmc.items() if sn in k), None)
+        if tsmc_sn is None:
+            return None
+        return self._tsmc_stem.get(tsmc_sn[:9].lower(), tsmc_sn)
+
+    def wafer(self, sn):
+        ''' Dict with the TSMC, RD53 and ITk identifiers and the aliases of a wafer identifier in any format. '''
+        tsmc_sn = self.tsmc(sn)
+        if tsmc_sn is None or tsmc_sn not in self.tsmc_to_rd53:
             raise ValueError(f'Unknown serial number: {sn}')
+        rd53 = self.tsmc_to_rd53[tsmc_sn]
+        return {'tsmc': tsmc_sn, 'rd53': rd53, 'itk': generate_itk_wafer_sn(rd53), 'aliases': self.aliases.get(tsmc_sn, [])}
+
+    def tsmc_many(self, sns):
+        ''' tsmc() of many identifiers, repeated identifiers are only resolved once. '''
+        resolved = {sn: self.tsmc(sn) for sn in set(sns)}
+        return [resolved[sn] for sn in sns]
+
+
+def load_index(lookup_file=LOOKUP_FILE, cache_file=LOOKUP_CACHE):
+    '''
+    SNIndex of lookup_wafer_tsmc_rd53 and the vendor tables of lookup_file. The index is taken from cache_file if it
+    was built from the same lookup_file (modification time and size) and lookup table, otherwise the yaml file is
+    parsed and the cache is renewed.
+    '''
+    stat = os.stat(lookup_file)
+    key = (CACHE_VERSION, path.abspath(lookup_file), stat.st_mtime_ns, stat.st_size, sorted(lookup_wafer_tsmc_rd53.items()))
+    try:
+        with open(cache_file, 'rb') as f:
+            cached_key, state = pickle.load(f)
+        if cached_key == key:
+            index = SNIndex.__new__(SNIndex)
+            index.__dict__.update(state)
+            return index
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        pass  # no or broken cache
+
+    import yaml  # only needed to rebuild the cache
+
+    with open(lookup_file, 'r') as f:
+        index = SNIndex(lookup_wafer_tsmc_rd53, yaml.safe_load(f))
+    try:
+        tmp = cache_file + '.tmp'
+        with open(tmp, 'wb') as f:
+            # Plain dicts instead of the instance, so the cache does not depend on the module name (e.g. __main__)
+            pickle.dump((key, index.__dict__), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+    except OSError:
+        pass  # read only installation, parse again next time
+    return index
+
+
+_index = None
+
+
+def get_index():
+    ''' SNIndex of lookup_wafer_tsmc_rd53 and the vendor tables of LOOKUP_FILE, loaded on first use. '''
+    global _index
+    if _index is None:
+        _index = load_index()
+    return _index
+
+
+def parse_wafer_sn(sn, index=None):
+    tsmc_sn = (index or get_index()).tsmc(sn)
+    if tsmc_sn is None:
+        raise ValueError(f'Unknown serial number: {sn}')
+    return tsmc_sn
 
 
 def generate_itk_chip_sn(rd53_chip_sn):
@@ -152,12 +280,8 @@ def _input_options(text, options):
         raise ValueError('Invalid input!')
 
 
-if __name__ == '__main__':
-
-    lookup_file = path.join(path.dirname(path.abspath(__file__)), 'flipchip_lookup.yaml')
-    with open(lookup_file, 'r') as f:
-        lookup_tables = yaml.load(f)
-
+def interactive(index=None):
+    index = index or get_index()
     option = _input_options('What information do you have available?', ['Chip serial number (any format)', 'Wafer number (any format)', ''])
 
     if option == 0:   # Chip SN
@@ -168,7 +292,7 @@ if __name__ == '__main__':
         wafer_no_rd53 = find_wafer_from_chip_sn(sn)
         col, row = find_chip(sn)
 
-        wafer_sn_tsmc = next(key for key, value in lookup_wafer_tsmc_rd53.items() if value == wafer_no_rd53)
+        wafer_sn_tsmc = index.rd53_to_tsmc[wafer_no_rd53]
         wafer_sn_itk = generate_itk_wafer_sn(wafer_no_rd53)
 
         print(' ')
@@ -182,10 +306,28 @@ if __name__ == '__main__':
         print('TSMC        : NXXXXX-XXXX')
         print('Other       : e.g. W6')
         sn = input('\nEnter wafer number: ')
-        wafer_sn_tsmc = parse_wafer_sn(sn)
+        wafer_sn_tsmc = parse_wafer_sn(sn, index)
 
         wafer_no_rd53 = lookup_wafer_tsmc_rd53[wafer_sn_tsmc]
         wafer_sn_itk = generate_itk_wafer_sn(wafer_no_rd53)
 
         print(' ')
         print(f'Wafer {sn} is called {wafer_sn_itk} (ITk) / {wafer_no_rd53} (RD53) / {wafer_sn_tsmc} (TSMC).')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert chip and wafer serial numbers, interactive without arguments')
+    parser.add_argument('--batch', default=None, help='csv or HDF5 (.h5) file with chip serial numbers')
+    parser.add_argument('--column', default=None, help='Column of the serial numbers (default: sn or first column)')
+    parser.add_argument('--node', default='/chips', help='HDF5 node of the serial numbers')
+    parser.add_argument('-o', '--output', default=None, help='Output file (csv or .h5), default: print csv')
+    args = parser.parse_args()
+
+    index = get_index()
+    if args.batch is not None:
+        from batch_sn import convert_chip_sns  # numpy is only needed for batch conversion
+
+        convert_chip_sns(args.batch, args.output, args.column, args.node, index)
+    else:
+        interactive(index)
+
@@ -0,0 +1,11 @@
+'''
+    Makes the shared code in the repository root (e.g. the instruments package) importable for the scripts of this folder.
+    Import it before any of these packages.
+'''
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
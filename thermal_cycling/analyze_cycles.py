@@ -0,0 +1,175 @@
+'''
+    Splits a thermocycling temperature log into ramps and cycles and calculates per ramp statistics:
+    ramp rate, time to target, overshoot, dwell stability and dew point margin.
+
+    Ramps are found from the change points of the t_setp column. Overshoot setpoints and the switch back
+    to the target belong to the same ramp, a new ramp starts when the setpoint changes direction with
+    respect to the module temperature.
+'''
+
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from thermocycling_data import load_temps
+
+time_str = None  # time of file: 'YYYYmmdd_HHMMSS'/ latest when None
+t_sens = 't_mod2'  # temperature sensor which has reach set temperature
+mod_sens = ['t_mod', 't_mod2']  # module temperatures (used for dew point margin)
+accuracy = 1  # target is reached when t_sens is within accuracy
+# Schedule of the run to group ramps into cycles: array like in run_thermocycling_QC.py or name of the runner
+# module to take its schedule from, ramps are not grouped when None
+cycles = 'run_thermocycling_QC'
+
+FILEPATH = os.path.dirname(os.path.abspath(__file__))
+DATAPATH = os.path.join(FILEPATH, 'output_data')
+
+ramp_dtype = [('cycle', 'i4'), ('start', 'f8'), ('stop', 'f8'), ('target', 'f8'), ('t_start', 'f8'),
+              ('time_to_target', 'f8'), ('ramp_rate', 'f8'), ('overshoot', 'f8'),
+              ('dwell_time', 'f8'), ('dwell_std', 'f8'), ('dp_margin', 'f8')]
+
+
+def _ffill(values):
+    ''' Replace NaN by the last valid value. '''
+    idx = np.where(np.isnan(values), 0, np.arange(len(values)))
+    np.maximum.accumulate(idx, out=idx)
+    return values[idx]
+
+
+def find_ramps(setpoint, temperature):
+    ''' Return start indices of the ramps (change points of the setpoint which start a new direction). '''
+    setpoint = _ffill(setpoint)
+    temperature = _ffill(temperature)
+    change_points = np.flatnonzero(np.diff(setpoint) != 0) + 1
+    direction = np.sign(setpoint[change_points] - temperature[change_points])
+    # A switch from overshoot back to target keeps the direction and belongs to the same ramp
+    new_direction = np.ones(len(change_points), dtype=bool)
+    new_direction[1:] = direction[1:] != direction[:-1]
+    return change_points[new_direction]
+
+
+def _crossing(values, level, direction):
+    ''' Index of first value passing level in direction, len(values) if never. '''
+    passed = (values - level) * direction >= 0
+    return np.argmax(passed) if passed.any() else len(values)
+
+
+def analyze(data, t_sens=t_sens, mod_sens=mod_sens, accuracy=accuracy):
+    ts = data['timestamp']
+    temperature = data[t_sens]
+    starts = find_ramps(data['t_setp'], temperature)
+    stops = np.append(starts[1:], len(ts))
+    has_dp = 'dew_point' in data.dtype.names
+    mod_sens = [s for s in mod_sens if s in data.dtype.names]
+
+    ramps = np.zeros(len(starts), dtype=ramp_dtype)
+    ramps['cycle'] = -1
+    for name, _ in ramp_dtype[1:]:
+        ramps[name] = np.nan
+    for ramp, start, stop in zip(ramps, starts, stops):
+        t, y = ts[start:stop], temperature[start:stop]
+        target = _ffill(data['t_setp'][start:stop])[-1]  # last setpoint of the ramp is the target
+        valid = ~np.isnan(y)
+        ramp['start'], ramp['stop'], ramp['target'] = ts[start], ts[stop - 1], target
+        if not valid.any():
+            continue
+        t, y = t[valid], y[valid]
+        y0 = y[0]
+        direction = 1 if target > y0 else -1
+
+        reached = np.flatnonzero(np.abs(y - target) < accuracy)
+        ramp['t_start'] = y0
+        if len(reached) == 0:
+            continue
+        i_reached = reached[0]
+        ramp['time_to_target'] = t[i_reached] - t[0]
+
+        # Ramp rate between 10% and 90% of the transition
+        i_10 = _crossing(y[:i_reached + 1], y0 + 0.1 * (target - y0), direction)
+        i_90 = _crossing(y[:i_reached + 1], y0 + 0.9 * (target - y0), direction)
+        if i_90 > i_10 and i_90 <= i_reached:
+            ramp['ramp_rate'] = (y[i_90] - y[i_10]) / (t[i_90] - t[i_10]) * 60.
+
+        dwell = y[i_reached:]
+        ramp['overshoot'] = max(0, np.max((dwell - target) * direction))
+        ramp['dwell_time'] = t[-1] - t[i_reached]
+        ramp['dwell_std'] = np.std(dwell)
+
+        if has_dp and mod_sens:
+            mod_temps = np.array([data[s][start:stop] for s in mod_sens])
+            margin = np.nanmin(mod_temps, axis=0) - data['dew_point'][start:stop]
+            if not np.all(np.isnan(margin)):
+                ramp['dp_margin'] = np.nanmin(margin)
+
+    return ramps
+
+
+def load_schedule(cycles):
+    ''' Return the cycles schedule, imported from the runner module if given by name. '''
+    if isinstance(cycles, str):
+        import importlib
+        cycles = importlib.import_module(cycles).cycles
+    return cycles
+
+
+def assign_cycles(ramps, cycles):
+    ''' Set cycle number of the ramps by matching their targets to the schedule in order. '''
+    expected = []
+    n_iter = 1
+    for cycle in cycles:
+        for _ in range(cycle['n_cycles']):
+            expected.extend((n_iter, temp) for temp in cycle['temps'])
+            n_iter += 1
+
+    i = 0
+    for ramp in ramps:
+        if i < len(expected) and ramp['target'] == expected[i][1]:
+            ramp['cycle'] = expected[i][0]
+            i += 1
+    if i < len(expected):
+        print('Only {0} of {1} scheduled ramps found in data'.format(i, len(expected)))
+    return ramps
+
+
+def print_report(ramps):
+    if len(ramps) == 0:
+        print('No ramps found')
+        return
+
+    print('{0:>5} {1:>16} {2:>7} {3:>7} {4:>10} {5:>11} {6:>9} {7:>9} {8:>9} {9:>9}'.format(
+        'cycle', 'start', 'T_0', 'target', 'to target', 'rate', 'overshoot', 'dwell', 'dwell std', 'dp margin'))
+    print('{0:>5} {1:>16} {2:>7} {3:>7} {4:>10} {5:>11} {6:>9} {7:>9} {8:>9} {9:>9}'.format(
+        '', '', '[°C]', '[°C]', '[min]', '[°C/min]', '[°C]', '[min]', '[°C]', '[°C]'))
+    for r in ramps:
+        print('{0:>5} {1:>16} {2:7.1f} {3:7.1f} {4:10.1f} {5:11.2f} {6:9.2f} {7:9.1f} {8:9.2f} {9:9.1f}'.format(
+            r['cycle'] if r['cycle'] >= 0 else '', datetime.fromtimestamp(r['start']).strftime('%d %H:%M:%S'), r['t_start'], r['target'],
+            r['time_to_target'] / 60., r['ramp_rate'], r['overshoot'], r['dwell_time'] / 60., r['dwell_std'], r['dp_margin']))
+
+    total = ramps['stop'][-1] - ramps['start'][0]
+    ramping = np.nansum(ramps['time_to_target'])
+    dwelling = np.nansum(ramps['dwell_time'])
+    print('\nTotal {0:1.2f}h: {1:1.2f}h ({2:1.0f}%) ramping, {3:1.2f}h ({4:1.0f}%) at target'.format(
+        total / 3600., ramping / 3600., 100. * ramping / total, dwelling / 3600., 100. * dwelling / total))
+
+    in_cycle = ramps[ramps['cycle'] > 0]
+    for n_iter in np.unique(in_cycle['cycle']):
+        sel = in_cycle[in_cycle['cycle'] == n_iter]
+        print('Cycle {0}: {1:1.2f}h, {2:1.2f}h ramping'.format(n_iter, (sel['stop'][-1] - sel['start'][0]) / 3600., np.nansum(sel['time_to_target']) / 3600.))
+
+
+if __name__ == '__main__':
+    if time_str is None:
+        file_times = [f[:15] for f in os.listdir(DATAPATH) if f.endswith('_thermocycling_temps.dat')]
+        times = [time.mktime(datetime.strptime(s, "%Y%m%d_%H%M%S").timetuple()) for s in file_times]
+        time_str = file_times[np.argmax(times)]
+
+    data = load_temps(os.path.join(DATAPATH, time_str + '_thermocycling_temps.dat'))
+    ramps = analyze(data)
+    if cycles is not None:
+        assign_cycles(ramps, load_schedule(cycles))
+    print_report(ramps)
+
+    np.savetxt(os.path.join(DATAPATH, time_str + '_cycle_analysis.csv'), ramps, delimiter=',', fmt='%s',
+               header=', '.join(name for name, _ in ramp_dtype))
@@ -0,0 +1,100 @@
+'''
+    Disconnected bump history of a connectivity campaign.
+
+    The bump status map of every cycle (see run_connectivity_cycles.py) is appended bit-packed along the rows
+    to an extendable array of shape (cycles, 400, 24) in one h5 file, so the failures of hundreds of cycles can
+    be evaluated without opening the scan files again.
+'''
+
+import os
+import re
+import logging
+
+import numpy as np
+import tables as tb
+
+N_COLUMNS, N_ROWS = 400, 192
+BUMP_STATUS_PATH = 'bump_status'
+HISTORY_FILE = 'bump_history.h5'
+
+DISCONNECTED = 2  # status of a disconnected bump in the status maps (see connectivity_analysis.py)
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint16)
+
+
+class BumpHistory(object):
+    '''
+    Parameters
+    ----------
+    filename : str
+        h5 file of the history, it is created if it does not exist.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.isfile(filename):
+            with tb.open_file(filename, 'r') as f:
+                self.cycles = f.root.cycles[:]
+                self.packed = f.root.disconnected[:]
+        else:
+            with tb.open_file(filename, 'w') as f:
+                f.create_earray(f.root, 'cycles', tb.Int32Atom(), shape=(0,), title='Cycle number')
+                f.create_earray(f.root, 'disconnected', tb.UInt8Atom(), shape=(0, N_COLUMNS, N_ROWS // 8),
+                                title='Disconnected bumps, bit-packed along rows', filters=tb.Filters(complevel=5, complib='blosc'))
+            self.cycles = np.zeros(0, dtype=np.int32)
+            self.packed = np.zeros((0, N_COLUMNS, N_ROWS // 8), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.cycles)
+
+    def append(self, cycle, disconnected):
+        ''' Add the boolean (400, 192) map of disconnected bumps of a cycle. '''
+        packed = np.packbits(np.asarray(disconnected, dtype=bool), axis=1)[np.newaxis]
+        with tb.open_file(self.filename, 'a') as f:
+            f.root.cycles.append([cycle])
+            f.root.disconnected.append(packed)
+        self.cycles = np.append(self.cycles, np.int32(cycle))
+        self.packed = np.concatenate((self.packed, packed))
+
+    def update(self, status_path=BUMP_STATUS_PATH):
+        ''' Append the status maps (cycle_NNNN.npy) of cycles which are not in the history yet. Returns the added cycles. '''
+        added = []
+        if not os.path.isdir(status_path):
+            return added
+        files = {int(m.group(1)): f for f in os.listdir(status_path) for m in [re.match(r'cycle_(\d+)\.npy$', f)] if m}
+        last = self.cycles[-1] if len(self.cycles) else 0
+        for cycle in sorted(c for c in files if c > last):
+            self.append(cycle, np.load(os.path.join(status_path, files[cycle])) == DISCONNECTED)
+            added.append(cycle)
+        return added
+
+    def failures_per_cycle(self):
+        ''' Number of disconnected bumps in every cycle. '''
+        return POPCOUNT[self.packed].sum(axis=(1, 2))
+
+    def pixel_history(self, column, row):
+        ''' Disconnection status of one pixel in every cycle. '''
+        return (self.packed[:, column, row // 8] >> (7 - row % 8)) & 1 == 1
+
+    def first_failure(self, chunk_size=256):
+        ''' Cycle in which each pixel was disconnected for the first time, -1 if never. '''
+        first = np.full((N_COLUMNS, N_ROWS), -1, dtype=np.int32)
+        for start in range(0, len(self.cycles), chunk_size):
+            disconnected = np.unpackbits(self.packed[start:start + chunk_size], axis=2).astype(bool)
+            new = (first < 0) & disconnected.any(axis=0)
+            first[new] = self.cycles[start:start + chunk_size][np.argmax(disconnected, axis=0)[new]]
+        return first
+
+    def new_failures_per_cycle(self):
+        ''' Number of bumps which were disconnected for the first time in every cycle. '''
+        first = self.first_failure()
+        return np.bincount(np.searchsorted(self.cycles, first[first >= 0]), minlength=len(self.cycles))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)-7s %(message)s', level=logging.INFO)
+    history = BumpHistory(HISTORY_FILE)
+    added = history.update(BUMP_STATUS_PATH)
+    logging.info('Added {0} cycles, history contains {1} cycles'.format(len(added), len(history)))
+
+    for cycle, n_failures, n_new in zip(history.cycles, history.failures_per_cycle(), history.new_failures_per_cycle()):
+        print('Cycle {0:4d}: {1:5d} disconnected bumps, {2:5d} new'.format(cycle, n_failures, n_new))
@@ -0,0 +1,121 @@
+'''
+    Persistent state of a thermal cycling campaign.
+
+    The state is stored as json and rewritten atomically (temporary file + rename) after every step,
+    so an interrupted campaign can be resumed at the last completed step and the dry-out can be skipped
+    if the chamber was dry until shortly before the restart. The modules and a hash of the cycle schedule
+    are stored with the state, a state of a different campaign is not resumed.
+'''
+
+import os
+import json
+import time
+import hashlib
+
+
+def save_json(filename, data):
+    ''' Write data as json to a temporary file and rename it, so filename is never left half written. '''
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+def schedule_hash(cycles):
+    ''' Short hash of a cycles schedule (n_cycles, temps, wait_time) to recognize the campaign of a state file. '''
+    schedule = [[int(c['n_cycles']), [float(t) for t in c['temps']], float(c['wait_time'])] for c in cycles]
+    return hashlib.sha1(json.dumps(schedule).encode()).hexdigest()[:12]
+
+
+class CampaignState(object):
+    '''
+    Parameters
+    ----------
+    filename : str
+        State file, it is loaded if it exists.
+    min_save_interval : float
+        Minimal time in s between two saves triggered by record_dew_point. Steps are always saved.
+    '''
+
+    defaults = {
+        'completed_cycles': 0,  # number of fully completed cycles
+        'step': 0,  # completed steps (temperatures/scans) of the current cycle
+        'phase': 'idle',
+        'dried': False,  # dry-out at start was completed
+        'dew_point': None,  # last dew point status: time, margin of lowest module temperature to dew point, ok
+        'started': None,
+        'updated': None,
+        'campaign': None,  # modules and schedule hash of the campaign, see campaign()
+    }
+
+    def __init__(self, filename, min_save_interval=10):
+        self.filename = filename
+        self.min_save_interval = min_save_interval
+        self.state = dict(self.defaults)
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                self.state.update(json.load(f))
+
+    def __getitem__(self, key):
+        return self.state[key]
+
+    @property
+    def finished(self):
+        return self.state['phase'] == 'finished'
+
+    @staticmethod
+    def campaign(modules, cycles):
+        return {'modules': list(modules), 'schedule': schedule_hash(cycles)}
+
+    def resumable(self, campaign):
+        ''' True if the state belongs to an unfinished campaign with the same modules and schedule. '''
+        return not self.finished and self.state['started'] is not None and self.state['campaign'] == campaign
+
+    def save(self):
+        self.state['updated'] = time.time()
+        save_json(self.filename, self.state)
+
+    def reset(self, campaign=None):
+        ''' Start a new campaign. '''
+        self.state = dict(self.defaults)
+        self.state['started'] = time.time()
+        self.state['campaign'] = campaign
+        self.save()
+
+    def update(self, **kwargs):
+        self.state.update(kwargs)
+        self.save()
+
+    def complete_step(self, phase=None):
+        self.state['step'] += 1
+        if phase is not None:
+            self.state['phase'] = phase
+        self.save()
+
+    def complete_cycle(self):
+        self.state['completed_cycles'] += 1
+        self.state['step'] = 0
+        self.save()
+
+    def record_dew_point(self, margin, min_margin):
+        ''' Store distance of the lowest module temperature to the dew point (None if not measured). '''
+        if margin is not None:
+            margin = float(margin)
+        self.state['dew_point'] = {'time': time.time(), 'margin': margin,
+                                   'ok': bool(margin is None or margin >= min_margin)}
+        if self.state['updated'] is None or time.time() - self.state['updated'] >= self.min_save_interval:
+            self.save()
+
+    def dry_out_needed(self, max_age):
+        '''
+        The dry-out can be skipped if it was completed before, the state was updated within max_age seconds
+        (chamber was closed and controlled until then) and the last dew point status was ok.
+        '''
+        if not self.state['dried'] or self.state['updated'] is None:
+            return True
+        if time.time() - self.state['updated'] > max_age:
+            return True
+        dew_point = self.state['dew_point']
+        return dew_point is not None and not dew_point['ok']
@@ -0,0 +1,172 @@
+'''
+    Ramp/soak programs of the climate chamber compiled from the cycle schedule of the QC runner.
+
+    A program is a list of segments (setpoint, ramp, soak): the chamber setpoint ramps linearly from the previous
+    setpoint to setpoint within ramp s (0: step) and is then held for soak s. The whole schedule is uploaded and
+    started at once, the chamber then runs the cycles on its own timing and the host only supervises (interlock,
+    logging, progress). Drivers running programs provide
+
+    upload_program(segments)    list of (setpoint, ramp, soak) tuples, replaces the previous program
+    start_program(segment=0)    start the program at segment
+    stop_program()              end the program, the chamber keeps the current setpoint
+    hold_program(hold)          pause (True) or continue (False) the program. While it is paused the setpoint can be
+                                changed with set_temperature, the program setpoint is restored on continue.
+    get_program_status()        dict with running, held, segment (index of the current segment, the number of
+                                segments when the program is finished) and elapsed (time in the segment in s)
+
+    The simulated chamber (instruments/simulation.py) has a program mode, the basil weiss_labevent driver only has the
+    manual mode. HostProgram runs a program with the same methods on a chamber in manual mode, the setpoints follow
+    the wall clock since the start instead of the iterations of the control loop.
+'''
+
+import time
+
+import numpy as np
+
+PROGRAM_DTYPE = [('setpoint', 'f8'), ('ramp', 'f8'), ('soak', 'f8'), ('cycle', 'i4'), ('target', 'f8'),
+                 ('end_of_step', '?'), ('end_of_cycle', '?')]
+
+
+def compile_program(cycles, start_temperature, model=None, setpoint_limits=(-65, 70), max_overshoot=15, settle_time=30 * 60,
+                    ramp_rate=None, completed_cycles=0, completed_steps=0):
+    '''
+    Segments of the cycle schedule as structured array with the fields of PROGRAM_DTYPE.
+
+    Every temperature of a cycle is one step: without a model one segment at the target temperature which is held for
+    settle_time plus the wait time of the cycle. With a SetpointModel the transition is planned like in
+    run_thermocycling: a segment at target + overshoot until the module is expected to pass the switch temperature,
+    then the target segment is held for the dead time of the model, settle_time and the wait time.
+
+    Parameters
+    ----------
+    cycles : structured array
+        Schedule with the fields n_cycles, temps and wait_time.
+    start_temperature : float
+        Module temperature at the start, used to plan the first transition.
+    settle_time : float
+        Time in s the modules get to reach the target (in addition to the planned transition time with a model).
+    ramp_rate : float
+        Setpoint ramp in K/s of the segments without overshoot, steps if None.
+    completed_cycles, completed_steps : int
+        Progress of a resumed campaign (see CampaignState), only the remaining steps are compiled.
+    '''
+    segments = []
+    current, previous_setpoint = start_temperature, start_temperature
+    n_iter = 0
+    for cycle in cycles:
+        for _ in range(cycle['n_cycles']):
+            n_iter += 1
+            if n_iter <= completed_cycles:
+                continue
+            temps = cycle['temps'][completed_steps if n_iter == completed_cycles + 1 else 0:]
+            for i, target in enumerate(temps):
+                end_of_cycle = i == len(temps) - 1
+                overshoot, switch_temperature, duration = 0, None, None
+                if model is not None:
+                    overshoot, switch_temperature, duration = model.plan(current, target, setpoint_limits, max_overshoot)
+                if switch_temperature is not None:
+                    segments.append((target + overshoot, 0, duration - model.dead_time, n_iter, target, False, False))
+                    segments.append((target, 0, model.dead_time + settle_time + cycle['wait_time'], n_iter, target, True, end_of_cycle))
+                else:
+                    ramp = 0 if ramp_rate is None else abs(target - previous_setpoint) / ramp_rate
+                    soak = settle_time + cycle['wait_time'] + (duration if duration is not None and np.isfinite(duration) else 0)
+                    segments.append((target, ramp, soak, n_iter, target, True, end_of_cycle))
+                current, previous_setpoint = target, target
+    return np.array(segments, dtype=PROGRAM_DTYPE)
+
+
+def program_segments(program):
+    ''' (setpoint, ramp, soak) tuples of a compiled program, as uploaded to the chamber. '''
+    return [(float(s['setpoint']), float(s['ramp']), float(s['soak'])) for s in program]
+
+
+def program_duration(program):
+    ''' Total time of the program in s. '''
+    return float(np.sum(program['ramp']) + np.sum(program['soak']))
+
+
+def ramp_setpoint(start, setpoint, ramp, elapsed):
+    ''' Setpoint at elapsed s after the start of a segment which ramps from start to setpoint within ramp s. '''
+    if ramp <= 0 or elapsed >= ramp:
+        return setpoint
+    return start + (setpoint - start) * max(elapsed, 0) / ramp
+
+
+class HostProgram(object):
+    '''
+    Runs a ramp/soak program on a chamber in manual mode, for drivers without program mode.
+
+    update() has to be called regularly (e.g. on every sample of the control loop). The program position is
+    calculated from clock, so late or missed updates do not shift the schedule, and the chamber is only
+    called when the setpoint changes by at least resolution.
+
+    Parameters
+    ----------
+    chamber : driver
+        Climate chamber with get_temperature_setpoint and set_temperature.
+    clock : callable
+        Time in s, time.monotonic by default.
+    '''
+
+    def __init__(self, chamber, resolution=0.1, clock=time.monotonic):
+        self.chamber = chamber
+        self.resolution = resolution
+        self.clock = clock
+        self.segments = []
+        self.segment = 0
+        self.running = False
+        self.held = False
+        self._segment_start = None  # clock time the current segment started
+        self._held_since = None
+        self._start_setpoint = None  # setpoint the current segment ramps from
+        self._setpoint = None  # last setpoint sent to the chamber
+
+    def upload_program(self, segments):
+        self.stop_program()
+        self.segments = [tuple(float(v) for v in segment) for segment in segments]
+        self.segment = 0
+
+    def start_program(self, segment=0):
+        self.segment = segment
+        self._segment_start = self.clock()
+        self._start_setpoint = self.chamber.get_temperature_setpoint()
+        self._setpoint = None
+        self.running, self.held = segment < len(self.segments), False
+        self.update()
+
+    def stop_program(self):
+        self.running = False
+
+    def hold_program(self, hold):
+        now = self.clock()
+        if hold and not self.held:
+            self._held_since = now
+        elif not hold and self.held:
+            self._segment_start += now - self._held_since
+            self._setpoint = None  # restore the program setpoint
+        self.held = bool(hold)
+        self.update()
+
+    def get_program_status(self):
+        now = self._held_since if self.held else self.clock()
+        elapsed = now - self._segment_start if self.running else 0.
+        return {'running': self.running, 'held': self.held, 'segment': self.segment, 'elapsed': elapsed}
+
+    def update(self):
+        ''' Advance the program to the current time and send a changed setpoint. '''
+        if not self.running or self.held:
+            return
+        now = self.clock()
+        while self.running:
+            setpoint, ramp, soak = self.segments[self.segment]
+            if now - self._segment_start < ramp + soak:
+                break
+            self._segment_start += ramp + soak
+            self._start_setpoint = setpoint
+            self.segment += 1
+            self.running = self.segment < len(self.segments)
+        if self.running:
+            setpoint = ramp_setpoint(self._start_setpoint, setpoint, ramp, now - self._segment_start)
+        if self._setpoint is None or abs(setpoint - self._setpoint) >= self.resolution:
+            self.chamber.set_temperature(round(setpoint, 1))
+            self._setpoint = setpoint
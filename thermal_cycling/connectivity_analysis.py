@@ -0,0 +1,105 @@
+'''
+    Offline analysis of the connectivity scans of run_connectivity_cycles.py.
+
+    The functions only get file names and must not touch the hardware: analyze_scan runs in worker
+    processes while the chamber already continues with the next cycle.
+'''
+
+import numpy as np
+import tables as tb
+
+# Bump status per pixel
+CONNECTED, MARGINAL, DISCONNECTED, NOT_SCANNED = 0, 1, 2, -1
+# Threshold difference between the two sensor bias settings in the interpreted file of BumpConnThrShScan
+# (bdaq53.scans.scan_disconnected_bumps_threshold), adjust to the node name of the installed bdaq53 version
+THRESHOLD_SHIFT_NODE = 'ThresholdShiftMap'
+
+
+class MissingThresholdShift(Exception):
+    ''' The interpreted file has no THRESHOLD_SHIFT_NODE, every following bump scan would fail the same way. '''
+
+
+def analyze_scan(raw_data_file, create_pdf=True):
+    ''' Interpret the raw data file of a scan and create the standard plots. Returns the interpreted data file. '''
+    # bdaq53 is only imported by the workers which analyze a scan
+    from bdaq53.analysis import analysis as anl
+    from bdaq53.analysis import plotting
+
+    with anl.Analysis(raw_data_file=raw_data_file) as a:
+        a.analyze_data()
+        analyzed_data_file = a.analyzed_data_file
+
+    if create_pdf:
+        with plotting.Plotting(analyzed_data_file=analyzed_data_file) as p:
+            p.create_standard_plots()
+    return analyzed_data_file
+
+
+def read_registers(raw_data_file, names):
+    ''' Chip register values at the end of a scan (e.g. the result of a tuning). '''
+    with tb.open_file(raw_data_file, 'r') as f:
+        registers = f.root.configuration_out.chip.registers[:]
+    values = {}
+    for register in registers:
+        name = register['name'].decode() if isinstance(register['name'], bytes) else register['name']
+        if name in names:
+            values[name] = int(register['value'])
+    return values
+
+
+def mean_occupancy(analyzed_data_file, start_column, stop_column, start_row, stop_row):
+    ''' Mean number of hits per pixel in the selected region. '''
+    with tb.open_file(analyzed_data_file, 'r') as f:
+        hist_occ = f.root.HistOcc[:]
+    if hist_occ.ndim > 2:
+        hist_occ = hist_occ.sum(axis=tuple(range(2, hist_occ.ndim)))
+    return np.mean(hist_occ[start_column:stop_column, start_row:stop_row])
+
+
+def bump_status(analyzed_data_file, disconnected_shift, marginal_shift):
+    '''
+    Classify the bumps by the threshold shift between forward and reverse sensor bias of a BumpConnThrShScan:
+    the input capacitance of a connected pixel changes with the sensor bias, a disconnected one does not see it.
+    Pixels without a result are NOT_SCANNED.
+    '''
+    with tb.open_file(analyzed_data_file, 'r') as f:
+        if '/' + THRESHOLD_SHIFT_NODE not in f:
+            maps = [node._v_name for node in f.root if node._v_name.endswith('Map')]
+            raise MissingThresholdShift('No threshold shift map /{0} in {1} (maps in file: {2}). Expected the interpreted output of the '
+                               'bdaq53 BumpConnThrShScan, set THRESHOLD_SHIFT_NODE to the name used by the installed bdaq53.'.format(
+                                   THRESHOLD_SHIFT_NODE, analyzed_data_file, ', '.join(maps) if maps else 'none'))
+        shift = np.abs(f.get_node('/' + THRESHOLD_SHIFT_NODE)[:])
+    status = np.full(shift.shape, CONNECTED, dtype=np.int8)
+    status[shift < marginal_shift] = MARGINAL
+    status[shift < disconnected_shift] = DISCONNECTED
+    status[~np.isfinite(shift)] = NOT_SCANNED
+    return status
+
+
+def roi_regions(mask, padding=2, max_gap=8):
+    '''
+    Rectangles (start_column, stop_column, start_row, stop_row) covering all pixels set in mask (columns x rows).
+    Columns with selected pixels closer than max_gap are scanned together to limit the number of scans.
+    '''
+    columns = np.flatnonzero(mask.any(axis=1))
+    if len(columns) == 0:
+        return []
+    regions = []
+    for group in np.split(columns, np.flatnonzero(np.diff(columns) > max_gap) + 1):
+        rows = np.flatnonzero(mask[group[0]:group[-1] + 1].any(axis=0))
+        regions.append((int(max(0, group[0] - padding)), int(min(mask.shape[0], group[-1] + 1 + padding)),
+                        int(max(0, rows[0] - padding)), int(min(mask.shape[1], rows[-1] + 1 + padding))))
+    return regions
+
+
+def analyze_bump_scans(status, raw_data_files, regions, status_file, disconnected_shift, marginal_shift, create_pdf=True):
+    '''
+    Analyze the full statistics bump connectivity scans of one cycle and overlay their result in the scanned
+    regions onto status (the result of the survey scan). The bump status of the cycle is saved to status_file.
+    '''
+    status = status.copy()
+    for raw_data_file, (start_column, stop_column, start_row, stop_row) in zip(raw_data_files, regions):
+        region_status = bump_status(analyze_scan(raw_data_file, create_pdf=create_pdf), disconnected_shift, marginal_shift)
+        status[start_column:stop_column, start_row:stop_row] = region_status[start_column:stop_column, start_row:stop_row]
+    np.save(status_file, status)
+    return status_file
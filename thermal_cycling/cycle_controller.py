@@ -0,0 +1,251 @@
+'''
+    Temperature control loop shared by the thermal cycling runners.
+
+    The sensors are read out on a fixed sampling clock instead of back to back. Samples are written
+    to the log and data file at a separate (slower) logging rate and the events 'target_reached',
+    'dew_point_violation', 'timeout', 'data_logged' and 'sampled' (every sample) can be hooked with callbacks.
+'''
+
+import time
+import logging
+
+import numpy as np
+
+from interlock import DewPointInterlock
+
+EVENTS = ('target_reached', 'dew_point_violation', 'timeout', 'data_logged', 'sampled')
+
+
+class RunStopped(Exception):
+    ''' Raised by the control loop after a stop was requested (see CycleController.stop). '''
+
+
+class SampleClock(object):
+    ''' Fixed rate clock. Ticks are scheduled on a fixed grid and do not drift with the time spent between them. '''
+
+    def __init__(self, period):
+        self.period = period
+        self.next_tick = time.monotonic()
+        self.max_lag = 0.
+
+    def wait(self):
+        now = time.monotonic()
+        if now < self.next_tick:
+            time.sleep(self.next_tick - now)
+        else:
+            self.max_lag = max(self.max_lag, now - self.next_tick)
+        # Skip ticks which were missed because the readout took longer than one period
+        missed = max(0, int((time.monotonic() - self.next_tick) // self.period))
+        self.next_tick += (missed + 1) * self.period
+
+
+class CycleController(object):
+    '''
+    Controls the climate chamber and logs the sensors of one thermal cycling setup.
+
+    Parameters
+    ----------
+    dut : basil.dut.Dut
+        Initialized periphery with a 'Climatechamber'.
+    sensors : structured array
+        Sensor table with the fields name, short, f and kwargs. Short names are used in the log file,
+        sensors with short name None are only written to the data file.
+    outfile : str
+        Data file the samples are appended to.
+    t_sens : str
+        Name of the temperature sensor which has to reach the set temperature.
+    air_sens : list of str
+        Sensors (without t_/h_) measuring air temperature and humidity, used to calculate the dew point. No dew point
+        is calculated and no interlock is active if None.
+    mod_sens : list of str
+        Sensors (without t_/h_) that measure temperatures of modules, used for interlocking.
+    interlock_dp : str
+        Name of the value which stores the dew point used for interlocking.
+    min_interlock_distance : float
+        How much the interlock dew point must be under the lowest module temperature.
+    interlock_hysteresis : float
+        Additional distance needed to release the interlock.
+    interlock_debounce : int
+        Number of consecutive samples needed to activate or release the interlock.
+    sample_period : float
+        Time between two sensor readouts in s. Target and interlock are checked on every sample.
+    log_period : float
+        Minimal time between two entries in the log and data file in s.
+    timeout : float
+        Default time in s after which go_to_temperature gives up.
+    '''
+
+    def __init__(self, dut, sensors, outfile, t_sens, air_sens=None, mod_sens=None, interlock_dp='dew_point', min_interlock_distance=5,
+                 interlock_hysteresis=2, interlock_debounce=3, sample_period=1, log_period=10, timeout=60 * 60, sample_log_level=logging.INFO, log=None):
+        self.dut = dut
+        self.sensors = sensors
+        self.outfile = outfile
+        self.t_sens = t_sens
+        self.air_sens = air_sens
+        self.mod_sens = mod_sens if mod_sens is not None else []
+        self.interlock_dp = interlock_dp
+        self.min_interlock_distance = min_interlock_distance
+        self.timeout = timeout
+        self.sample_log_level = sample_log_level
+        self.log = log if log is not None else logging.getLogger()
+        self.interlock = None
+        if air_sens is not None:
+            self.interlock = DewPointInterlock(sensors['name'], air_sens, self.mod_sens, min_distance=min_interlock_distance,
+                                               hysteresis=interlock_hysteresis, debounce=interlock_debounce, log=self.log)
+
+        self.clock = SampleClock(sample_period)
+        self.log_period = log_period
+        self.last_log_time = 0
+        self.n_samples = 0
+        self.max_latency = 0.   # max. time between scheduled sample and interlock decision in s
+
+        self.callbacks = {event: [] for event in EVENTS}
+
+        self.phase = 'idle'  # free text status shown by monitoring
+        self.program = None  # runs a chamber program (see chamber_program.py), paused while the interlock is active
+        self.last_values = {}
+        self.stopped = False
+
+    @property
+    def chamber(self):
+        return self.dut['Climatechamber']
+
+    def stop(self):
+        ''' Request the control loop to stop, the next sample raises RunStopped. Can be called from another thread. '''
+        self.stopped = True
+
+    def add_callback(self, event, callback):
+        ''' Register callback(**kwargs) for one of EVENTS. '''
+        if event not in EVENTS:
+            raise ValueError('Unknown event {0}, possible events are {1}'.format(event, ', '.join(EVENTS)))
+        self.callbacks[event].append(callback)
+
+    def _emit(self, event, **kwargs):
+        for callback in self.callbacks[event]:
+            try:
+                callback(**kwargs)
+            except Exception as e:
+                self.log.error('Callback for event {0} failed: {1}'.format(event, e))
+
+    def acquire(self, save_data=True):
+        ''' Read out all sensors once. Data is logged if save_data is set and the logging period is over. '''
+        values = {s['name']: s['f'](**s['kwargs']) for s in self.sensors}
+        if self.interlock is not None:
+            self.interlock.evaluate(np.array([v if v is not None else np.nan for v in values.values()], dtype=float))
+            values[self.interlock_dp] = self.interlock.dew_point
+
+        now = time.time()
+        if save_data and now - self.last_log_time >= self.log_period:
+            self.last_log_time = now
+            self.log.log(self.sample_log_level,
+                         ', '.join([f'{key.capitalize()} = {value:1.2f}' if value is not None else f'{key.capitalize()} = None'
+                                    for key, value in zip(self.sensors['short'], values.values()) if key != 'None']))
+            with open(self.outfile, 'a') as f:
+                f.write('{0}, '.format(now)
+                        + ', '.join([f'{value:1.2f}' if value is not None else 'None'
+                                     for value in values.values()])
+                        + '\n')
+            self._emit('data_logged', values=values)
+
+        self.last_values = values
+        self._emit('sampled', values=values, timestamp=now)
+        return values
+
+    def sample(self, save_data=True):
+        ''' Wait for the next tick of the sampling clock and acquire. '''
+        self.clock.wait()
+        if self.stopped:
+            raise RunStopped('Run was stopped')
+        scheduled = self.clock.next_tick - self.clock.period
+        values = self.acquire(save_data=save_data)
+        self.n_samples += 1
+        self.max_latency = max(self.max_latency, time.monotonic() - scheduled)
+        return values
+
+    def dew_point_margin(self):
+        ''' Distance of the lowest module temperature to the interlock dew point in the last sample, None if not available. '''
+        if self.interlock is None or np.isnan(self.interlock.margin):
+            return None
+        return float(self.interlock.margin)
+
+    def _below_dew_point(self, distance):
+        margin = self.dew_point_margin()
+        return margin is not None and margin < distance
+
+    def wait_for_min_dew_point(self, distance, timeout=60 * 60, save_data=True):
+        timestamp_start = time.time()
+        self.sample(save_data=save_data)
+        while self._below_dew_point(distance):
+            values = self.sample(save_data=save_data)
+            if time.time() - timestamp_start > timeout:
+                self._emit('timeout', reason='dew_point', values=values)
+                raise RuntimeError('Target dew point could not be reached within specified timeout!')
+        self.log.info('Target dew point reached!')
+
+    def check_interlock(self, values, save_data=True, timeout=60 * 60):
+        ''' Hold the current temperature (and pause a running chamber program) while the interlock is active. '''
+        if self.interlock is None or not self.interlock.active:
+            return
+        self._emit('dew_point_violation', values=values, distance=self.interlock.min_distance, event=self.interlock.events[-1])
+        # wait at current temperature till all temperatures are stabilized and dew point is low again
+        if self.program is not None:
+            self.program.hold_program(True)
+        target = self.chamber.get_temperature_setpoint()
+        cur_temp = self.chamber.get_temperature()
+        self.chamber.set_temperature(cur_temp)
+        timestamp_start = time.time()
+        while self.interlock.active:
+            values = self.sample(save_data=save_data)
+            if time.time() - timestamp_start > timeout:
+                self._emit('timeout', reason='dew_point', values=values)
+                raise RuntimeError('Interlock was not released within specified timeout!')
+        self.log.info('Interlock released, continuing')
+        if self.program is not None:
+            self.program.hold_program(False)
+        else:
+            self.chamber.set_temperature(target)
+
+    def _in_range(self, values, target, accuracy):
+        return values[self.t_sens] is not None and (target - accuracy) < values[self.t_sens] < (target + accuracy)
+
+    def go_to_temperature(self, target, wait_time=0, overshoot=0, accuracy=1, timeout=None, save_data=True, interlock=True, switch_temperature=None):
+        '''
+        Set the chamber to target + overshoot until t_sens is within accuracy of target, then wait wait_time at target.
+        If switch_temperature is given, the chamber is already set back to target when t_sens passes it.
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        self.chamber.set_temperature(target + overshoot)
+        timestamp_start = time.time()
+        while True:
+            values = self.sample(save_data=save_data)
+            if interlock:
+                self.check_interlock(values, save_data=save_data)
+            if switch_temperature is not None and values[self.t_sens] is not None and (values[self.t_sens] - switch_temperature) * overshoot >= 0:
+                self.log.info('Switching setpoint to target at T_sens = {0:1.2f}'.format(values[self.t_sens]))
+                self.chamber.set_temperature(target)
+                switch_temperature = None
+            if self._in_range(values, target, accuracy):
+                self.log.info('Target temperature reached on device!')
+                self._emit('target_reached', target=target, values=values)
+                break
+            if time.time() - timestamp_start > timeout:
+                self._emit('timeout', reason='temperature', target=target, values=values)
+                raise RuntimeError('Target temperature could not be reached within specified timeout!')
+
+        self.chamber.set_temperature(target)
+        if wait_time > 0:
+            self.log.info('Waiting for {0:1.0f}s at {1}°C...'.format(wait_time, target))
+            timestamp_start = time.time()
+            while True:
+                values = self.sample(save_data=save_data)
+                if interlock:
+                    self.check_interlock(values, save_data=save_data)
+                if values[self.t_sens] is not None and not self._in_range(values, target, accuracy):
+                    self.log.warning(f'Temperature on device deviated too much: Target = {target}, T_sens = {values[self.t_sens]:1.2f}')
+                if time.time() - timestamp_start > wait_time:
+                    self.log.info('Wait time over. Continuing...')
+                    break
+
+    def log_statistics(self):
+        self.log.info('Acquired {0} samples, max. sampling lag {1:1.3f}s, max. interlock latency {2:1.3f}s'.format(self.n_samples, self.clock.max_lag, self.max_latency))
@@ -0,0 +1,103 @@
+'''
+    Dew point interlock for the thermal cycling setups.
+
+    The sensor columns are looked up once, on every sample the dew points of all air sensors are calculated in one
+    numpy expression and compared to the lowest module temperature. The interlock activates when a module gets closer
+    than min_distance to the highest dew point and is released only when the distance is min_distance + hysteresis
+    again. Both transitions have to be seen for debounce consecutive samples.
+'''
+
+import json
+import time
+import logging
+
+import numpy as np
+
+
+def dew_point(T, RH):
+    ''' Dew point for temperatures T and relative humidities RH (scalars or arrays), NaN for RH = 0. '''
+    # Formula by Sensirion:
+    # http://irtfweb.ifa.hawaii.edu/~tcs3/tcs3/Misc/Dewpoint_Calculation_Humidity_Sensor_E.pdf
+    T, RH = np.asarray(T, dtype=float), np.asarray(RH, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        H = (np.log10(np.where(RH > 0, RH, np.nan)) - 2) / 0.4343 + (17.62 * T) / (243.12 + T)
+        return 243.12 * H / (17.62 - H)
+
+
+class DewPointInterlock(object):
+    '''
+    Parameters
+    ----------
+    names : list of str
+        Names of the sampled values, in the order they are passed to evaluate.
+    air_sens : list of str
+        Sensors (without t_/h_) measuring air temperature and humidity. Sensors without humidity are ignored.
+    mod_sens : list of str
+        Sensors (without t_) measuring module temperatures.
+    min_distance : float
+        How much the dew point must be under the lowest module temperature.
+    hysteresis : float
+        Additional distance needed to release the interlock.
+    debounce : int
+        Number of consecutive samples needed to activate or release the interlock.
+    '''
+
+    def __init__(self, names, air_sens, mod_sens, min_distance=5, hysteresis=2, debounce=3, log=None):
+        self.log = log if log is not None else logging.getLogger()
+        names = list(names)
+        self.air_sens = [s for s in air_sens if 't_' + s in names and 'h_' + s in names]
+        ignored = [s for s in air_sens if s not in self.air_sens]
+        if ignored:
+            self.log.warning('No temperature and humidity for air sensors {0}, not used for dew point'.format(', '.join(ignored)))
+        self.t_air = np.array([names.index('t_' + s) for s in self.air_sens], dtype=int)
+        self.h_air = np.array([names.index('h_' + s) for s in self.air_sens], dtype=int)
+        self.t_mod = np.array([names.index('t_' + s) for s in mod_sens if 't_' + s in names], dtype=int)
+
+        self.min_distance = min_distance
+        self.hysteresis = hysteresis
+        self.debounce = debounce
+
+        self.active = False
+        self.dew_point = np.nan
+        self.margin = np.nan
+        self.events = []
+        self._count = 0  # consecutive samples which would change the state
+
+    def evaluate(self, values):
+        '''
+        Update the interlock with one sample (array in the order of names, NaN for missing values).
+        Returns True if the state of the interlock changed.
+        '''
+        dew_points = dew_point(values[self.t_air], values[self.h_air])
+        valid = ~np.isnan(dew_points)
+        if valid.any():
+            worst = np.flatnonzero(valid)[np.argmax(dew_points[valid])]
+            self.dew_point = dew_points[worst]
+        else:
+            worst, self.dew_point = None, np.nan
+        mod_temps = values[self.t_mod]
+        self.margin = np.nanmin(mod_temps) - self.dew_point if not np.all(np.isnan(mod_temps)) else np.nan
+
+        if np.isnan(self.margin):
+            self._count = 0
+            return False
+        if self.active:
+            change = self.margin >= self.min_distance + self.hysteresis
+        else:
+            change = self.margin < self.min_distance
+        self._count = self._count + 1 if change else 0
+        if self._count < self.debounce:
+            return False
+
+        self._count = 0
+        self.active = not self.active
+        self._record('activated' if self.active else 'released',
+                     sensor=self.air_sens[worst] if worst is not None else None,
+                     air_dew_points=dict(zip(self.air_sens, np.round(dew_points, 2).tolist())))
+        return True
+
+    def _record(self, event, **kwargs):
+        entry = dict(time=time.time(), event=event, dew_point=round(float(self.dew_point), 2), margin=round(float(self.margin), 2),
+                     min_distance=self.min_distance, **kwargs)
+        self.events.append(entry)
+        self.log.warning('Interlock event: {0}'.format(json.dumps(entry)))
@@ -0,0 +1,216 @@
+'''
+    Slack notifications which never block the control loop.
+
+    Notifier.notify only puts the message into a queue and returns. A background thread posts the messages:
+
+    batching     all messages which are due are posted as one Slack message per user
+    rate limit   token bucket of rate posts per second with bursts of up to burst posts
+    coalescing   a message which is already waiting, or was sent less than coalesce_window s ago, is not queued
+                 again but counted, it is sent once with the number of repetitions (e.g. a dew point alarm
+                 triggered on every sample)
+    retries      failed posts are retried with exponential backoff (or after the Retry-After time of a rate limited
+                 request), new messages wait for the next batch. After max_retries the batch is dropped.
+
+    The Slack client is created in the worker thread. base_url points it to another server, e.g. a local stub for tests.
+'''
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+
+def read_token(token):
+    ''' Slack token from a token file, or the token itself. '''
+    if os.path.isfile(os.path.expanduser(token)):
+        with open(os.path.expanduser(token), 'r') as token_file:
+            return token_file.read().strip()
+    return token
+
+
+class Notifier(object):
+    '''
+    Parameters
+    ----------
+    token : str
+        Slack API token or file containing it, read once.
+    users : list
+        Channels or user ids the messages are sent to.
+    rate : float
+        Maximal average number of posts per second, burst posts can be sent at once.
+    coalesce_window : float
+        Minimal time in s between two posts of the same message.
+    max_retries : int
+        Attempts to post a batch before it is dropped.
+    backoff : float
+        Delay in s before the first retry, doubled on every retry up to max_backoff.
+    max_queue : int
+        Maximal number of different waiting messages, further ones are dropped.
+    client : object
+        Object with a chat_postMessage method like slack.WebClient, created from token and base_url if None.
+    '''
+
+    def __init__(self, token='', users=(), username='Thermocycle Bot', icon_emoji=':robot_face:', rate=1., burst=3,
+                 coalesce_window=60., max_retries=5, backoff=2., max_backoff=300., max_queue=100, max_batch=20,
+                 base_url=None, timeout=10, client=None):
+        self.token = read_token(token) if token else token
+        self.users = list(users)
+        self.username = username
+        self.icon_emoji = icon_emoji
+        self.rate = rate
+        self.burst = burst
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.base_url = base_url
+        self.timeout = timeout
+        self.client = client
+        self.log = logging.getLogger('Notifier')
+
+        self.pending = OrderedDict()  # message: [repetitions, time it is due]
+        self.last_sent = {}  # message: time of the last post
+        self.stats = dict(queued=0, coalesced=0, dropped=0, posts=0, sent=0, failed=0, retries=0)
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._condition = threading.Condition()
+        self._sending = ()  # messages of the batch which is being posted
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name='Notifier', daemon=True)
+        self._thread.start()
+
+    def notify(self, message):
+        ''' Queue message for sending, returns immediately. '''
+        now = time.monotonic()
+        with self._condition:
+            if message in self.pending:
+                self.pending[message][0] += 1
+                self.stats['coalesced'] += 1
+                return
+            if len(self.pending) >= self.max_queue:
+                self.stats['dropped'] += 1
+                return
+            last_sent = now if message in self._sending else self.last_sent.get(message, -float('inf'))
+            self.pending[message] = [1, max(now, last_sent + self.coalesce_window)]
+            self.stats['queued'] += 1
+            self._condition.notify()
+
+    __call__ = notify
+
+    def _client(self):
+        if self.client is None:
+            from slack import WebClient
+
+            kwargs = {'base_url': self.base_url} if self.base_url is not None else {}
+            self.client = WebClient(self.token, timeout=self.timeout, **kwargs)
+        return self.client
+
+    def _take_batch(self, now):
+        ''' Remove the due messages from pending, returns them with their repetitions and the time of the next due message. '''
+        batch, next_due = [], None
+        for message, (count, due) in list(self.pending.items()):
+            if due <= now and len(batch) < self.max_batch:
+                batch.append((message, count))
+                del self.pending[message]
+            elif next_due is None or due < next_due:
+                next_due = due
+        return batch, next_due
+
+    def _wait_for_token(self):
+        ''' Block until the token bucket allows a post. '''
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            time.sleep((1 - self._tokens) / self.rate)
+
+    def _post(self, user, text):
+        self._client().chat_postMessage(channel=user, text=text, username=self.username, icon_emoji=self.icon_emoji)
+
+    def _retry_delay(self, error, attempt):
+        ''' Retry-After of a rate limited request, otherwise exponential backoff. '''
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None) or {}
+        try:
+            return float(headers['Retry-After'])
+        except (KeyError, TypeError, ValueError):
+            return min(self.max_backoff, self.backoff * 2 ** attempt)
+
+    def _send(self, batch):
+        ''' Post the batch to all users with retries. '''
+        text = '\n'.join(message if count == 1 else '{0} ({1}x)'.format(message, count) for message, count in batch)
+        users = list(self.users)
+        attempt = 0
+        while users:
+            self._wait_for_token()
+            try:
+                self._post(users[0], text)
+                self.stats['posts'] += 1
+                users.pop(0)
+                attempt = 0
+                continue
+            except Exception as e:
+                attempt += 1
+                if attempt >= self.max_retries:
+                    self.log.error('Notification to {0} failed after {1} attempts, dropping it: {2}'.format(users[0], attempt, e))
+                    self.stats['failed'] += len(batch)
+                    users.pop(0)
+                    attempt = 0
+                    continue
+                delay = self._retry_delay(e, attempt - 1)
+                self.stats['retries'] += 1
+                self.log.warning('Notification failed, retrying in {0:1.0f}s: {1}'.format(delay, e))
+                time.sleep(delay)
+        self.stats['sent'] += len(batch)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    batch, next_due = self._take_batch(now)
+                    if batch or (self._stop and not self.pending):
+                        break
+                    if self._stop:  # only messages held back by coalescing are left, send them now
+                        for message in self.pending:
+                            self.pending[message][1] = now
+                        continue
+                    self._condition.wait(None if next_due is None else next_due - now)
+                if not batch:
+                    return
+                self._sending = [message for message, _ in batch]
+            try:
+                self._send(batch)
+            finally:
+                with self._condition:
+                    for message in self._sending:
+                        self.last_sent[message] = time.monotonic()
+                    self._sending = ()
+                    self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        ''' Wait until the queue is empty (messages held back by coalescing count as sent). '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._sending or any(due <= time.monotonic() for _, due in self.pending.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining if remaining is not None else 0.1)
+        return True
+
+    def close(self, timeout=10.):
+        ''' Send the remaining messages (waiting at most timeout s) and stop the worker. '''
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self.log.warning('{0} notifications could not be sent before closing'.format(len(self.pending) + len(self._sending)))
+        self.log.info('Notifications: ' + ', '.join('{0} {1}'.format(v, k) for k, v in self.stats.items()))
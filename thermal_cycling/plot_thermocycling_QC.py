@@ -10,17 +10,23 @@ from matplotlib.figure import Figure
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 import matplotlib.gridspec as gridspec
 
+from thermocycling_data import load_temps, valid
+
 time_str = None  # time of file: 'YYYYmmdd_HHMMSS'/ latest when None
 plot_frequently = False  # if plot should be repeated regularly
 plot_interval = 30  # minimal time between each plot in seconds
 
 FILEPATH = os.path.dirname(os.path.abspath(__file__))
 DATAPATH = os.path.join(FILEPATH, 'output_data')
-if time_str is None:
-    file_times = [f[:15] for f in os.listdir(DATAPATH) if f.endswith('_thermocycling_temps.dat')]
-    times = [time.mktime(datetime.strptime(s, "%Y%m%d_%H%M%S").timetuple()) for s in file_times]
-    time_str = file_times[np.argmax(times)]
-TEMPSFILE = os.path.join(DATAPATH, time_str + '_thermocycling_temps.dat')
+
+
+def find_tempsfile(time_str=None, datapath=DATAPATH):
+    ''' Time string and path of the temperature log of time_str, of the latest one in datapath if None. '''
+    if time_str is None:
+        file_times = [f[:15] for f in os.listdir(datapath) if f.endswith('_thermocycling_temps.dat')]
+        times = [time.mktime(datetime.strptime(s, "%Y%m%d_%H%M%S").timetuple()) for s in file_times]
+        time_str = file_times[np.argmax(times)]
+    return time_str, os.path.join(datapath, time_str + '_thermocycling_temps.dat')
 
 
 class DelayedKeyboardInterrupt(object):
@@ -37,31 +43,10 @@ class DelayedKeyboardInterrupt(object):
             self.old_handler(*self.signal_received)
 
 
-def plot():
-    with open(TEMPSFILE, 'r') as f:
-        l = f.readline()    # Remove title line
-        names = [n.strip() for n in l.split(',')[1:]]
-        times = {name: [] for name in names}
-        data = {name: [] for name in names}
-        times['dp'] = []
-        data['dp'] = []
-        for l in f.readlines():
-            d = l.strip().split(',')
-            ts = datetime.fromtimestamp((float(d[0])))
-            printdp = True
-            for name, value in zip(names, d[1:]):
-                if name == 'dew_point':
-                    dp = float(value.strip())
-                else:
-                    if 'None' not in value:
-                        times[name].append(ts)
-                        v = float(value.strip())
-                        data[name].append(v)
-                    elif name in ['t_air2', 't_sens', 'h_air2', 'h_sens']:
-                        printdp = False
-            if printdp:
-                times['dp'].append(ts)
-                data['dp'].append(dp)
+def plot(tempsfile, outfiles):
+    data = load_temps(tempsfile)
+    # Dew point is only meaningful when all sensors it is calculated from are available
+    dp_valid = np.all([~np.isnan(data[name]) for name in ['t_air2', 't_sens', 'h_air2', 'h_sens']], axis=0)
 
     fig = Figure()
     FigureCanvas(fig)
@@ -71,20 +56,20 @@ def plot():
     ax = fig.add_subplot(gs[0])
     ax2 = fig.add_subplot(gs[1], sharex=ax)
 
-    ax.plot(times['t_setp'], data['t_setp'], label='T_setpoint', color='gray')
-    ax.plot(times['t_chamber'], data['t_chamber'], label='T_chamber', color='C0')
-    ax.plot(times['t_sens'], data['t_sens'], label='T_sens', color='C1')
-    ax.plot(times['t_mod'], data['t_mod'], label='T_mod', color='C2')
-    ax.plot(times['t_mod2'], data['t_mod2'], label='T_mod_2', color='C4')
-    ax.plot(times['t_air'], data['t_air'], label='T_air', color='C5')
-    ax.plot(times['t_air2'], data['t_air2'], label='T_air_2', color='C6')
-    ax.plot(times['dp'], data['dp'], label='Dew Point', color='C3')
-
-    ax2.plot(times['h_sens'], data['h_sens'], color='C1', label='Hum_sens')
-    ax2.plot(times['h_mod'], data['h_mod'], color='C2', label='Hum_mod')
-    ax2.plot(times['h_mod2'], data['h_mod2'], color='C4', label='Hum_mod_2')
-    # ax2.plot(times['h_air'], data['h_air'], color='C5', label='Hum_air')
-    ax2.plot(times['h_air2'], data['h_air2'], color='C6', label='Hum_air_2')
+    ax.plot(*valid(data, 't_setp'), label='T_setpoint', color='gray')
+    ax.plot(*valid(data, 't_chamber'), label='T_chamber', color='C0')
+    ax.plot(*valid(data, 't_sens'), label='T_sens', color='C1')
+    ax.plot(*valid(data, 't_mod'), label='T_mod', color='C2')
+    ax.plot(*valid(data, 't_mod2'), label='T_mod_2', color='C4')
+    ax.plot(*valid(data, 't_air'), label='T_air', color='C5')
+    ax.plot(*valid(data, 't_air2'), label='T_air_2', color='C6')
+    ax.plot(data['time'][dp_valid], data['dew_point'][dp_valid], label='Dew Point', color='C3')
+
+    ax2.plot(*valid(data, 'h_sens'), color='C1', label='Hum_sens')
+    ax2.plot(*valid(data, 'h_mod'), color='C2', label='Hum_mod')
+    ax2.plot(*valid(data, 'h_mod2'), color='C4', label='Hum_mod_2')
+    # ax2.plot(*valid(data, 'h_air'), color='C5', label='Hum_air')
+    ax2.plot(*valid(data, 'h_air2'), color='C6', label='Hum_air_2')
 
     xfmt = md.DateFormatter('%d %H:%M')
     ax2.xaxis.set_major_formatter(xfmt)
@@ -95,21 +80,23 @@ def plot():
     ax2.grid()
     ax.legend(bbox_to_anchor=(1.01, 1), loc='upper left')
     ax2.legend(bbox_to_anchor=(1.01, 1), loc='upper left')
-    ax.set_title('Thermal cycling {}'.format(times['t_setp'][0].strftime("%Y-%m-%d, %H:%M")))
+    ax.set_title('Thermal cycling {}'.format(data['time'][0].astype(datetime).strftime("%Y-%m-%d, %H:%M")))
     ax.set_ylabel('T [°C]')
     ax2.set_ylabel('rel. Humidity [%]')
 
-    fig.savefig(os.path.join(DATAPATH, time_str + '_temps.pdf'))
-    fig.savefig(os.path.join(FILEPATH, 'temps.pdf'))
+    for outfile in outfiles:
+        fig.savefig(outfile)
 
 
 if __name__ == '__main__':
-    plot()
+    time_str, TEMPSFILE = find_tempsfile(time_str)
+    outfiles = [os.path.join(DATAPATH, time_str + '_temps.pdf'), os.path.join(FILEPATH, 'temps.pdf')]
+    plot(TEMPSFILE, outfiles)
 
     last_time = time.time()
     while plot_frequently:
         with DelayedKeyboardInterrupt():
-            plot()
+            plot(TEMPSFILE, outfiles)
         cur_time = time.time()
         if cur_time - last_time < plot_interval:
             time.sleep(plot_interval - (cur_time - last_time))
@@ -1,26 +1,64 @@
 import os
+import copy
 import time
+import atexit
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import yaml
 
-from slack import WebClient
-from basil.dut import Dut
+# slack and the bdaq53 scans are imported where they are used, they take seconds to load
 
-from bdaq53.system.periphery import BDAQ53Periphery
-from bdaq53.scans.scan_analog import AnalogScan
-from bdaq53.scans.tune_global_threshold import GDACTuning
-from bdaq53.scans.scan_disconnected_bumps_threshold import BumpConnThrShScan
+from cycle_controller import CycleController
+from telemetry import TelemetryServer, attach
+from campaign_state import CampaignState
+from notifications import Notifier
+from connectivity_analysis import (MissingThresholdShift, analyze_scan, read_registers, mean_occupancy, bump_status, roi_regions, analyze_bump_scans,
+                                   MARGINAL, DISCONNECTED, NOT_SCANNED)
+from tuning_cache import TuningCache
+from bump_history import BumpHistory
+
+import _paths  # noqa: F401 (shared instrument code in the repository root)
+from instruments.io_metrics import IOMetrics, InstrumentedDut
+from instruments.simulation import create_dut
 
 LOGFILE = 'thermocycling_connectivity.log'
 OUTFILE_TEMPS = 'thermocycling_connectivity_temps.dat'
+STATEFILE = 'thermocycling_connectivity_state.json'
+TUNING_CACHE = 'thermocycling_connectivity_tuning.json'
+BUMP_STATUS_PATH = 'bump_status'  # Bump status map of every cycle (cycle_0001.npy, ...)
+BUMP_HISTORY_FILE = 'bump_history.h5'  # Disconnected bumps of all cycles, see bump_history.py
+IO_METRICS_FILE = 'thermocycling_connectivity_io_metrics.prom'
 
 T_MIN = -40         # Minimum temperature
 T_MAX = 60          # Maximum temperature
 WAIT_TIME = 2 * 60  # Wait time at target temperature
-
-CYCLE_START = 1
+SAMPLE_PERIOD = 1   # Time between two sensor readouts in s
+LOG_PERIOD = 10     # Minimal time between two entries in log and data file in s
+IO_METRICS_PORT = None  # Serve instrument I/O statistics (Prometheus text format) on this local port
+TELEMETRY_PORT = None  # Serve the latest samples from memory (see telemetry.py) on this local port
+TELEMETRY_SOCKET = None  # or on this unix socket
+TELEMETRY_HISTORY = 24 * 60 * 60  # Time span of the samples kept in memory in s
+
+RESUME = True               # Continue after the last completed step of the state file (same module and cycle), start new campaign otherwise
+DRY_OUT_MAX_AGE = 30 * 60   # Skip dry-out on resume if the state file showed a dry chamber within this time in s
+ANALYSIS_WORKERS = 2        # Processes analyzing finished scans while the chamber continues with the next cycle
+
+# Global threshold DACs set by the tunings, cached per module, temperature and front-end
+TUNING_REGISTERS = {'sync': ['VTH_SYNC'], 'lin_diff': ['Vthreshold_LIN', 'VTH1_DIFF']}
+TUNING_TOLERANCE = 0.05     # Cached tuning is used if the occupancy at the tuning charge is within 50% +- this fraction
+TUNING_VERIFICATION = {'start_row': 0, 'stop_row': 24, 'n_injections': 50}  # Short analog scan checking a cached tuning
+
+INCREMENTAL_SCANS = True    # Full statistics bump scans only of regions that were marginal, disconnected or changed in a survey
+FULL_SCAN_INTERVAL = 0      # Full statistics scan of the whole matrix every n-th cycle, only when there is no previous result if 0
+SURVEY_CONFIGURATION = {'n_injections': 10, 'VCAL_HIGH_step_fine': 200}  # Fast survey of the whole matrix, overrides scan_configuration
+DISCONNECTED_SHIFT = 20     # Max. threshold shift between forward and reverse bias of a disconnected bump in DVCAL
+MARGINAL_SHIFT = 50         # Max. threshold shift of a marginal bump in DVCAL
+ROI_PADDING = 2             # Pixels scanned around the pixels of interest
 
 TESTBENCH = '/home/silab/git/bdaq53/bdaq53/testbench.yaml'
+notifier = None  # Slack notifications of bench['notifications'], created by the first notify()
 
 scan_configuration = {
     'start_column': 0,
@@ -79,171 +117,321 @@ tuning_configuration_lin_diff = {
              }
 }
 
-# Logging setup
-for handler in logging.root.handlers[:]:
-    logging.root.removeHandler(handler)
-fmt = '%(asctime)s - %(levelname)-7s %(message)s'
-logging.basicConfig(format=fmt, filename=LOGFILE, filemode='w', level=logging.INFO)
-sh = logging.StreamHandler()
-sh.setFormatter(logging.Formatter(fmt))
-sh.setLevel(logging.DEBUG)
-logging.root.addHandler(sh)
 
-def notify(message):
-    global bench
+def setup_logging():
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+    fmt = '%(asctime)s - %(levelname)-7s %(message)s'
+    logging.basicConfig(format=fmt, filename=LOGFILE, filemode='w', level=logging.INFO)
+    sh = logging.StreamHandler()
+    sh.setFormatter(logging.Formatter(fmt))
+    sh.setLevel(logging.DEBUG)
+    logging.root.addHandler(sh)
 
-    with open(os.path.expanduser(bench['notifications']['slack_token']), 'r') as token_file:
-        token = token_file.read().strip()
 
+def notify(message):
+    global notifier
+    if notifier is None:
+        # The token is read once, messages are posted by a background thread without delaying the cycle
+        notifier = Notifier(bench['notifications']['slack_token'], bench['notifications']['slack_users'], username='BDAQ53 Bot')
+        atexit.register(notifier.close)
+    notifier.notify(message)
+
+def setup_sensors(dut):
+    return np.array([
+        ('t_setp', None, dut['Climatechamber'].get_temperature_setpoint, {}),
+        ('t_chamber', 't_ch', dut['Climatechamber'].get_temperature, {}),
+        ('t_sens', 't_sns', dut['Thermohygrometer'].get_temperature, {'channel': 0}),
+        ('h_sens', 'h_sns', dut['Thermohygrometer'].get_humidity, {'channel': 0}),
+        ('t_mod', 't_mod', dut['Thermohygrometer'].get_temperature, {'channel': 1}),
+        ('h_mod', 'h_mod', dut['Thermohygrometer'].get_humidity, {'channel': 1}),
+        ('t_air', 't_air', dut['Thermohygrometer'].get_temperature, {'channel': 3}),
+        ('h_air', 'h_air', dut['Thermohygrometer'].get_humidity, {'channel': 3})
+    ], dtype=[('name', 'U50'), ('short', 'U50'), ('f', 'O'), ('kwargs', 'O')])
+    # Order has to match the columns of OUTFILE_TEMPS, short names are used in log file (when None, it does not get printed there)
+
+
+def overshoot(target):
+    return 5 if target > 0 else -10
+
+
+def verify_tuning(config):
+    ''' Short analog scan at the tuning charge: a tuned front-end sees half of the injections. '''
+    from bdaq53.scans.scan_analog import AnalogScan
+
+    verification = dict(config, **TUNING_VERIFICATION)
+    with AnalogScan(scan_config=verification) as scan:
+        scan.start()
+        analyzed_data_file = scan.output_filename + '_interpreted.h5'
+    occupancy = mean_occupancy(analyzed_data_file, verification['start_column'], verification['stop_column'],
+                               verification['start_row'], verification['stop_row']) / verification['n_injections']
+    logging.info('Occupancy at tuning charge: {0:1.1f}%'.format(occupancy * 100))
+    return abs(occupancy - 0.5) <= TUNING_TOLERANCE
+
+
+def tune_front_end(front_end, config, tuned, cache, module, temperature):
+    '''
+    Global threshold tuning of one front-end. The tuning is skipped if the last converged result of the cache
+    passes verify_tuning, otherwise GDACTuning runs its full binary search. The resulting registers are added to tuned.
+    '''
+    config = copy.deepcopy(config)
+    registers = config.setdefault('chip', {}).setdefault('registers', {})
+    registers.update(tuned)  # keep the results of the other front-ends
+    cached = cache.get(module, temperature, front_end)
+    if cached is not None:
+        registers.update(cached)
+        if verify_tuning(config):
+            logging.info('Cached {0} tuning is still valid, skipping tuning'.format(front_end))
+            tuned.update(cached)
+            return
+        logging.info('Cached {0} tuning is out of tolerance, tuning again'.format(front_end))
+
+    from bdaq53.scans.tune_global_threshold import GDACTuning
+
+    with GDACTuning(scan_config=config) as global_tuning:
+        global_tuning.start()
+        raw_data_file = global_tuning.output_filename + '.h5'
+    result = read_registers(raw_data_file, TUNING_REGISTERS[front_end])
+    cache.store(module, temperature, front_end, result)
+    tuned.update(result)
+
+
+def take_scan_data(scan_bench, cache, module, temperature):
+    '''
+    Temperature sensitive part of the cycle before the bump connectivity scans: analog scan and global threshold tunings.
+    The tunings are analyzed right away since the next scan depends on them, the raw data file of the analog scan
+    is returned to be analyzed in the background together with the tuned registers.
+    '''
+    from bdaq53.scans.scan_analog import AnalogScan
+
+    raw_data_files = []
+    with AnalogScan(scan_config={'use_default_chip_configuration': True}, bench_config=scan_bench) as scan:
+        scan.start()
+        raw_data_files.append(scan.output_filename + '.h5')
+
+    tuning_configuration['start_column'] = scan_configuration['start_column']
+    tuning_configuration['stop_column'] = scan_configuration['stop_column']
+    tuning_configuration['start_row'] = scan_configuration['start_row']
+    tuning_configuration['stop_row'] = scan_configuration['stop_row']
+
+    for key in tuning_configuration:
+        tuning_configuration_sync[key] = tuning_configuration[key]
+        tuning_configuration_lin_diff[key] = tuning_configuration[key]
+
+    tuned = {}
+    if tuning_configuration_sync['stop_column'] > 128:
+        tuning_configuration_sync['stop_column'] = 128
+    if tuning_configuration_sync['start_column'] < 128:
+        tune_front_end('sync', tuning_configuration_sync, tuned, cache, module, temperature)
+        tuning_configuration_lin_diff['use_default_chip_configuration'] = False
+
+    if tuning_configuration_lin_diff['start_column'] < 128:
+        tuning_configuration_lin_diff['start_column'] = 128
+    if tuning_configuration_lin_diff['stop_column'] > 128:
+        tune_front_end('lin_diff', tuning_configuration_lin_diff, tuned, cache, module, temperature)
+
+    return raw_data_files, tuned
+
+
+def bump_status_file(cycle):
+    return os.path.join(BUMP_STATUS_PATH, 'cycle_{0:04d}.npy'.format(cycle))
+
+
+def archive_campaign_files(started):
+    ''' Move the bump status maps and bump history of the previous campaign aside, named by its start time. '''
+    for path in (BUMP_STATUS_PATH, BUMP_HISTORY_FILE):
+        if os.path.exists(path):
+            root, ext = os.path.splitext(path)
+            suffix = time.strftime('_%Y%m%d_%H%M%S', time.localtime(started if started is not None else os.path.getmtime(path)))
+            os.rename(path, root + suffix + ext)
+            logging.info('Moved {0} of the previous campaign to {1}'.format(path, root + suffix + ext))
+
+
+def take_bump_scan_data(cycle, scan_bench, tuned):
+    '''
+    Bump connectivity scans of one cycle. Without a result of the previous cycle the whole matrix is scanned with
+    full statistics. Otherwise a fast survey of the whole matrix is done and only the regions which were marginal or
+    disconnected before or changed in the survey are scanned with full statistics.
+    Returns the survey status, the scanned regions and their raw data files.
+    '''
+    from bdaq53.scans.scan_disconnected_bumps_threshold import BumpConnThrShScan
+
+    config = dict(scan_configuration)
+    if tuned:
+        config['chip'] = {'registers': tuned}
+    previous_status_file = bump_status_file(cycle - 1)
+    if not INCREMENTAL_SCANS or not os.path.isfile(previous_status_file) or (FULL_SCAN_INTERVAL > 0 and cycle % FULL_SCAN_INTERVAL == 0):
+        status = np.full((400, 192), NOT_SCANNED, dtype=np.int8)
+        regions = [(config['start_column'], config['stop_column'], config['start_row'], config['stop_row'])]
+    else:
+        last_status = np.load(previous_status_file)
+        with BumpConnThrShScan(scan_config=dict(config, **SURVEY_CONFIGURATION)) as survey:
+            survey.start()
+            status = bump_status(survey.output_filename + '_interpreted.h5', DISCONNECTED_SHIFT, MARGINAL_SHIFT)
+        of_interest = np.isin(last_status, (MARGINAL, DISCONNECTED)) | np.isin(status, (MARGINAL, DISCONNECTED)) | (status != last_status)
+        regions = roi_regions(of_interest, padding=ROI_PADDING)
+        logging.info('Survey found {0} pixels of interest, scanning {1} regions with full statistics'.format(np.count_nonzero(of_interest), len(regions)))
+
+    raw_data_files = []
+    for start_column, stop_column, start_row, stop_row in regions:
+        region_config = dict(config, start_column=start_column, stop_column=stop_column, start_row=start_row, stop_row=stop_row)
+        with BumpConnThrShScan(scan_config=region_config, bench_config=scan_bench) as disconn_bumps_scan:
+            disconn_bumps_scan.start()
+            raw_data_files.append(disconn_bumps_scan.output_filename + '.h5')
+    return status, regions, raw_data_files
+
+
+def power_off_module(periphery, module):
+    ''' The scans open the periphery themselves, so the connection is only held while powering off. '''
+    periphery.init()
     try:
-        slack = WebClient(token)
-        for user in bench['notifications']['slack_users']:
-            slack.chat_postMessage(channel=user, text=message, username='BDAQ53 Bot', icon_emoji=':robot_face:')
-    except Exception as e:
-        logging.error('Notification error: {0}'.format(e))
-
-def acquire_temperatures():
-    global dut
-
-    t_chamber = dut['Climatechamber'].get_temperature()
-    setpoint = dut['Climatechamber'].get_temperature_setpoint()
-    t_sens = dut['Thermohygrometer'].get_temperature(channel=0)
-    h_sens = dut['Thermohygrometer'].get_humidity(channel=0)
-    t_mod = dut['Thermohygrometer'].get_temperature(channel=1)
-    h_mod = dut['Thermohygrometer'].get_humidity(channel=1)
-    t_air = dut['Thermohygrometer'].get_temperature(channel=3)
-    h_air = dut['Thermohygrometer'].get_humidity(channel=3)
+        periphery.power_off_module(module)
+    finally:
+        periphery.close()
+
+
+def check_analyses(analyses, wait=False):
+    ''' Report finished background analyses and remove them from the list. '''
+    for cycle, name, future in analyses[:]:
+        if not wait and not future.done():
+            continue
+        try:
+            logging.info('Analyzed {0} of cycle {1}: {2}'.format(name, cycle, future.result()))
+        except MissingThresholdShift:
+            analyses.remove((cycle, name, future))
+            raise
+        except Exception as e:
+            logging.error('Analysis of {0} failed for cycle {1}: {2}'.format(name, cycle, e))
+            notify('ERROR: Analysis failed for cycle {0}: {1}'.format(cycle, e))
+        analyses.remove((cycle, name, future))
 
-    try:
-        logging.debug('T_ch = {0:1.2f}, T_sns = {1:1.2f}, Hum_sns = {2:1.2f}, T_mod = {3:1.2f}, H_mod = {4:1.2f}, T_air = {5:1.2f}, H_air = {6:1.2f}'.format(t_chamber, t_sens, h_sens, t_mod, h_mod, t_air, h_air))
-        with open(OUTFILE_TEMPS, 'a') as f:
-            f.write('{0}, {1}, {2:1.2f}, {3:1.2f}, {4:1.2f}, {5:1.2f}, {6:1.2f}, {7:1.2f}, {8:1.2f}\n'.format(time.time(), setpoint, t_chamber, t_sens, h_sens, t_mod, h_mod, t_air, h_air))
-    except TypeError:
-        logging.debug('T_ch = {0:1.2f}, T_sns = {1}, H_sns = {2}, T_mod = {3}, H_mod = {4}, T_air = {5}, Hum_air = {6}'.format(t_chamber, t_sens, h_sens, t_mod, h_mod, t_air, h_air))
-        with open(OUTFILE_TEMPS, 'a') as f:
-            f.write('{0}, {1}, {2:1.2f}, {3}, {4}, {5}, {6}, {7}, {8}\n'.format(time.time(), setpoint, t_chamber, t_sens, h_sens, t_mod, h_mod, t_air, h_air))
-
-    return t_chamber, t_sens, h_sens, t_mod, h_mod, t_air, h_air
-
-def go_to_temperature(target, wait_time=0, overshoot=False, accuracy=1, timeout=30*60):
-    global dut
-
-    if overshoot:
-        if target > 0:
-            set_target = target + 5
-        else:
-            set_target = target - 10
-    else:
-        set_target = target
-
-    dut['Climatechamber'].set_temperature(set_target)
-    timestamp_start = time.time()
-    while True:
-        _, t_sens, _, _, _, _, h_air = acquire_temperatures()
-        # TODO interlock on air humidity?
-        if t_sens is not None and t_sens > (target - accuracy) and t_sens < (target + accuracy):
-            logging.info('Target temperature reached on device!')
-            break
-        if time.time() - timestamp_start > timeout:
-            raise RuntimeError('Target temperature could not be reached within specified timeout!')
-
-    dut['Climatechamber'].set_temperature(target)
-    if wait_time > 0:
-        logging.info('Waiting for {0:1.0f}s at {1}°C...'.format(wait_time, target))
-        timestamp_start = time.time()
-        while True:
-            _, t_sens, _, _, _, _, h_air = acquire_temperatures()
-            # TODO interlock on air humidity?
-            if t_sens is not None and (t_sens < (target - accuracy) or t_sens > (target + accuracy)):
-                logging.warning('Temperature on device deviated too much: Target = {0}, T_sens = {1:1.2f}'.format(target, t_sens))
-            if time.time() - timestamp_start > wait_time:
-                logging.info('Wait time over. Continuing...')
-                break
 
 if __name__ == '__main__':
+    from bdaq53.system.periphery import BDAQ53Periphery
+
+    setup_logging()
     with open(TESTBENCH) as f:
         bench = yaml.safe_load(f)
+    # The chip scans only take data, analysis and plotting are done by the process pool
+    scan_bench = copy.deepcopy(bench)
+    scan_bench.setdefault('analysis', {})['skip'] = True
 
     if not os.path.isfile(OUTFILE_TEMPS):
         # Reset data file
         with open(OUTFILE_TEMPS, 'w') as f:
             f.write('#Timestamp, T_setpoint, T_chamber, T_sens, Hum_sens, T_mod, Hum_mod, T_air, Hum_air\n')
 
-    dut = Dut('thermocycling.yaml')
+    io_metrics = IOMetrics()
+    if IO_METRICS_PORT is not None:
+        io_metrics.serve(IO_METRICS_PORT)
+    atexit.register(io_metrics.finish, IO_METRICS_FILE)
+    dut = InstrumentedDut(create_dut('thermocycling.yaml'), io_metrics)
     dut.init()
+    ctrl = CycleController(dut, setup_sensors(dut), OUTFILE_TEMPS, t_sens='t_sens', timeout=30 * 60,
+                           sample_period=SAMPLE_PERIOD, log_period=LOG_PERIOD, sample_log_level=logging.DEBUG)
+    if TELEMETRY_PORT is not None or TELEMETRY_SOCKET is not None:
+        telemetry = TelemetryServer(attach(ctrl, int(TELEMETRY_HISTORY / SAMPLE_PERIOD)), port=TELEMETRY_PORT, unix_socket=TELEMETRY_SOCKET)
+        atexit.register(telemetry.close)
+
+    module = next(iter(bench['modules']))
+    module_sn = bench['modules'][module].get('identifier', module)
+    # One cycle (with the temperature reset before the scans), repeated until stopped
+    campaign = CampaignState.campaign([module_sn], [{'n_cycles': 1, 'temps': (T_MIN, T_MAX, 20), 'wait_time': WAIT_TIME}])
+    state = CampaignState(STATEFILE)
+    if not RESUME or not state.resumable(campaign):
+        if RESUME and state['started'] is not None:
+            logging.warning('State file belongs to another campaign ({0}), starting a new campaign'.format(state['campaign']))
+        archive_campaign_files(state['started'])
+        state.reset(campaign)
+    else:
+        logging.info('Resuming campaign after {0} completed cycles and {1} steps'.format(state['completed_cycles'], state['step']))
+    ctrl.add_callback('data_logged', lambda **_: state.record_dew_point(ctrl.dew_point_margin(), 0))
 
-    logging.info('Starting run, setting start temperature to 20C...')
     dut['Climatechamber'].start_manual_mode()
     dut['Climatechamber'].set_air_dryer(True) # make sure air dryer is running to avoid condensation
-    go_to_temperature(20, wait_time=3*60*60)  # wait 3h at 20°C to make sure the air is dry
+    if state.dry_out_needed(DRY_OUT_MAX_AGE):
+        logging.info('Starting run, setting start temperature to 20C...')
+        state.update(phase='dry-out', dried=False)
+        ctrl.go_to_temperature(20, wait_time=3*60*60)  # wait 3h at 20°C to make sure the air is dry
+        state.update(dried=True)
+    else:
+        logging.info('Chamber was dry until {0}, skipping dry-out'.format(time.strftime('%H:%M:%S', time.localtime(state['updated']))))
 
     # Make sure chip is powered off before starting cycle
-    periphery = BDAQ53Periphery()
-    periphery.init()
-    periphery.power_off_module(next(iter(bench['modules'])))
-    periphery.close()
+    periphery = BDAQ53Periphery()  # created once, its configuration is not reloaded every cycle
+    power_off_module(periphery, module)
+
+    steps = [('Cooling to {}'.format(T_MIN), T_MIN, WAIT_TIME, overshoot(T_MIN)),
+             ('Heating to {}'.format(T_MAX), T_MAX, WAIT_TIME, overshoot(T_MAX)),
+             ('Resetting temperature to 20C', 20, 15*60, 0)]
+    # When resuming before the scans, the temperature reset is repeated to have stable conditions
+    first_step = min(state['step'], len(steps) - 1)
+    state.update(step=first_step)
+
+    if not os.path.exists(BUMP_STATUS_PATH):
+        os.makedirs(BUMP_STATUS_PATH)
+    tuning_cache = TuningCache(TUNING_CACHE)
+    bump_history = BumpHistory(BUMP_HISTORY_FILE)
 
     total_time_start = time.time()
+    # Workers are spawned so they do not inherit the hardware connections
+    pool = ProcessPoolExecutor(ANALYSIS_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    analyses = []
+    shift_checked = False  # the first bump analysis of the run is waited for, to find a wrong THRESHOLD_SHIFT_NODE at once
     try:
-        cycle = CYCLE_START
+        cycle = state['completed_cycles'] + 1
         while True:
             logging.info('Starting cycle {}'.format(cycle))
             notify('Starting cycle {}'.format(cycle))
-            logging.info('Cooling to {}'.format(T_MIN))
-            go_to_temperature(T_MIN, wait_time=WAIT_TIME, overshoot=True)
-            logging.info('Heating to {}'.format(T_MAX))
-            go_to_temperature(T_MAX, wait_time=WAIT_TIME, overshoot=True)
-            logging.info('Resetting temperature to 20C')
-            go_to_temperature(20, wait_time=15*60)
+            for message, target, wait_time, offset in steps[first_step:]:
+                logging.info(message)
+                state.update(phase='cycle {0}: {1}°C'.format(cycle, target))
+                ctrl.go_to_temperature(target, wait_time=wait_time, overshoot=offset)
+                state.complete_step()
+            first_step = 0
 
             logging.info('Starting bump connectivity scans for cycle {}...'.format(cycle))
+            state.update(phase='cycle {0}: scans'.format(cycle))
             notify('Starting bump connectivity scans for cycle {}...'.format(cycle))
             try:
-                with AnalogScan(scan_config={'use_default_chip_configuration': True}) as scan:
-                    scan.start()
-
-                tuning_configuration['start_column'] = scan_configuration['start_column']
-                tuning_configuration['stop_column'] = scan_configuration['stop_column']
-                tuning_configuration['start_row'] = scan_configuration['start_row']
-                tuning_configuration['stop_row'] = scan_configuration['stop_row']
-
-                for key in tuning_configuration:
-                    tuning_configuration_sync[key] = tuning_configuration[key]
-                    tuning_configuration_lin_diff[key] = tuning_configuration[key]
-
-                if tuning_configuration_sync['stop_column'] > 128:
-                    tuning_configuration_sync['stop_column'] = 128
-                if tuning_configuration_sync['start_column'] < 128:
-                    with GDACTuning(scan_config=tuning_configuration_sync) as global_tuning:
-                        global_tuning.start()
-                    tuning_configuration_lin_diff['use_default_chip_configuration'] = False
-
-                if tuning_configuration_lin_diff['start_column'] < 128:
-                    tuning_configuration_lin_diff['start_column'] = 128
-                if tuning_configuration_lin_diff['stop_column'] > 128:
-                    with GDACTuning(scan_config=tuning_configuration_lin_diff) as global_tuning:
-                        global_tuning.start()
-
-                with BumpConnThrShScan(scan_config=scan_configuration) as disconn_bumps_scan:
-                    disconn_bumps_scan.start()
+                temperature = ctrl.last_values['t_sens'] if ctrl.last_values['t_sens'] is not None else 20
+                raw_data_files, tuned = take_scan_data(scan_bench, tuning_cache, module_sn, temperature)
+                check_analyses(analyses, wait=True)  # the bump scans depend on the result of the last cycle
+                if bump_history.update(BUMP_STATUS_PATH):
+                    logging.info('{0} disconnected bumps after cycle {1}'.format(bump_history.failures_per_cycle()[-1], bump_history.cycles[-1]))
+                status, regions, bump_raw_data_files = take_bump_scan_data(cycle, scan_bench, tuned)
             except RuntimeError:
                 logging.error('Bump connectivity scan failed for cycle {}!'.format(cycle))
                 notify('ERROR: Bump connectivity scan failed for cycle {}!'.format(cycle))
                 break
             finally:
-                periphery = BDAQ53Periphery()
-                periphery.init()
-                periphery.power_off_module(next(iter(bench['modules'])))
-                periphery.close()
+                power_off_module(periphery, module)
+
+            create_pdf = bench.get('analysis', {}).get('create_pdf', True)
+            for raw_data_file in raw_data_files:
+                analyses.append((cycle, os.path.basename(raw_data_file), pool.submit(analyze_scan, raw_data_file, create_pdf)))
+            analyses.append((cycle, 'bump connectivity scans', pool.submit(analyze_bump_scans, status, bump_raw_data_files, regions, bump_status_file(cycle),
+                                                                          DISCONNECTED_SHIFT, MARGINAL_SHIFT, create_pdf)))
+            check_analyses(analyses, wait=not shift_checked)
+            shift_checked = True
 
+            state.complete_cycle()
             cycle += 1
     except KeyboardInterrupt:
         logging.error('Scan stopped manually!')
+    except MissingThresholdShift as e:
+        logging.error('Stopping campaign, bump status can not be analyzed: {0}'.format(e))
+        notify('ERROR: Stopping campaign, bump status can not be analyzed: {0}'.format(e))
     finally:
         logging.info('Closing up. Setting temperature to 20°C.')
         dut['Climatechamber'].set_temperature(20)
 
-    go_to_temperature(20)
+    ctrl.go_to_temperature(20)
+    logging.info('Waiting for {0} analyses to finish...'.format(len(analyses)))
+    check_analyses(analyses, wait=True)
+    pool.shutdown()
+    bump_history.update(BUMP_STATUS_PATH)
     total_time = time.time() - total_time_start
     logging.info('Completed {0} cycles in {1:1.2f}h'.format(cycle, total_time / 3600))
+    ctrl.log_statistics()
     dut['Climatechamber'].stop_manual_mode()
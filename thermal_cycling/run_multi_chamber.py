@@ -0,0 +1,123 @@
+'''
+    Runs the QC thermal cycling (see run_thermocycling_QC.py) on several climate chambers from one process.
+
+    Every setup gets its own periphery, controller, schedule, data file, log file and interlock and runs in
+    its own thread. A status table of all setups is logged regularly. The periphery files have to use the
+    driver names of thermocycling_QC.yaml, since the sensor table of run_thermocycling_QC.py is used.
+'''
+
+import os
+import atexit
+import logging
+import threading
+
+import _paths  # noqa: F401 (shared instrument code in the repository root)
+import run_thermocycling_QC as qc
+from cycle_controller import CycleController, RunStopped
+from campaign_state import CampaignState
+from telemetry import TelemetryServer, attach
+from instruments.io_metrics import IOMetrics, InstrumentedDut
+from instruments.simulation import create_dut
+
+# One entry per chamber: name (used for output folder and log), periphery file, cycle schedule and module names
+setups = [
+    {'name': 'chamber_1', 'periphery': 'thermocycling_QC.yaml', 'cycles': qc.cycles, 'modules': qc.modules},
+    # {'name': 'chamber_2', 'periphery': 'thermocycling_QC_2.yaml', 'cycles': qc.cycles, 'modules': []},
+]
+status_interval = 5 * 60  # time between two status printouts in s
+
+LOGFILE = os.path.join(qc.OUTPATH, qc.time_str + 'multi_chamber.log')
+
+
+class ChamberRun(threading.Thread):
+    def __init__(self, name, periphery, cycles, io_metrics, modules=()):
+        super(ChamberRun, self).__init__(name=name, daemon=True)
+        self.cycles = cycles
+        self.modules = list(modules)
+        self.error = None
+
+        outpath = os.path.join(qc.OUTPATH, name)
+        if not os.path.exists(outpath):
+            os.makedirs(outpath)
+        self.outfile = os.path.join(outpath, qc.time_str + 'thermocycling_temps.dat')
+        self.state = CampaignState(os.path.join(outpath, qc.STATEFILE)) if qc.resume else None  # new state in run_thermocycling
+
+        # Own log file per setup, messages also propagate to the common log
+        self.log = logging.getLogger(name)
+        fh = logging.FileHandler(os.path.join(outpath, qc.time_str + 'thermocycling.log'), mode='w')
+        fh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)-7s %(message)s'))
+        self.log.addHandler(fh)
+
+        self.dut = InstrumentedDut(create_dut(os.path.join(qc.FILEPATH, periphery)), io_metrics, prefix=name + '.')
+        self.dut.init()
+        self.sensors = qc.setup_sensors(self.dut)
+        self.ctrl = CycleController(self.dut, self.sensors, self.outfile, t_sens=qc.t_sens, air_sens=qc.air_sens, mod_sens=qc.mod_sens,
+                                    interlock_dp=qc.interlock_dp, min_interlock_distance=qc.min_interlock_distance,
+                                    interlock_hysteresis=qc.interlock_hysteresis, interlock_debounce=qc.interlock_debounce,
+                                    sample_period=qc.sample_period, log_period=qc.log_period, log=self.log)
+        self.ctrl.add_callback('dew_point_violation', lambda **_: self.notify('Dew point interlock triggered, holding temperature!'))
+        self.telemetry = attach(self.ctrl, int(qc.telemetry_history / qc.sample_period))
+
+    def notify(self, message):
+        qc.notify('{0}: {1}'.format(self.name, message))
+
+    def run(self):
+        try:
+            qc.write_header(self.outfile, self.sensors, self.modules)
+            qc.run_thermocycling(self.ctrl, cycles=self.cycles, notify=self.notify, state=self.state,
+                                 modules=self.modules)
+        except RunStopped:
+            self.ctrl.phase = 'stopped'
+            self.log.warning('Thermal cycling stopped manually')
+        except Exception as e:
+            self.error = e
+            self.ctrl.phase = 'error'
+            self.log.exception('Thermal cycling failed: {0}'.format(e))
+        finally:
+            self.dut.close()
+
+
+def log_status(runs):
+    def fmt(value):
+        return '{0:8.2f}'.format(value) if value is not None else '{0:>8}'.format('None')
+
+    lines = ['{0:<15} {1:<25} {2:>8} {3:>8} {4:>8}'.format('setup', 'phase', 'T_sens', 'T_setp', 'dp')]
+    for run in runs:
+        values = run.ctrl.last_values
+        lines.append('{0:<15} {1:<25} {2} {3} {4}'.format(run.name, run.ctrl.phase, fmt(values.get(qc.t_sens)),
+                                                           fmt(values.get('t_setp')), fmt(values.get(qc.interlock_dp))))
+    logging.info('Status:\n' + '\n'.join(lines))
+
+
+if __name__ == '__main__':
+    qc.setup_logging(LOGFILE, fmt='%(asctime)s - %(name)-10s %(levelname)-7s %(message)s')
+    qc.setup_slack()
+    qc.notify('Starts thermal cycles on {0} chambers!'.format(len(setups)))
+
+    io_metrics = IOMetrics()
+    if qc.io_metrics_port is not None:
+        io_metrics.serve(qc.io_metrics_port)
+    atexit.register(io_metrics.finish, qc.IO_METRICS_FILE)
+    runs = [ChamberRun(io_metrics=io_metrics, **setup) for setup in setups]
+    if qc.telemetry_port is not None or qc.telemetry_socket is not None:
+        # One endpoint for all setups, selected with ?setup=name
+        telemetry = TelemetryServer({run.name: run.telemetry for run in runs}, port=qc.telemetry_port, unix_socket=qc.telemetry_socket)
+        atexit.register(telemetry.close)
+    for run in runs:
+        run.start()
+
+    try:
+        while any(run.is_alive() for run in runs):
+            log_status(runs)
+            next(run for run in runs if run.is_alive()).join(timeout=status_interval)
+    except KeyboardInterrupt:
+        logging.warning('Stopped manually, closing up all chambers...')
+        for run in runs:
+            run.ctrl.stop()
+        for run in runs:
+            run.join()
+
+    log_status(runs)
+    for run in runs:
+        if run.error is not None:
+            logging.error('{0} failed: {1}'.format(run.name, run.error))
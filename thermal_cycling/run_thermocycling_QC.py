@@ -1,10 +1,28 @@
+'''
+    QC thermal cycling of modules in one climate chamber: dry-out at the starting temperature, then the cycles schedule
+    with overshoot planned by the setpoint model, interlocked against the dew point.
+
+    The schedule can also run as ramp/soak program (program_mode, see chamber_program.py). On real hardware only
+    'host' works, the basil weiss_labevent driver has no program mode, 'chamber' needs the simulated chamber.
+'''
+
 import time
+import atexit
 import logging
 import numpy as np
 import os
+from glob import glob
 
-from basil.dut import Dut
-from slack import WebClient
+from cycle_controller import CycleController, RunStopped
+from setpoint_model import SetpointModel
+from campaign_state import CampaignState
+from chamber_program import HostProgram, compile_program, program_segments, program_duration
+from notifications import Notifier
+from telemetry import TelemetryServer, attach
+
+import _paths  # noqa: F401 (shared instrument code in the repository root)
+from instruments.io_metrics import IOMetrics, InstrumentedDut
+from instruments.simulation import create_dut
 
 time_str = time.strftime('%Y%m%d_%H%M%S_')
 FILEPATH = os.path.dirname(os.path.abspath(__file__))
@@ -15,6 +33,8 @@ if not os.path.exists(OUTPATH):
 PERIPHERYFILE = os.path.join(FILEPATH, 'thermocycling_QC.yaml')
 LOGFILE = os.path.join(OUTPATH, time_str + 'thermocycling.log')
 OUTFILE_TEMPS = os.path.join(OUTPATH, time_str + 'thermocycling_temps.dat')
+IO_METRICS_FILE = os.path.join(OUTPATH, time_str + 'io_metrics.prom')
+STATEFILE = 'campaign_state.json'  # in output folder, not renewed on restart
 
 cycles = np.array([
     (2, (-45, 40), 2 * 60),
@@ -26,19 +46,41 @@ starting_dew_point = -25
 minimal_starting_time = 1 * 60 * 60
 maximal_starting_time = 3 * 60 * 60
 save_data_on_startup = True
+modules = []  # names of the modules in the chamber, written to the data file header for the QC dossiers
+resume = True  # continue an unfinished campaign from the state file (same modules and cycles) instead of starting a new one
+dry_out_max_age = 30 * 60  # skip dry-out on resume if the state file showed a dry chamber within this time in s
 
 t_sens = 't_mod2'  # temperature sensor which has reach set temperature
 air_sens = ['air2', 'sens', 'chamber']  # sensors (without t_/h_) measuring air temperature (used to calculate dew point)
 mod_sens = ['mod', 'mod2']  # sensors (without t_/h_) that measure temps of modules (used for interlocking)
 interlock_dp = 'dew_point'  # name of the value which stores the dew point used for interlocking
 min_interlock_distance = 5  # how much the interlock dew point must be under lowest module temperature
+interlock_hysteresis = 2  # additional distance needed to release the interlock
+interlock_debounce = 3  # consecutive samples needed to activate or release the interlock
+sample_period = 1  # time between two sensor readouts (and interlock checks) in s
+log_period = 10  # minimal time between two entries in log and data file in s
+io_metrics_port = None  # serve instrument I/O statistics (Prometheus text format) on this local port
+telemetry_port = None  # serve the latest samples from memory (see telemetry.py) on this local port
+telemetry_socket = None  # or on this unix socket
+telemetry_history = 24 * 60 * 60  # time span of the samples kept in memory in s
+
+use_setpoint_model = True  # plan overshoot with a model learned from previous data files, fixed overshoot otherwise
+model_history = 5  # number of latest data files used to learn the model
+setpoint_limits = (-65, 70)  # min./max. chamber setpoint during transitions
+max_overshoot = 15  # max. distance between chamber setpoint and target temperature
+
+program_mode = None  # None: setpoints sent by the control loop, 'host': run the schedule as program with HostProgram,
+                     # 'chamber': upload it as program of the chamber (only the simulation, weiss_labevent has no program mode)
+program_settle_time = 30 * 60  # time in s the modules get to reach a target in a program (plus the planned transition time)
+program_ramp_rate = None  # setpoint ramp in K/s of program steps without overshoot, as fast as possible if None
 
 notify_on_slack = False
 slack_token = "~/slack_api_token"
 slack_users = []
+notifier = None
 
 
-def setup_sensors():
+def setup_sensors(dut):
     return np.array([
         ('t_chamber', 't_ch', dut['Climatechamber'].get_temperature, {}),
         ('t_setp', 't_sp', dut['Climatechamber'].get_temperature_setpoint, {}),
@@ -62,174 +104,229 @@ def setup_sensors():
     # short names are used in log file (when None, it does not get printed there)
 
 
-# Logging setup
-for handler in logging.root.handlers[:]:
-    logging.root.removeHandler(handler)
-fmt = '%(asctime)s - %(levelname)-7s %(message)s'
-logging.basicConfig(format=fmt, filename=LOGFILE, filemode='w', level=logging.INFO)
-sh = logging.StreamHandler()
-sh.setFormatter(logging.Formatter(fmt))
-logging.root.addHandler(sh)
-
-
-def acquire_temperatures(save_data=True):
-    temperatures = {s['name']: s['f'](**s['kwargs']) for s in sensors}
-    temperatures[interlock_dp] = get_dew_point(temperatures)
-
-    if save_data:
-        logging.info(", ".join([f'{key.capitalize()} = {value:1.2f}' if value is not None else f'{key.capitalize()} = None'
-                                for key, value in zip(sensors['short'], temperatures.values()) if key != 'None']))
-        with open(OUTFILE_TEMPS, 'a') as f:
-            f.write('{0}, '.format(time.time())
-                    + ', '.join([f'{value:1.2f}' if value is not None else 'None'
-                                 for value in temperatures.values()])
-                    + '\n')
-
-    return temperatures
-
-
-def get_temps(values, sensors):
-    return [v for k, v in values.items() if k.startswith('t') and any(k.endswith(s) for s in sensors) and v is not None]
-
-
-def get_humiditys(values, sensors):
-    return [v for k, v in values.items() if k.startswith('h') and any(k.endswith(s) for s in sensors) and v is not None]
-
-
-def get_dew_point(values):
-    # Formula by Sensirion:
-    # http://irtfweb.ifa.hawaii.edu/~tcs3/tcs3/Misc/Dewpoint_Calculation_Humidity_Sensor_E.pdf
-    temps = get_temps(values, air_sens)
-    humids = get_humiditys(values, air_sens)
-    T = max(temps)
-    RH = max(humids)
-    if RH == 0:
-        return float('nan')
-    H = (np.log10(RH) - 2) / 0.4343 + (17.62 * T) / (243.12 + T)
-    Dp = 243.12 * H / (17.62 - H)
-    return Dp
-
-
-def temps_below_dp(values, sensors, min_distance):
-    return not np.isnan(values[interlock_dp]) and any(v < values[interlock_dp] + min_distance for v in get_temps(values, sensors))
-
-
-def wait_for_min_dew_point(distance, timeout=60 * 60, save_data=True):
-    timestamp_start = time.time()
-    values = acquire_temperatures(save_data=save_data)
-    while temps_below_dp(values, mod_sens, distance):
-        values = acquire_temperatures(save_data=save_data)
-        if time.time() - timestamp_start > timeout:
-            raise RuntimeError('Target dew point could not be reached within specified timeout!')
-    logging.info('Target dew point reached!')
-
-
-def check_interlock(values, distance=min_interlock_distance, sleep_time=.2, save_data=True):
-    if temps_below_dp(values, mod_sens, distance):
-        # whait at current temperature till all tempertures are stabilized and dew point is low again
-        target = dut['Climatechamber'].get_temperature_setpoint()
-        cur_temp = dut['Climatechamber'].get_temperature()
-        dut['Climatechamber'].set_temperature(cur_temp)
-        wait_for_min_dew_point(distance, save_data=save_data)
-        dut['Climatechamber'].set_temperature(target)
-
-
-def go_to_temperature(target, wait_time=0, overshoot=0, accuracy=1, timeout=60*60, save_data=True, interlock=True):
-    set_target = target + overshoot
-
-    dut['Climatechamber'].set_temperature(set_target)
-    timestamp_start = time.time()
-    while True:
-        temps = acquire_temperatures(save_data=save_data)
-        temps[interlock_dp] = get_dew_point(temps)
-        if interlock:
-            check_interlock(temps)
-        if temps[t_sens] is not None and temps[t_sens] > (target - accuracy) and temps[t_sens] < (target + accuracy):
-            logging.info('Target temperature reached on device!')
-            break
-        if time.time() - timestamp_start > timeout:
-            raise RuntimeError('Target temperature could not be reached within specified timeout!')
-
-    dut['Climatechamber'].set_temperature(target)
-    if wait_time > 0:
-        logging.info('Waiting for {0:1.0f}s at {1}°C...'.format(wait_time, target))
-        timestamp_start = time.time()
-        while True:
-            temps = acquire_temperatures(save_data=save_data)
-            temps[interlock_dp] = get_dew_point(temps)
-            if interlock:
-                check_interlock(temps, save_data=save_data)
-            if temps[t_sens] is not None and (temps[t_sens] < (target - accuracy) or temps[t_sens] > (target + accuracy)):
-                logging.warning(f'Temperature on device deviated too much: Target = {target}, T_sens = {temps[t_sens]:1.2f}')
-            if time.time() - timestamp_start > wait_time:
-                logging.info('Wait time over. Continuing...')
-                break
-
+def setup_logging(logfile, fmt='%(asctime)s - %(levelname)-7s %(message)s'):
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+    logging.basicConfig(format=fmt, filename=logfile, filemode='w', level=logging.INFO)
+    sh = logging.StreamHandler()
+    sh.setFormatter(logging.Formatter(fmt))
+    logging.root.addHandler(sh)
 
-def setup_slack():
-    global slack
-    if notify_on_slack:
-        if os.path.isfile(os.path.expanduser(slack_token)):
-            with open(os.path.expanduser(slack_token), 'r') as token_file:
-                token = token_file.read().strip()
-        else:
-            token = slack_token
-        slack = WebClient(token)
 
-
-def notify(message):
-    if notify_on_slack:
-        for user in slack_users:
-            slack.chat_postMessage(channel=user, text=message, username='Thermocycle Bot', icon_emoji=':robot_face:')
+def write_header(outfile, sensors, modules=modules):
+    with open(outfile, 'w') as f:
+        f.write('#Timestamp, ' + ', '.join([s['name'] for s in sensors] + [interlock_dp]) + ', ' + '\n')
+        if modules:
+            f.write('#Modules: ' + ', '.join(modules) + '\n')
 
 
-if __name__ == '__main__':
+def fit_setpoint_model(outpath=OUTPATH, log=logging.root):
+    if not use_setpoint_model:
+        return None
+    files = sorted(glob(os.path.join(outpath, '*_thermocycling_temps.dat')))[-model_history:]
+    try:
+        model = SetpointModel.from_files(files, t_sens)
+    except (ValueError, OSError) as e:
+        log.warning('Could not learn setpoint model, using fixed overshoot: {0}'.format(e))
+        return None
+    log.info('Learned {0}'.format(model))
+    return model
 
-    setup_slack()
-    notify("Starts thermal cycles!")
 
-    dut = Dut(PERIPHERYFILE)
-    dut.init()
-    sensors = setup_sensors()
+def setup_slack():
+    global notifier
+    if notify_on_slack and notifier is None:
+        # Messages are posted by a background thread, a slow network never delays the control loop
+        notifier = Notifier(slack_token, slack_users, username='Thermocycle Bot')
+        atexit.register(notifier.close)
 
-    with open(OUTFILE_TEMPS, 'w') as f:
-        f.write('#Timestamp, ' + ', '.join([s['name'] for s in sensors] + [interlock_dp]) + ', ' + '\n')
 
-    logging.info('Starting run, setting start temperature to 20C...')
-    dut['Climatechamber'].start_manual_mode()
-    dut['Climatechamber'].set_air_dryer(True)  # make sure air dryer is running to avoid condensation
+def notify(message):
+    if notifier is not None:
+        notifier.notify(message)
+
+
+def check_program_mode(chamber, program_mode):
+    ''' Fail before the dry-out if program_mode is unknown or the chamber driver can not run programs. '''
+    if program_mode not in (None, 'host', 'chamber'):
+        raise ValueError("Unknown program mode {0}, use None, 'host' or 'chamber'".format(program_mode))
+    if program_mode == 'chamber':
+        try:  # also works for drivers of an instrument server, which accept any method name
+            chamber.get_program_status()
+        except AttributeError:
+            raise ValueError("Program mode 'chamber' needs a chamber driver with program mode (e.g. the simulation), "
+                             "use 'host' with the weiss_labevent driver")
+
+
+def run_program(ctrl, program_runner, cycles, cur_temp, state, model=None):
+    '''
+    Run the remaining cycle schedule as ramp/soak program: compile it, upload and start it at once, then only sample,
+    pause the program while the interlock is active and save the progress. The setpoint model is learned once before
+    the upload. program_runner is the chamber driver itself or a HostProgram.
+    '''
+    log = ctrl.log
+    program = compile_program(cycles, cur_temp, model=model, setpoint_limits=setpoint_limits, max_overshoot=max_overshoot,
+                              settle_time=program_settle_time, ramp_rate=program_ramp_rate,
+                              completed_cycles=state['completed_cycles'], completed_steps=state['step'])
+    log.info('Uploading program with {0} segments, expected duration {1:1.1f}h'.format(len(program), program_duration(program) / 3600))
+    program_runner.upload_program(program_segments(program))
+    program_runner.start_program()
+    ctrl.program = program_runner
+    done = 0  # completed segments
+    try:
+        while done < len(program):
+            values = ctrl.sample()
+            ctrl.check_interlock(values)
+            if isinstance(program_runner, HostProgram):
+                program_runner.update()
+            status = program_runner.get_program_status()
+            for segment in program[done:status['segment']]:
+                if segment['end_of_step']:
+                    state.complete_step()
+                if segment['end_of_cycle']:
+                    state.complete_cycle()
+            done = max(done, status['segment'])
+            if done < len(program):
+                phase = 'cycle {0}: {1:g}°C'.format(program['cycle'][done], program['target'][done])
+                if phase != ctrl.phase:
+                    log.info('Program segment {0}: setpoint {1:1.1f}°C for {2:1.0f}min'.format(
+                        done, program['setpoint'][done], (program['ramp'][done] + program['soak'][done]) / 60))
+                    ctrl.phase = phase
+                    state.update(phase=ctrl.phase)
+                if not status['running']:
+                    raise RuntimeError('Chamber program stopped in segment {0}!'.format(done))
+    finally:
+        ctrl.program = None
+        if done < len(program):
+            program_runner.stop_program()
+
+
+def run_thermocycling(ctrl, cycles=cycles, notify=notify, state=None, program_mode=program_mode, modules=modules):
+    '''
+    Dry out at starting temperature and run the cycle schedule with the given controller.
+    With a CampaignState of the same modules and cycles the run is resumed after the last completed step,
+    the progress is saved after every step.
+    With program_mode the schedule is run as chamber program (see run_program).
+    '''
+    check_program_mode(ctrl.chamber, program_mode)
+    log = ctrl.log
+    outpath = os.path.dirname(ctrl.outfile)
+    campaign = CampaignState.campaign(modules, cycles)
+    if state is None:
+        state = CampaignState(os.path.join(outpath, STATEFILE))
+        state.reset(campaign)
+    elif not state.resumable(campaign):
+        if not state.finished and state['started'] is not None:
+            previous = state['campaign'] or {}
+            log.warning('State file belongs to another campaign (modules {0}, schedule {1}), starting a new campaign'.format(
+                previous.get('modules'), previous.get('schedule')))
+        state.reset(campaign)
+    else:
+        log.info('Resuming campaign after {0} completed cycles and {1} steps'.format(state['completed_cycles'], state['step']))
+    ctrl.add_callback('data_logged', lambda **_: state.record_dew_point(ctrl.dew_point_margin(), min_interlock_distance))
+
+    ctrl.chamber.start_manual_mode()
+    ctrl.chamber.set_air_dryer(True)  # make sure air dryer is running to avoid condensation
     try:
-        go_to_temperature(starting_temperature, wait_time=minimal_starting_time, save_data=save_data_on_startup)
-        wait_for_min_dew_point(starting_temperature - starting_dew_point, timeout=maximal_starting_time - minimal_starting_time)
+        if state.dry_out_needed(dry_out_max_age):
+            log.info('Starting run, setting start temperature to 20C...')
+            ctrl.phase = 'dry-out'
+            state.update(phase=ctrl.phase, dried=False)
+            ctrl.go_to_temperature(starting_temperature, wait_time=minimal_starting_time, save_data=save_data_on_startup)
+            ctrl.wait_for_min_dew_point(starting_temperature - starting_dew_point, timeout=maximal_starting_time - minimal_starting_time)
+            state.update(dried=True)
+        else:
+            log.info('Chamber was dry until {0}, skipping dry-out'.format(time.strftime('%H:%M:%S', time.localtime(state['updated']))))
+            ctrl.wait_for_min_dew_point(min_interlock_distance, timeout=maximal_starting_time)
+    except RunStopped:
+        notify("Thermal cycling was stopped manually!")
+        raise
     except Exception:
         notify("Thermal cycling couldn't be started!")
         raise
 
     total_time_start = time.time()
-    cur_temp = starting_temperature
+    cur_temp = ctrl.sample()[t_sens]
+    if cur_temp is None:
+        cur_temp = starting_temperature
     next_iter = 1
     try:
-        for cycle in cycles:
-            for n_iter in range(next_iter, cycle['n_cycles'] + next_iter):
-                logging.info('Starting cycle {}'.format(n_iter))
-                for next_temp in cycle['temps']:
-                    if next_temp < cur_temp:
-                        logging.info('Cooling to {}'.format(next_temp))
-                        overshoot = -10
-                    else:
-                        logging.info('Heating to {}'.format(next_temp))
-                        overshoot = +5
-                    go_to_temperature(next_temp, wait_time=cycle['wait_time'], overshoot=overshoot)
-            next_iter += cycle['n_cycles']
+        if program_mode is not None:
+            program_runner = ctrl.chamber if program_mode == 'chamber' else HostProgram(ctrl.chamber)
+            run_program(ctrl, program_runner, cycles, cur_temp, state, model=fit_setpoint_model(outpath, log))
+            next_iter += int(np.sum(cycles['n_cycles']))
+        else:
+            for cycle in cycles:
+                for n_iter in range(next_iter, cycle['n_cycles'] + next_iter):
+                    if n_iter <= state['completed_cycles']:
+                        continue
+                    log.info('Starting cycle {}'.format(n_iter))
+                    model = fit_setpoint_model(outpath, log)  # also learns from the cycles done so far
+                    for next_temp in cycle['temps'][state['step']:]:
+                        if next_temp < cur_temp:
+                            log.info('Cooling to {}'.format(next_temp))
+                            overshoot = -10
+                        else:
+                            log.info('Heating to {}'.format(next_temp))
+                            overshoot = +5
+                        ctrl.phase = 'cycle {0}: {1}°C'.format(n_iter, next_temp)
+                        state.update(phase=ctrl.phase)
+                        switch_temperature = None
+                        if model is not None:
+                            planned_overshoot, planned_switch, duration = model.plan(cur_temp, next_temp, setpoint_limits, max_overshoot)
+                            if np.isfinite(duration):
+                                overshoot, switch_temperature = planned_overshoot, planned_switch
+                                log.info('Planned overshoot {0:+1.1f}°C, expected transition time {1:1.0f}min'.format(overshoot, duration / 60))
+                            else:
+                                log.warning('Setpoint model does not reach {0}°C, using fixed overshoot {1:+d}°C for this step'.format(next_temp, overshoot))
+                        ctrl.go_to_temperature(next_temp, wait_time=cycle['wait_time'], overshoot=overshoot, switch_temperature=switch_temperature)
+                        cur_temp = next_temp
+                        state.complete_step()
+                    state.complete_cycle()
+                next_iter += cycle['n_cycles']
+    except RunStopped:
+        notify("Thermal cycling was stopped manually!")
+        raise
     except Exception:
         notify("An error occured during thermal cycling!")
         raise
     finally:
-        logging.info('Closing up. Setting temperature to 20°C.')
-        dut['Climatechamber'].set_temperature(20)
+        log.info('Closing up. Setting temperature to 20°C.')
+        ctrl.chamber.set_temperature(20)
 
-    go_to_temperature(20)
+    ctrl.phase = 'closing'
+    state.update(phase=ctrl.phase)
+    ctrl.go_to_temperature(20)
     total_time = time.time() - total_time_start
-    logging.info('Completed {0} cycles in {1:1.2f}h'.format(next_iter - 1, total_time / 3600))
-    dut['Climatechamber'].stop_manual_mode()
+    log.info('Completed {0} cycles in {1:1.2f}h'.format(next_iter - 1, total_time / 3600))
+    ctrl.log_statistics()
+    ctrl.chamber.stop_manual_mode()
+    ctrl.phase = 'finished'
+    state.update(phase=ctrl.phase)
     notify("Thermal cycles are finished!")
+
+
+if __name__ == '__main__':
+    setup_logging(LOGFILE)
+    setup_slack()
+    notify("Starts thermal cycles!")
+
+    io_metrics = IOMetrics()
+    if io_metrics_port is not None:
+        io_metrics.serve(io_metrics_port)
+    atexit.register(io_metrics.finish, IO_METRICS_FILE)
+    dut = InstrumentedDut(create_dut(PERIPHERYFILE), io_metrics)
+    dut.init()
+    sensors = setup_sensors(dut)
+    ctrl = CycleController(dut, sensors, OUTFILE_TEMPS, t_sens=t_sens, air_sens=air_sens, mod_sens=mod_sens,
+                           interlock_dp=interlock_dp, min_interlock_distance=min_interlock_distance,
+                           interlock_hysteresis=interlock_hysteresis, interlock_debounce=interlock_debounce,
+                           sample_period=sample_period, log_period=log_period)
+    ctrl.add_callback('dew_point_violation', lambda **_: notify('Dew point interlock triggered, holding temperature!'))
+    if telemetry_port is not None or telemetry_socket is not None:
+        telemetry = TelemetryServer(attach(ctrl, int(telemetry_history / sample_period)), port=telemetry_port, unix_socket=telemetry_socket)
+        atexit.register(telemetry.close)
+
+    state = CampaignState(os.path.join(OUTPATH, STATEFILE)) if resume else None
+    write_header(OUTFILE_TEMPS, sensors)
+    run_thermocycling(ctrl, state=state)
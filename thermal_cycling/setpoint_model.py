@@ -0,0 +1,120 @@
+'''
+    First-order-plus-dead-time (FOPDT) model of the module temperature vs. the chamber setpoint.
+
+    The model is learned from logged temperature data (*_temps.dat) and used to plan temperature
+    transitions: drive the chamber with the largest allowed overshoot and switch back to the target
+    one dead time before the module reaches it, so the module arrives at the target without overshooting.
+'''
+
+import numpy as np
+
+from thermocycling_data import load_temps
+
+
+class SetpointModel(object):
+    '''
+    tau * dy/dt = gain * u(t - dead_time) + offset - y(t)
+
+    with module temperature y and chamber setpoint u.
+    '''
+
+    def __init__(self, gain, offset, tau, dead_time):
+        self.gain = gain
+        self.offset = offset
+        self.tau = tau
+        self.dead_time = dead_time
+
+    def __repr__(self):
+        return 'SetpointModel(gain={0:1.3f}, offset={1:1.2f}, tau={2:1.0f}s, dead_time={3:1.0f}s)'.format(self.gain, self.offset, self.tau, self.dead_time)
+
+    def steady_state(self, setpoint):
+        return self.gain * setpoint + self.offset
+
+    @staticmethod
+    def _resample(timestamps, setpoint, temperature, dt):
+        sel = ~np.isnan(temperature) & ~np.isnan(setpoint)
+        timestamps, setpoint, temperature = timestamps[sel], setpoint[sel], temperature[sel]
+        if len(timestamps) < 2:
+            return None
+        grid = np.arange(timestamps[0], timestamps[-1], dt)
+        y = np.interp(grid, timestamps, temperature)
+        u = setpoint[np.searchsorted(timestamps, grid, side='right') - 1]  # setpoint is a step function
+        return u, y
+
+    @classmethod
+    def fit(cls, segments, dt=10., max_dead_time=600.):
+        '''
+        Least squares fit of the discretized model y[k+1] = a * y[k] + b * u[k - d] + c for every dead time d
+        on the grid, the dead time with the smallest residual wins.
+
+        Parameters
+        ----------
+        segments : list of tuples
+            (timestamps, setpoint, temperature) arrays of continuous measurements, e.g. one per data file.
+        dt : float
+            Time step in s the data is resampled to.
+        max_dead_time : float
+            Largest dead time in s that is tried.
+        '''
+        resampled = [r for r in (cls._resample(*s, dt=dt) for s in segments) if r is not None]
+
+        best = None
+        for d in range(int(max_dead_time // dt) + 1):
+            rows, targets = [], []
+            for u, y in resampled:
+                if len(y) < d + 10:
+                    continue
+                rows.append(np.column_stack((y[d:-1], u[:len(y) - 1 - d], np.ones(len(y) - 1 - d))))
+                targets.append(y[d + 1:])
+            if not rows:
+                break
+            A, b = np.concatenate(rows), np.concatenate(targets)
+            coeffs, residuals, _, _ = np.linalg.lstsq(A, b, rcond=None)
+            residual = residuals[0] if len(residuals) else np.inf
+            if best is None or residual < best[0]:
+                best = (residual, d, coeffs)
+
+        if best is None:
+            raise ValueError('Not enough data to fit setpoint model')
+        _, d, (a, b, c) = best
+        if not 0 < a < 1 or b <= 0:
+            raise ValueError('Data does not describe a stable first order system (a = {0:1.4f}, b = {1:1.4f})'.format(a, b))
+        return cls(gain=b / (1 - a), offset=c / (1 - a), tau=-dt / np.log(a), dead_time=d * dt)
+
+    @classmethod
+    def from_files(cls, filenames, t_sens, **kwargs):
+        ''' Fit the model to the setpoint and t_sens columns of QC runner data files. '''
+        segments = []
+        for filename in filenames:
+            data = load_temps(filename)
+            segments.append((data['timestamp'], data['t_setp'], data[t_sens]))
+        return cls.fit(segments, **kwargs)
+
+    def plan(self, current, target, setpoint_limits, max_overshoot=None):
+        '''
+        Plan the fastest transition from current to target module temperature.
+
+        Returns
+        -------
+        overshoot : float
+            Setpoint relative to target that is used during the transition.
+        switch_temperature : float
+            Module temperature at which the setpoint has to be set back to target. None if no overshoot is used.
+        duration : float
+            Expected duration of the transition in s.
+        '''
+        direction = 1 if target > current else -1
+        setpoint = setpoint_limits[1] if direction > 0 else setpoint_limits[0]
+        if max_overshoot is not None:
+            setpoint = target + direction * min(abs(setpoint - target), max_overshoot)
+
+        y_inf = self.steady_state(setpoint)
+        if (y_inf - target) * direction <= 0:  # overshoot does not help, module would not reach target
+            return 0, None, np.inf
+
+        duration = self.dead_time + self.tau * np.log((y_inf - current) / (y_inf - target))
+        # The module follows the old setpoint for one dead time after switching
+        switch_temperature = y_inf - (y_inf - target) * np.exp(self.dead_time / self.tau)
+        if (switch_temperature - current) * direction <= 0:  # transition is shorter than dead time
+            return 0, None, duration
+        return setpoint - target, switch_temperature, duration
@@ -0,0 +1,247 @@
+'''
+    In-memory telemetry of the thermal cycling runs.
+
+    TelemetryBuffer keeps the last samples of a CycleController in a fixed-size ring buffer (hook it to the
+    'sampled' event). TelemetryServer serves one or several buffers on a local http port or unix socket, so
+    monitors and plotters get the current state without reading the data file:
+
+    /setups                                    names of the served setups
+    /latest?setup=chamber_1                    last sample and status (e.g. phase) as json
+    /history?names=t_mod,t_air&start=&stop=&points=500&format=npy
+                                               samples between the unix timestamps start and stop, averaged down
+                                               to at most points rows. json (default) or a numpy .npy structured
+                                               array with the fields time and names.
+
+    curl localhost:8088/latest
+    np.load(io.BytesIO(urlopen('http://localhost:8088/history?points=1000&format=npy').read()))
+'''
+
+import io
+import os
+import json
+import socket
+import logging
+import threading
+import warnings
+import socketserver
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+class TelemetryBuffer(object):
+    '''
+    Ring buffer of the last size samples of the values names.
+
+    Parameters
+    ----------
+    names : list of str
+        Values stored per sample, other values are ignored and missing ones (or None) stored as NaN.
+    size : int
+        Number of samples kept.
+    status : callable
+        Returns a dict with the current status (e.g. the phase of the controller), added to the latest sample.
+    '''
+
+    def __init__(self, names, size=24 * 60 * 60, status=None):
+        self.names = list(names)
+        self.size = int(size)
+        self.status = status
+        self.time = np.full(self.size, np.nan)
+        self.values = np.full((self.size, len(self.names)), np.nan)
+        self.n = 0  # samples appended in total, the latest one is at (n - 1) % size
+        self._lock = threading.Lock()
+
+    def append(self, values, timestamp, **_):
+        ''' Add one sample, signature of the 'sampled' callback of CycleController. '''
+        row = [values.get(name) for name in self.names]
+        with self._lock:
+            i = self.n % self.size
+            self.time[i] = timestamp
+            self.values[i] = [v if v is not None else np.nan for v in row]
+            self.n += 1
+
+    def latest(self):
+        ''' Last sample as dict with time, values and status, None if empty. '''
+        with self._lock:
+            if self.n == 0:
+                return None
+            i = (self.n - 1) % self.size
+            sample = {'time': self.time[i], 'values': dict(zip(self.names, self.values[i].tolist()))}
+        if self.status is not None:
+            sample['status'] = self.status()
+        return sample
+
+    def history(self, start=None, stop=None, names=None, points=None):
+        '''
+        Samples with start <= time < stop (unix timestamps, open if None) of the values names (all if None).
+        With points, consecutive samples are averaged so that at most points rows are returned.
+        Returns a structured array with the fields time and names.
+        '''
+        names = self.names if names is None else list(names)
+        unknown = set(names) - set(self.names)
+        if unknown:
+            raise KeyError('Unknown values: {0}'.format(', '.join(sorted(unknown))))
+        columns = [self.names.index(name) for name in names]
+        with self._lock:
+            n, first = min(self.n, self.size), self.n % self.size if self.n > self.size else 0
+            # Only the time stamps are put in order to find the range, then only the rows in range are copied
+            t = np.roll(self.time[:n], -first)
+            lo = 0 if start is None else np.searchsorted(t, start, side='left')
+            hi = n if stop is None else np.searchsorted(t, stop, side='left')
+            rows = (first + np.arange(lo, hi)) % self.size
+            t, values = t[lo:hi], self.values[rows[:, np.newaxis], columns]
+        if points is not None and len(t) > points > 0:
+            t, values = _average(t, values, int(np.ceil(len(t) / float(points))))
+
+        data = np.empty(len(t), dtype=[('time', np.float64)] + [(name, np.float64) for name in names])
+        data['time'] = t
+        for j, name in enumerate(names):
+            data[name] = values[:, j]
+        return data
+
+
+def _average(t, values, n):
+    ''' Means of blocks of n samples, NaN (missing readouts) are ignored. '''
+    pad = -len(t) % n
+    t = np.concatenate((t, np.full(pad, np.nan))).reshape(-1, n)
+    values = np.concatenate((values, np.full((pad, values.shape[1]), np.nan))).reshape(-1, n, values.shape[1])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # blocks with only missing values
+        return np.nanmean(t, axis=1), np.nanmean(values, axis=1)
+
+
+def attach(ctrl, size=24 * 60 * 60):
+    ''' TelemetryBuffer of all values of a CycleController filled on every sample, with its phase as status. '''
+    names = list(ctrl.sensors['name'])
+    if ctrl.interlock is not None and ctrl.interlock_dp not in names:
+        names.append(ctrl.interlock_dp)
+
+    def status():
+        return {'phase': ctrl.phase, 'interlock': ctrl.interlock is not None and ctrl.interlock.active}
+
+    buffer = TelemetryBuffer(names, size=size, status=status)
+    ctrl.add_callback('sampled', buffer.append)
+    return buffer
+
+
+def _json_value(value):
+    ''' NaN is not valid json, missing values are null. '''
+    return None if isinstance(value, float) and value != value else value
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super(_UnixHTTPServer, self).get_request()
+        return request, ('local', 0)  # BaseHTTPRequestHandler expects (host, port)
+
+
+class TelemetryServer(object):
+    '''
+    Serves telemetry buffers from a background thread.
+
+    Parameters
+    ----------
+    buffers : TelemetryBuffer or dict
+        Buffer of one setup or buffers by setup name.
+    port : int
+        Local http port, or
+    unix_socket : str
+        Path of a unix socket.
+    '''
+
+    def __init__(self, buffers, port=None, unix_socket=None, host='localhost'):
+        self.buffers = buffers if isinstance(buffers, dict) else {'default': buffers}
+        self.log = logging.getLogger('TelemetryServer')
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {key: value[-1] for key, value in parse_qs(url.query).items()}
+                try:
+                    content_type, body = telemetry.handle(url.path, query)
+                    status = 200
+                except KeyError as e:
+                    content_type, body, status = 'application/json', json.dumps({'error': str(e)}).encode(), 404
+                except ValueError as e:
+                    content_type, body, status = 'application/json', json.dumps({'error': str(e)}).encode(), 400
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            self._server = _UnixHTTPServer(unix_socket, Handler)
+            self.address = unix_socket
+        else:
+            self._server = ThreadingHTTPServer((host, port), Handler)
+            self.address = '{0}:{1}'.format(*self._server.server_address[:2])
+        self.unix_socket = unix_socket
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.log.info('Serving telemetry on {0}'.format(self.address))
+
+    def handle(self, path, query):
+        ''' Content type and body of the reply to a request of path with the query parameters. '''
+        if path == '/setups':
+            return 'application/json', json.dumps(list(self.buffers)).encode()
+        setup = query.get('setup', next(iter(self.buffers)))
+        if setup not in self.buffers:
+            raise KeyError('Unknown setup {0}'.format(setup))
+        buffer = self.buffers[setup]
+        if path == '/latest':
+            sample = buffer.latest()
+            if sample is not None:
+                sample['values'] = {key: _json_value(value) for key, value in sample['values'].items()}
+            return 'application/json', json.dumps(sample, default=str).encode()
+        if path == '/history':
+            names = query['names'].split(',') if query.get('names') else None
+            start, stop, points = query.get('start'), query.get('stop'), query.get('points')
+            data = buffer.history(start=float(start) if start else None, stop=float(stop) if stop else None, names=names,
+                                  points=int(points) if points else None)
+            if query.get('format', 'json') == 'npy':
+                f = io.BytesIO()
+                np.save(f, data)
+                return 'application/octet-stream', f.getvalue()
+            return 'application/json', json.dumps({name: [_json_value(v) for v in data[name].tolist()] for name in data.dtype.names}).encode()
+        raise KeyError('Unknown path {0}'.format(path))
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self.unix_socket is not None and os.path.exists(self.unix_socket):
+            os.remove(self.unix_socket)
+
+
+def request(address, path):
+    ''' Body of a GET request to a TelemetryServer on 'host:port' or a unix socket path. '''
+    if ':' in address:
+        from urllib.request import urlopen
+
+        with urlopen('http://{0}{1}'.format(address, path)) as response:
+            return response.read()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    try:
+        sock.sendall('GET {0} HTTP/1.0\r\n\r\n'.format(path).encode())
+        response = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+    finally:
+        sock.close()
+    header, _, body = response.partition(b'\r\n\r\n')
+    if b' 200 ' not in header.split(b'\r\n')[0]:
+        raise IOError(body.decode(errors='replace'))
+    return body
@@ -0,0 +1,151 @@
+'''
+    Vectorized loader for the temperature logs (*_temps.dat) written by the thermal cycling runners.
+
+    Both file layouts are supported:
+      - the fixed 9 column layout of run_thermocycling_DC.py / run_connectivity_cycles.py (use names=DC_NAMES)
+      - the header driven layout of run_thermocycling_QC.py (column names are taken from the header line,
+        further comment lines like '#Modules: ...' are skipped)
+
+    Parsing the text is the slow part (a week of 1 Hz QC data, 604,800 rows with 20 columns, takes about 1.3 s), so the
+    parsed rows are also kept in a cache file next to the log (<log>.npz). Later loads, also by other processes (plots,
+    analysis, dossiers), read the binary rows and only parse the lines appended since then.
+'''
+
+import io
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+
+# Column names (without timestamp) of the fixed layout written by run_thermocycling_DC.py and run_connectivity_cycles.py
+DC_NAMES = ['t_setp', 't_chamber', 't_sens', 'h_sens', 't_mod', 'h_mod', 't_air', 'h_air']
+
+# Already parsed rows per file: {filename: (mtime_ns, bytes_read, head, tail, raw_data)}, makes repeated loads of a
+# growing file cheap. head (first bytes) and tail (last parsed line) detect a file which was rewritten meanwhile.
+_cache = {}
+
+CACHE_FILES = True  # keep the parsed rows in <log>.npz
+CACHE_MIN_BYTES = 1 << 20  # the cache file is only (re)written after parsing at least this many bytes
+
+
+def _read_header_names(filename):
+    with open(filename, 'r') as f:
+        header = f.readline()
+    if not header.startswith('#'):
+        raise ValueError('{0} has no header line, column names have to be given'.format(filename))
+    return [n.strip() for n in header.split(',')[1:] if n.strip()]
+
+
+def _parse_lines(text):
+    ''' Parse complete lines of comma separated values. 'None' entries become NaN. '''
+    if not text.strip(b'\n'):
+        return None
+    return np.loadtxt(io.BytesIO(text.replace(b'None', b'nan')), delimiter=',', dtype=np.float64, ndmin=2)
+
+
+def _load_cache_file(filename):
+    try:
+        with np.load(filename + '.npz') as f:
+            return None, int(f['offset']), f['head'].tobytes(), f['tail'].tobytes(), f['raw']
+    except (OSError, KeyError, ValueError):  # no or a broken cache file
+        return None, 0, b'', b'', None
+
+
+def _save_cache_file(filename, offset, head, tail, raw):
+    tmp = filename + '.tmp.npz'
+    try:
+        with open(tmp, 'wb') as f:
+            np.savez(f, offset=offset, head=np.frombuffer(head, dtype=np.uint8), tail=np.frombuffer(tail, dtype=np.uint8), raw=raw)
+        os.replace(tmp, filename + '.npz')  # readers never see a partly written cache
+    except OSError:  # e.g. read-only data directory, the next load parses again
+        pass
+
+
+def _read_raw(filename):
+    stat = os.stat(filename)
+    entry = _cache.get(filename)
+    if entry is None and CACHE_FILES:
+        entry = _load_cache_file(filename)
+    mtime, offset, head, tail, raw = entry if entry is not None else (None, 0, b'', b'', None)
+    if stat.st_mtime_ns == mtime and stat.st_size == offset:
+        return raw
+
+    with open(filename, 'rb') as f:
+        if offset > 0:
+            # Only append to the parsed rows if the file starts with the same bytes and the last parsed line is unchanged
+            unchanged = stat.st_size >= offset and f.read(len(head)) == head
+            f.seek(offset - len(tail))
+            if not unchanged or f.read(len(tail)) != tail:  # file was rewritten
+                offset, head, raw = 0, b'', None
+        f.seek(offset)
+        text = f.read()
+    # Only use complete lines, the runner might still be writing the last one
+    text = text[:text.rfind(b'\n') + 1]
+    new = _parse_lines(text)
+    if new is not None:
+        raw = new if raw is None else np.concatenate((raw, new))
+    if text:
+        head = head or text[:256]
+        tail = text[text.rfind(b'\n', 0, -1) + 1:]
+    _cache[filename] = (stat.st_mtime_ns, offset + len(text), head, tail, raw)
+    if CACHE_FILES and raw is not None and len(text) >= CACHE_MIN_BYTES:
+        _save_cache_file(filename, offset + len(text), head, tail, raw)
+    return raw
+
+
+def to_local_datetime(timestamps):
+    ''' Convert epoch seconds to naive datetime64 in local time (same as datetime.fromtimestamp) in bulk. '''
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    if timestamps.size == 0:
+        return np.array([], dtype='datetime64[ms]')
+    # UTC offset only changes on full hours, so it is only evaluated once per hour of data
+    hours = np.floor(timestamps / 3600.).astype(np.int64)
+    first_hour = hours.min()
+    offsets = np.array([(datetime.fromtimestamp(h * 3600.) - datetime.fromtimestamp(h * 3600., timezone.utc).replace(tzinfo=None)).total_seconds()
+                        for h in range(first_hour, hours.max() + 1)])
+    return ((timestamps + offsets[hours - first_hour]) * 1e3).astype('datetime64[ms]')
+
+
+def load_temps(filename, names=None):
+    '''
+    Load a thermocycling temperature log.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the *_temps.dat file.
+    names : list of str
+        Names of the data columns (without timestamp). If None the names are read from the header line.
+
+    Returns
+    -------
+    Structured array with the fields 'timestamp' (epoch seconds), 'time' (local datetime64)
+    and one float field per data column. Missing values ('None') are NaN.
+    '''
+    if names is None:
+        names = _read_header_names(filename)
+    raw = _read_raw(filename)
+
+    n_cols = len(names) if raw is None else raw.shape[1] - 1
+    if len(names) < n_cols:
+        raise ValueError('{0} has {1} data columns but only {2} names are given'.format(filename, n_cols, len(names)))
+    names = list(names[:n_cols])  # header of QC runner lists the interlock dew point twice
+    if len(set(names)) != len(names):
+        raise ValueError('Duplicate column names in {0}: {1}'.format(filename, names))
+
+    dtype = [('timestamp', np.float64), ('time', 'datetime64[ms]')] + [(name, np.float64) for name in names]
+    if raw is None:
+        return np.zeros(0, dtype=dtype)
+
+    # All fields have 8 bytes: the rows are filled as 2d array (fast block copy) and viewed as records
+    rows = np.empty((raw.shape[0], n_cols + 2))
+    rows[:, 0] = raw[:, 0]
+    rows[:, 1].view(np.int64)[:] = to_local_datetime(raw[:, 0]).view(np.int64)
+    rows[:, 2:] = raw[:, 1:n_cols + 1]
+    return rows.view(dtype)[:, 0]
+
+
+def valid(data, name):
+    ''' Return times and values of column name where data is available. '''
+    sel = ~np.isnan(data[name])
+    return data['time'][sel], data[name][sel]
@@ -0,0 +1,43 @@
+'''
+    Cache of converged global threshold tunings, keyed by module, temperature and front-end.
+
+    Cached register values make it possible to skip the tuning of the next cycle when a short verification
+    scan shows that the module is still tuned.
+'''
+
+import os
+import json
+import time
+
+from campaign_state import save_json
+
+
+class TuningCache(object):
+    '''
+    Parameters
+    ----------
+    filename : str
+        Json file the cache is stored in, it is loaded if it exists.
+    temperature_step : float
+        Temperatures are rounded to this step to build the key.
+    '''
+
+    def __init__(self, filename, temperature_step=5):
+        self.filename = filename
+        self.temperature_step = temperature_step
+        self.entries = {}
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                self.entries = json.load(f)
+
+    def key(self, module, temperature, front_end):
+        return '{0}/{1:+d}/{2}'.format(module, int(round(temperature / self.temperature_step) * self.temperature_step), front_end)
+
+    def get(self, module, temperature, front_end):
+        ''' Return the registers of the last converged tuning, None if there is none. '''
+        entry = self.entries.get(self.key(module, temperature, front_end))
+        return entry['registers'] if entry is not None else None
+
+    def store(self, module, temperature, front_end, registers):
+        self.entries[self.key(module, temperature, front_end)] = {'registers': registers, 'time': time.time()}
+        save_json(self.filename, self.entries)